@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+bench_aggregate_counts.py
+-------------------------
+Benchmarks aggregate_counts.aggregate_listens (row-by-row dict) against
+aggregate_counts.aggregate_listens_vectorized on synthetic userid-artist.csv files.
+For each size, both implementations run on the same file; the script checks that the
+outputs are identical and reports wall time, events/sec and peak RSS.
+
+Each implementation runs in its own process so peak RSS is measured independently.
+
+Usage:
+    python benchmarks/bench_aggregate_counts.py [--events 10000000,100000000] [--users N] [--artists N]
+                                                [--skip-dict-above N] [--work-dir DIR]
+
+Example:
+    python benchmarks/bench_aggregate_counts.py --events 1000000,10000000
+"""
+
+import argparse
+import filecmp
+import os
+import resource
+import sys
+import tempfile
+import time
+import uuid
+from multiprocessing import get_context
+
+import numpy as np
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.preprocessing.aggregate_counts import aggregate_listens, aggregate_listens_vectorized
+
+IMPLEMENTATIONS = {
+    "dict": aggregate_listens,
+    "vectorized": aggregate_listens_vectorized,
+}
+
+def write_synthetic_user_artist(path, num_events, num_users, num_artists, seed=0, block=1_000_000):
+    """
+    Writes a synthetic userid-artist.csv with Zipf-like artist popularity.
+    """
+    rng = np.random.default_rng(seed)
+    artist_ids = np.array([str(uuid.UUID(int=int(x))) for x in rng.integers(0, 2**63, num_artists)], dtype=object)
+    with open(path, "w", encoding="utf-8") as fp:
+        fp.write("user_id,artist_id\n")
+        for start in range(0, num_events, block):
+            size = min(block, num_events - start)
+            users = rng.integers(1, num_users + 1, size)
+            artists = np.minimum(rng.zipf(1.3, size) - 1, num_artists - 1)
+            fp.write("\n".join(f"{u},{a}" for u, a in zip(users.tolist(), artist_ids[artists])))
+            fp.write("\n")
+
+def _run(name, input_file, output_file, queue):
+    started = time.perf_counter()
+    IMPLEMENTATIONS[name](input_file, output_file)
+    seconds = time.perf_counter() - started
+    queue.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def run_isolated(name, input_file, output_file):
+    """Runs one implementation in a fresh process and returns (seconds, peak_rss_mb)."""
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run, args=(name, input_file, output_file, queue))
+    process.start()
+    seconds, max_rss_kb = queue.get()
+    process.join()
+    return seconds, max_rss_kb / 1024
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark listen count aggregation.")
+    parser.add_argument("--events", default="10000000,100000000", help="Comma-separated event counts")
+    parser.add_argument("--users", type=int, default=20000, help="Number of distinct users")
+    parser.add_argument("--artists", type=int, default=200000, help="Number of distinct artists")
+    parser.add_argument("--skip-dict-above", type=int, default=None,
+                        help="Do not run the dict implementation above this many events")
+    parser.add_argument("--work-dir", default=None, help="Directory for the synthetic files (default: a temp dir)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as tmp_dir:
+        for num_events in (int(n) for n in args.events.split(",")):
+            input_file = os.path.join(tmp_dir, f"userid-artist-{num_events}.csv")
+            print(f"\nWriting {num_events:,} synthetic events ...")
+            write_synthetic_user_artist(input_file, num_events, args.users, args.artists)
+
+            outputs = []
+            for name in IMPLEMENTATIONS:
+                if name == "dict" and args.skip_dict_above and num_events > args.skip_dict_above:
+                    print(f"{name:>10}: skipped")
+                    continue
+                output_file = os.path.join(tmp_dir, f"counts-{name}.csv")
+                seconds, peak_mb = run_isolated(name, input_file, output_file)
+                outputs.append(output_file)
+                print(f"{name:>10}: {seconds:8.1f}s  {num_events / seconds:>12,.0f} events/sec  peak RSS {peak_mb:,.0f} MB")
+            if len(outputs) == 2:
+                same = filecmp.cmp(outputs[0], outputs[1], shallow=False)
+                print(f"outputs {'identical' if same else 'DIFFERENT'}")
+            os.remove(input_file)
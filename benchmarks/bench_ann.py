@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+bench_ann.py
+------------
+Recall@K versus latency of the approximate nearest-neighbour backends of src/utils/ann.py,
+against the exact cosine top-K of src/utils/similarity.py, to choose a backend and its query
+setting (nprobe for "ivf", ef for "hnsw", which is skipped if hnswlib is not installed).
+
+For each setting it runs single-artist queries one at a time and reports the mean and 99th
+percentile latency and recall@K (the share of the exact K nearest artists found). It uses the
+item factors of a model saved by listenbrainz_model.save_model (--model), or synthetic
+clustered factors for --artists artists (random factors without clusters are the worst case
+for any ANN index and do not resemble trained ones).
+
+Usage:
+    python benchmarks/bench_ann.py [--model DIR] [--artists N] [--factors N] [--clusters N]
+                                   [--queries N] [--k N] [--backends ivf,hnsw] [--nprobe 1,2,...]
+                                   [--ef 16,32,...] [--seed N] [--report FILE]
+
+Example:
+    python benchmarks/bench_ann.py --artists 1000000 --queries 500 --report ann.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.utils.ann import ANN_BACKENDS, hnswlib
+from src.utils.model_store import SavedModel
+from src.utils.similarity import normalized_factors, top_k_similar
+
+def clustered_factors(num_artists, factors, num_clusters, seed):
+    """Gaussian mixture of num_clusters clusters, as float32 factors."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, factors), dtype=np.float32)
+    labels = rng.integers(0, num_clusters, num_artists)
+    noise = rng.standard_normal((num_artists, factors), dtype=np.float32)
+    return centers[labels] + noise
+
+def evaluate(index, item_factors, rows, exact, k, query_params):
+    """Latency (ms) of single queries and recall@k against the exact neighbours."""
+    latencies = np.empty(len(rows))
+    found = 0
+    for i, row in enumerate(rows.tolist()):
+        started = time.perf_counter()
+        items, _ = index.query(item_factors[row], k, **query_params)
+        latencies[i] = (time.perf_counter() - started) * 1000
+        found += len(np.intersect1d(items, exact[i]))
+    return {"mean_ms": float(latencies.mean()), "p99_ms": float(np.percentile(latencies, 99)),
+            "recall": found / exact.size}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@K vs latency of the ANN backends.")
+    parser.add_argument("--model", default=None, help="Directory of a model saved by save_model")
+    parser.add_argument("--artists", type=int, default=200_000, help="Artists of the synthetic factors")
+    parser.add_argument("--factors", type=int, default=64, help="Factors of the synthetic factors")
+    parser.add_argument("--clusters", type=int, default=1000, help="Clusters of the synthetic factors")
+    parser.add_argument("--queries", type=int, default=500, help="Number of query artists")
+    parser.add_argument("--k", type=int, default=20, help="Neighbours per query (the K of recall@K)")
+    parser.add_argument("--backends", default="ivf,hnsw", help="Comma-separated backends to evaluate")
+    parser.add_argument("--nprobe", default="1,2,4,8,16,32,64", help="nprobe settings of the ivf backend")
+    parser.add_argument("--ef", default="20,40,80,160,320", help="ef settings of the hnsw backend")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--report", default=None, help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    if args.model:
+        item_factors = np.asarray(SavedModel.load(args.model).item_factors)
+    else:
+        item_factors = clustered_factors(args.artists, args.factors, args.clusters, args.seed)
+    rows = np.random.default_rng(args.seed + 1).choice(len(item_factors), min(args.queries, len(item_factors)),
+                                                       replace=False)
+    print(f"{len(item_factors):,} artists x {item_factors.shape[1]} factors, {len(rows)} queries, K={args.k}")
+
+    normalized = normalized_factors(item_factors)
+    started = time.perf_counter()
+    exact, _ = top_k_similar(normalized, args.k, rows=rows)
+    exact_ms = (time.perf_counter() - started) * 1000 / len(rows)
+    started = time.perf_counter()
+    for row in rows[:20]:
+        top_k_similar(normalized, args.k, rows=[row])
+    single_ms = (time.perf_counter() - started) * 1000 / min(20, len(rows))
+    print(f"Exact: {single_ms:.2f} ms per single query, {exact_ms:.2f} ms per query in a batch\n")
+    results = {"artists": len(item_factors), "factors": int(item_factors.shape[1]), "k": args.k,
+               "exact_single_ms": single_ms, "exact_batched_ms": exact_ms, "backends": {}}
+
+    settings = {"ivf": ("nprobe", args.nprobe), "hnsw": ("ef", args.ef)}
+    print(f"{'backend':<8} {'setting':<12} {'recall@K':>9} {'mean ms':>9} {'p99 ms':>9}")
+    for backend in [name.strip() for name in args.backends.split(",") if name.strip()]:
+        if backend == "hnsw" and hnswlib is None:
+            print(f"{backend:<8} skipped: hnswlib is not installed")
+            continue
+        started = time.perf_counter()
+        index = ANN_BACKENDS[backend].build(item_factors)
+        build_seconds = time.perf_counter() - started
+        name, values = settings[backend]
+        rows_out = []
+        for value in [int(value) for value in values.split(",")]:
+            metrics = evaluate(index, item_factors, rows, exact, args.k, {name: value})
+            rows_out.append(dict(metrics, **{name: value}))
+            print(f"{backend:<8} {name + '=' + str(value):<12} {metrics['recall']:>9.3f} "
+                  f"{metrics['mean_ms']:>9.3f} {metrics['p99_ms']:>9.3f}")
+        print(f"{backend:<8} built in {build_seconds:.1f}s")
+        results["backends"][backend] = {"build_seconds": build_seconds, "settings": rows_out}
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+        print(f"Report saved to {args.report}")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+bench_artist_names.py
+---------------------
+Benchmarks loading the artist MBID -> name mapping and looking names up, for the formats
+artist_mapping.py can write:
+
+    csv     parsing musicbrainz_artist.csv into a dict (the former get_artist_map)
+    json    json.load of the artist_mapping.json export
+    table   UuidStringTable.load of the string table, memory-mapped (see src/utils/interning.py)
+
+The JSON export and the table are written once from the CSV. Each format is then loaded in a
+fresh process, which reports the load time, the memory it added to the process (peak RSS
+increase) and the time of --lookups single lookups and of one batch lookup of the same MBIDs.
+
+Usage:
+    python benchmarks/bench_artist_names.py <musicbrainz_artist_csv> [--work-dir DIR] [--lookups N]
+                                            [--seed N] [--report FILE]
+
+Example:
+    python benchmarks/bench_artist_names.py /mnt/j/MusicBrainz/musicbrainz_artist.csv --report names.json
+"""
+
+import argparse
+import csv
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.preprocessing.artist_mapping import build_artist_mapping, build_artist_table, export_artist_json
+from src.utils.interning import UuidStringTable
+
+def load_csv(path):
+    artist_map = {}
+    with open(path, encoding="utf-8") as fp:
+        for line in csv.DictReader(fp):
+            artist_map[line["artist_mbid"]] = line["name"]
+    return artist_map
+
+def load_json(path):
+    with open(path, encoding="utf-8") as fp:
+        return json.load(fp)
+
+LOADERS = {"csv": load_csv, "json": load_json, "table": UuidStringTable.load}
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_format(name, path, mbids):
+    """Worker: loads one format and times its lookups (see the module docstring)."""
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    artist_map = LOADERS[name](path)
+    load_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for mbid in mbids:
+        artist_map.get(mbid)
+    single_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    if isinstance(artist_map, UuidStringTable):
+        found = artist_map.get_many(mbids)
+    else:
+        found = [artist_map.get(mbid) for mbid in mbids]
+    batch_seconds = time.perf_counter() - started
+    return {"format": name, "load_seconds": load_seconds, "rss_mb": peak_rss_mb() - baseline,
+            "single_us": single_seconds * 1e6 / len(mbids), "batch_us": batch_seconds * 1e6 / len(mbids),
+            "found": sum(name is not None for name in found)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark loading and looking up artist names.")
+    parser.add_argument("artist_csv", help="musicbrainz_artist.csv to convert and load")
+    parser.add_argument("--work-dir", default=None, help="Directory for the converted files (default: a temp dir)")
+    parser.add_argument("--lookups", type=int, default=100_000, help="MBIDs looked up per format")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the looked-up MBIDs")
+    parser.add_argument("--report", default=None, help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_artist_names_")
+    paths = {"csv": args.artist_csv, "json": os.path.join(work_dir, "artist_mapping.json"),
+             "table": os.path.join(work_dir, "artist_names")}
+    started = time.perf_counter()
+    table = build_artist_table(args.artist_csv)
+    table.save(paths["table"])
+    print(f"Built the table of {len(table):,} artists in {time.perf_counter() - started:.2f}s")
+    export_artist_json(build_artist_mapping(args.artist_csv), paths["json"])
+
+    # Known MBIDs, in random order, plus one unknown MBID in ten.
+    rng = np.random.default_rng(args.seed)
+    known = [mbid for mbid, _ in table.items()]
+    mbids = [known[i] for i in rng.integers(0, len(known), args.lookups)]
+    for i in range(0, len(mbids), 10):
+        mbids[i] = "00000000-0000-0000-0000-" + f"{i:012x}"
+
+    print(f"\n{'format':<8} {'size MB':>9} {'load s':>9} {'RSS MB':>9} {'single us':>10} {'batch us':>9}")
+    results = []
+    for name, path in paths.items():
+        size = sum(os.path.getsize(path + suffix) for suffix in UuidStringTable.SUFFIXES) \
+            if name == "table" else os.path.getsize(path)
+        # A fresh process per format, so its memory increase is its own.
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_format, name, path, mbids).result()
+        result["size_mb"] = size / 2**20
+        results.append(result)
+        print(f"{name:<8} {result['size_mb']:>9.1f} {result['load_seconds']:>9.3f} {result['rss_mb']:>9.1f} "
+              f"{result['single_us']:>10.2f} {result['batch_us']:>9.2f}")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as fp:
+            json.dump({"artists": len(table), "lookups": len(mbids), "results": results}, fp, indent=2)
+        print(f"Report saved to {args.report}")
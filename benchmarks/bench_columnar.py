@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+bench_columnar.py
+-----------------
+Benchmarks reading a userid-artist-counts table stored as CSV, Parquet and .npcols
+(see src/utils/columnar.py). The CSV is converted to the binary formats once, then each
+format is read back in full with read_table; the script reports file size and read time.
+
+Usage:
+    python benchmarks/bench_columnar.py <userid_artist_counts_csv> [--work-dir DIR] [--repeat N]
+
+Example:
+    python benchmarks/bench_columnar.py /mnt/j/MusicBrainz/working/userid-artist-counts.csv
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.utils.columnar import copy_table, pq, read_table
+
+def path_size(path):
+    """Size in bytes of a file, or of all files in a directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+def time_read(path, repeat):
+    """Best wall time over `repeat` full reads of a table (columns forced into memory)."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        table = read_table(path)
+        for values in table.values():
+            np.array(values)  # memory-mapped .npcols columns are only paged in when copied
+        best = min(best, time.perf_counter() - started)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark CSV vs binary intermediate formats.")
+    parser.add_argument("input_csv", help="userid-artist-counts CSV to convert and read")
+    parser.add_argument("--work-dir", default=None, help="Directory for the converted tables (default: a temp dir)")
+    parser.add_argument("--repeat", type=int, default=3, help="Reads per format; the best time is reported")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_columnar_")
+    paths = {"csv": args.input_csv}
+    if pq is not None:
+        paths["parquet"] = os.path.join(work_dir, "counts.parquet")
+    paths["npcols"] = os.path.join(work_dir, "counts.npcols")
+    for name, path in paths.items():
+        if name != "csv":
+            copy_table(args.input_csv, path)
+
+    print(f"{'format':>8} {'size MB':>10} {'read s':>10}")
+    for name, path in paths.items():
+        seconds = time_read(path, args.repeat)
+        print(f"{name:>8} {path_size(path) / 2**20:>10.1f} {seconds:>10.3f}")
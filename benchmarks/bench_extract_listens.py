@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+bench_extract_listens.py
+------------------------
+Benchmarks the JSON parsing engines of extract_listens.py on a synthetic ListenBrainz-shaped
+JSON Lines file. Each engine extracts the same fields from the same file; the script checks
+that all engines produce identical CSV output and reports throughput in lines/sec.
+
+Usage:
+    python benchmarks/bench_extract_listens.py [--lines N] [--fields user_id,recording_msid,...]
+
+Example:
+    python benchmarks/bench_extract_listens.py --lines 1000000 --fields user_id,recording_msid,listened_at
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.preprocessing.extract_listens import output_fields, write_listen_rows
+from src.utils.json_fields import ENGINES, orjson
+
+def write_synthetic_listens(path, num_lines, num_users=10000, num_msids=100000, seed=0):
+    """
+    Writes a synthetic JSON Lines file shaped like a ListenBrainz listens dump.
+    """
+    rng = random.Random(seed)
+    msids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(num_msids)]
+    with open(path, "w", encoding="utf-8") as fp:
+        for i in range(num_lines):
+            msid = rng.choice(msids)
+            record = {
+                "listened_at": 1704067200 + i,
+                "user_id": rng.randint(1, num_users),
+                "user_name": f"user{rng.randint(1, num_users)}",
+                "recording_msid": msid,
+                "track_metadata": {
+                    "artist_name": "Some Artist",
+                    "track_name": f"Track {i % 977}",
+                    "release_name": "Some Release",
+                    "additional_info": {
+                        "recording_msid": msid,
+                        "media_player": "BrainzPlayer",
+                        "duration_ms": rng.randint(60000, 400000),
+                    },
+                },
+            }
+            fp.write(json.dumps(record) + "\n")
+
+def run_engine(input_file, output_csv, fields, engine):
+    """
+    Runs one extraction engine over input_file and returns (lines, seconds, digest).
+    """
+    mode = "r" if engine == "json" else "rb"
+    encoding = "utf-8" if engine == "json" else None
+    started = time.perf_counter()
+    with open(input_file, mode, encoding=encoding) as infile, \
+         open(output_csv, "w", newline="", encoding="utf-8") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(output_fields(fields))
+        total_lines, _ = write_listen_rows(infile, writer, fields, engine)
+    seconds = time.perf_counter() - started
+    with open(output_csv, "rb") as fp:
+        digest = hashlib.sha1(fp.read()).hexdigest()
+    return total_lines, seconds, digest
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark listen extraction engines.")
+    parser.add_argument("--lines", type=int, default=500000, help="Number of synthetic listens")
+    parser.add_argument("--fields", default="user_id,recording_msid", help="Comma-separated fields to project")
+    args = parser.parse_args()
+    fields = [field for field in args.fields.split(",") if field]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, "synthetic.listens")
+        print(f"Writing {args.lines} synthetic listens to {input_file} ...")
+        write_synthetic_listens(input_file, args.lines)
+
+        baseline = None
+        for engine in ENGINES:
+            if engine == "orjson" and orjson is None:
+                print(f"{engine:>8}: skipped (orjson not installed)")
+                continue
+            output_csv = os.path.join(tmp_dir, f"{engine}.csv")
+            lines, seconds, digest = run_engine(input_file, output_csv, fields, engine)
+            if baseline is None:
+                baseline = (seconds, digest)
+            identical = "identical" if digest == baseline[1] else "DIFFERENT OUTPUT"
+            print(f"{engine:>8}: {lines / seconds:>12,.0f} lines/sec  "
+                  f"{baseline[0] / seconds:5.2f}x vs json  ({identical})")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+bench_pipeline.py
+-----------------
+Runs the whole preprocessing pipeline (src/preprocessing/run_pipeline.py) on a synthetic
+ListenBrainz-shaped dataset (see synthetic_data.py) and reports the metrics of every stage:
+wall and CPU time, peak RSS, bytes read and written and rows per second
+(see src/utils/instrumentation.py).
+
+The dataset is generated in --data-dir, or reused if it was generated there with the same
+parameters. Every stage runs from scratch in a new directory under --work-dir. The script
+checks that the listen counts add up to what the generator expects, saves the report as JSON
+and, given the report of an earlier run as --baseline, flags every stage that got slower (or
+used more memory) by more than --tolerance; it exits with status 1 on a failed check or a
+regression, so it can gate changes.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--listens N] [--users N] [--recordings N] [--artists N]
+                                        [--dumps N] [--compress] [--data-dir DIR] [--work-dir DIR]
+                                        [--format csv|parquet|npcols] [--fused] [--jobs N]
+                                        [--report FILE] [--baseline FILE] [--tolerance RATIO]
+
+Example:
+    python benchmarks/bench_pipeline.py --listens 5000000 --dumps 4 --report before.json
+    python benchmarks/bench_pipeline.py --listens 5000000 --dumps 4 --report after.json --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from benchmarks.synthetic_data import generate_dataset, load_dataset
+from src.preprocessing.run_pipeline import build_stages, print_report
+from src.utils.columnar import iter_table
+from src.utils.pipeline import run_pipeline
+
+# Metrics compared against the baseline (higher is worse for all of them)
+COMPARED_METRICS = ("wall_seconds", "peak_rss_mb")
+# Stages shorter than this in the baseline are too noisy to flag as slower
+MIN_COMPARED_SECONDS = 1.0
+
+def check_counts(counts_file, expected):
+    """
+    Checks that the listen counts of the pipeline output add up to the number of listens the
+    generator resolved to an artist.
+
+    Returns:
+        dict: expected and actual totals, and whether they match.
+    """
+    total = sum(int(chunk["listen_count"].sum()) for chunk in iter_table(counts_file, ["listen_count"]))
+    return {"expected_listens": expected["converted_listens"], "counted_listens": total,
+            "ok": total == expected["converted_listens"]}
+
+def compare_reports(report, baseline, tolerance):
+    """
+    Prints the ratio of each stage's metrics to the baseline's.
+
+    Returns:
+        list: (stage, metric, ratio) for every metric over the tolerance.
+    """
+    regressions = []
+    print(f"\n{'stage':<18} " + " ".join(f"{metric:>14}" for metric in COMPARED_METRICS))
+    for name, stage in report["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if stage["status"] != "ran" or not before or before.get("status") != "ran":
+            continue
+        cells = []
+        for metric in COMPARED_METRICS:
+            ratio = stage[metric] / before[metric] if before[metric] else 1.0
+            regressed = ratio > tolerance and (metric != "wall_seconds" or before[metric] >= MIN_COMPARED_SECONDS)
+            flag = " !" if regressed else "  "
+            if regressed:
+                regressions.append((name, metric, ratio))
+            cells.append(f"{ratio:>11.2f}x{flag}")
+        print(f"{name:<18} " + " ".join(cells))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the whole preprocessing pipeline on synthetic data.")
+    parser.add_argument("--listens", type=int, default=1_000_000, help="Number of synthetic listens")
+    parser.add_argument("--users", type=int, default=10_000, help="Number of distinct users")
+    parser.add_argument("--recordings", type=int, default=100_000, help="Number of recordings")
+    parser.add_argument("--artists", type=int, default=20_000, help="Number of artists")
+    parser.add_argument("--dumps", type=int, default=1, help="Number of listen dump files")
+    parser.add_argument("--compress", action="store_true", help="zstd-compress the listen dumps")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the dataset")
+    parser.add_argument("--data-dir", default=None, help="Directory of the synthetic dataset (default: a temp dir)")
+    parser.add_argument("--work-dir", default=None, help="Directory under which each run gets its working dir")
+    parser.add_argument("--format", choices=["csv", "parquet", "npcols"], default="csv",
+                        help="Format of the intermediate tables")
+    parser.add_argument("--fused", action="store_true", help="Canonicalize and aggregate in one stage")
+    parser.add_argument("--jobs", type=int, default=None, help="Maximum number of stages running at once")
+    parser.add_argument("--report", default=None, help="JSON file to save the report to (default: in the working dir)")
+    parser.add_argument("--baseline", default=None, help="Report of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Slowdown (or memory growth) ratio above which a stage counts as a regression")
+    args = parser.parse_args()
+
+    parameters = {"listens": args.listens, "users": args.users, "recordings": args.recordings,
+                  "artists": args.artists, "dumps": args.dumps, "compress": args.compress, "seed": args.seed}
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench_pipeline_data_")
+    dataset = load_dataset(data_dir)
+    if dataset is None or dataset["parameters"] != parameters:
+        print(f"Generating {args.listens} synthetic listens in {data_dir} ...")
+        dataset = generate_dataset(data_dir, args.listens, args.users, args.recordings, args.artists,
+                                   args.dumps, args.compress, args.seed)
+    else:
+        print(f"Reusing the synthetic dataset in {data_dir}")
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+    working_dir = tempfile.mkdtemp(prefix="bench_pipeline_run_", dir=args.work_dir)
+    listens = dataset["listen_dumps"][0] if len(dataset["listen_dumps"]) == 1 else dataset["listens_dir"]
+    stages = build_stages(listens, dataset["mapping_file"], dataset["redirect_file"], dataset["metadata_file"],
+                          dataset["artist_file"], working_dir, args.format, args.fused)
+    print(f"Running the pipeline in {working_dir} ...")
+    summary = run_pipeline(stages, os.path.join(working_dir, ".pipeline"), args.jobs)
+    print_report(summary)
+
+    failed = [name for name, stage in summary["stages"].items() if stage["status"] != "ran"]
+    counts_file = next(stage.outputs[0] for stage in stages if stage.name == "aggregate_counts" or
+                       (args.fused and stage.name == "canonicalize"))
+    check = check_counts(counts_file, dataset["expected"]) if not failed else {"ok": False}
+    if not failed:
+        print(f"\nListen counts: {check['counted_listens']} (expected {check['expected_listens']}): "
+              f"{'OK' if check['ok'] else 'MISMATCH'}")
+
+    report = dict(summary, dataset=parameters, format=args.format, fused=args.fused, jobs=args.jobs, check=check)
+    report_path = args.report or os.path.join(working_dir, "bench_pipeline.json")
+    with open(report_path, "w", encoding="utf-8") as fp:
+        json.dump(report, fp, indent=2)
+    print(f"Report saved to {report_path}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fp:
+            regressions = compare_reports(report, json.load(fp), args.tolerance)
+        for name, metric, ratio in regressions:
+            print(f"REGRESSION: {name} {metric} {ratio:.2f}x the baseline")
+    if failed or not check["ok"] or regressions:
+        sys.exit(1)
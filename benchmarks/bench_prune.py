@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+bench_prune.py
+--------------
+Measures what min-support pruning (see src/preprocessing/prune_counts.py) saves when
+training the CF model: for each --levels value L, the play matrix of a userid-artist-counts
+table is pruned to the artists with at least L users and the users with at least L artists
+(and --min-user-plays listens), then BM25-weighted and trained with ALS (listenbrainz_model's
+parameters, --iterations iterations). Level 1 is the unpruned matrix.
+
+For each level it reports the matrix shape and non-zero entries, the pruning passes and time,
+and the training time, with the saving relative to level 1.
+
+Usage:
+    python benchmarks/bench_prune.py <userid_artist_counts> [--levels 1,2,5,10] [--min-user-plays N]
+                                     [--iterations N] [--factors N] [--threads N] [--report FILE]
+
+Example:
+    python benchmarks/bench_prune.py working/userid-artist-counts.csv --levels 1,2,5,10,20 --report prune.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from threadpoolctl import threadpool_limits
+
+# Ensure the project root (and the notebooks directory, for listenbrainz_model) is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+for path in (project_root, os.path.join(project_root, "notebooks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import listenbrainz_model as lb
+from src.utils.matrix_store import PlayMatrix
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ALS training on min-support pruned matrices.")
+    parser.add_argument("counts", help="userid-artist-counts table (.csv, .parquet, .npcols or .months)")
+    parser.add_argument("--levels", default="1,2,5,10", help="Comma-separated minimum users per artist / artists per user")
+    parser.add_argument("--min-user-plays", type=int, default=0, help="Minimum listens per user at every level above 1")
+    parser.add_argument("--iterations", type=int, default=15, help="ALS iterations")
+    parser.add_argument("--factors", type=int, default=lb.ALS_PARAMS["factors"], help="ALS factors")
+    parser.add_argument("--threads", type=int, default=0, help="Training threads (0: all cores)")
+    parser.add_argument("--report", default=None, help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    matrix, _ = PlayMatrix.open(lb.matrix_cache_prefix(args.counts), args.counts)
+    print(f"{'level':>5} {'users':>10} {'artists':>10} {'nnz':>12} {'passes':>6} {'prune s':>8} "
+          f"{'train s':>8} {'saved':>7}")
+    results = []
+    for level in [int(value) for value in args.levels.split(",") if value.strip()]:
+        started = time.perf_counter()
+        pruned, passes = matrix.prune(level, level, args.min_user_plays if level > 1 else 0)
+        prune_seconds = time.perf_counter() - started
+        weighted = lb.weight_plays(pruned.plays)
+        with threadpool_limits(args.threads or None):
+            started = time.perf_counter()
+            lb.train_als(weighted, show_progress=False, iterations=args.iterations, factors=args.factors,
+                         num_threads=args.threads)
+            train_seconds = time.perf_counter() - started
+        result = {"level": level, "users": int(pruned.plays.shape[0]), "artists": int(pruned.plays.shape[1]),
+                  "nnz": int(pruned.plays.nnz), "passes": passes, "prune_seconds": prune_seconds,
+                  "train_seconds": train_seconds}
+        results.append(result)
+        saved = 1 - train_seconds / results[0]["train_seconds"]
+        print(f"{level:>5} {result['users']:>10,} {result['artists']:>10,} {result['nnz']:>12,} {passes:>6} "
+              f"{prune_seconds:>8.2f} {train_seconds:>8.2f} {saved:>7.1%}")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as fp:
+            json.dump({"counts": os.path.abspath(args.counts), "iterations": args.iterations,
+                       "factors": args.factors, "min_user_plays": args.min_user_plays, "results": results},
+                      fp, indent=2)
+        print(f"Report saved to {args.report}")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+bench_similarity.py
+-------------------
+Compares the throughput of similar-artist queries answered one at a time by implicit's
+model.similar_items (as get_similar_artists in the Modeling notebook does) with the batched
+paths of src/utils/similarity.py:
+
+    per_item         model.similar_items(row, N) for each query
+    batched          top_k_similar over all queries at once (blocked matrix products)
+    precompute       SimilarityTable.build for every artist (time per artist)
+    table            SimilarityService.similar_rows, served from the precomputed table
+    table_by_mbid    SimilarityService.similar_artists, i.e. MBID lookup + table + MBIDs/names
+
+It uses a model saved by listenbrainz_model.save_model (--model), or random factors for
+--artists artists. It also reports the share of the per-item neighbours found by the table
+(1.0 up to ties), and saves the results as JSON with --report.
+
+Usage:
+    python benchmarks/bench_similarity.py [--model DIR] [--artists N] [--factors N] [--queries N]
+                                          [--n N] [--k N] [--seed N] [--report FILE]
+
+Example:
+    python benchmarks/bench_similarity.py --artists 200000 --queries 2000 --report similarity.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from implicit.als import AlternatingLeastSquares
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.utils.matrix_store import ArtistIndex
+from src.utils.model_store import SavedModel
+from src.utils.similarity import SimilarityService, normalized_factors, top_k_similar
+
+def random_model(num_artists, factors, seed):
+    """A SavedModel with random factors and artist MBIDs (no users)."""
+    rng = np.random.default_rng(seed)
+    keys = np.unique(np.frombuffer(rng.bytes(16 * num_artists), dtype="S16"))
+    item_factors = rng.standard_normal((len(keys), factors), dtype=np.float32)
+    return SavedModel.from_factors(np.empty((0, factors), dtype=np.float32), item_factors,
+                                   np.empty(0, dtype=np.int64), ArtistIndex.from_keys(keys))
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - started
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched vs per-item similar-artist queries.")
+    parser.add_argument("--model", default=None, help="Directory of a model saved by save_model")
+    parser.add_argument("--artists", type=int, default=100_000, help="Artists of the random model")
+    parser.add_argument("--factors", type=int, default=64, help="Factors of the random model")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of query artists")
+    parser.add_argument("--n", type=int, default=20, help="Similar artists per query")
+    parser.add_argument("--k", type=int, default=50, help="Neighbours per artist in the precomputed table")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--report", default=None, help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    if args.model:
+        model_dir = args.model
+        saved = SavedModel.load(model_dir)
+    else:
+        model_dir = tempfile.mkdtemp(prefix="bench_similarity_")
+        saved = random_model(args.artists, args.factors, args.seed)
+        saved.save(model_dir)
+        saved = SavedModel.load(model_dir)
+    num_artists, factors = saved.item_factors.shape
+    print(f"{num_artists:,} artists x {factors} factors, {args.queries:,} queries of {args.n} similar artists")
+
+    model = AlternatingLeastSquares(factors=factors, use_gpu=False)
+    model.item_factors = np.asarray(saved.item_factors)
+    rows = np.random.default_rng(args.seed).integers(0, num_artists, args.queries)
+    mbids = saved.artist_index.mbids(rows)
+    results = {"artists": num_artists, "factors": factors, "queries": args.queries, "n": args.n, "k": args.k}
+
+    per_item, seconds = timed(lambda: [model.similar_items(int(row), N=args.n)[0] for row in rows])
+    results["per_item_qps"] = args.queries / seconds
+    normalized = normalized_factors(saved.item_factors)
+    _, seconds = timed(lambda: top_k_similar(normalized, args.n, rows=rows))
+    results["batched_qps"] = args.queries / seconds
+
+    # Precompute the table from scratch (it is saved in the model directory).
+    for suffix in (".neighbours.npy", ".scores.npy", ".source.json"):
+        path = os.path.join(model_dir, "similar_items" + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+    service, seconds = timed(lambda: SimilarityService.open(model_dir, saved, args.k))
+    results["precompute_seconds"] = seconds
+    results["precompute_artists_per_second"] = num_artists / seconds
+    served, seconds = timed(lambda: [service.similar_rows(row, args.n)[0] for row in rows])
+    results["table_qps"] = args.queries / seconds
+    _, seconds = timed(lambda: [service.similar_artists(mbid, args.n) for mbid in mbids])
+    results["table_by_mbid_qps"] = args.queries / seconds
+    results["table_agreement"] = float(np.mean([len(np.intersect1d(a, b)) / len(a)
+                                                for a, b in zip(per_item, served)]))
+
+    print(f"\n{'path':<16} {'queries/s':>14}")
+    for path in ("per_item", "batched", "table", "table_by_mbid"):
+        print(f"{path:<16} {results[path + '_qps']:>14,.0f}")
+    print(f"Precomputed {args.k} neighbours of every artist in {results['precompute_seconds']:.1f}s "
+          f"({results['precompute_artists_per_second']:,.0f} artists/s)")
+    print(f"Table vs per-item neighbours: {results['table_agreement']:.4f} agreement")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+        print(f"Report saved to {args.report}")
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+sweep_als.py
+------------
+Hyperparameter sweep of the CF model (BM25 weighting + implicit ALS, see
+notebooks/listenbrainz_model.py) on a held-out split of a userid-artist-counts table.
+
+Every combination of the --k1 / --b / --factors / --regularization / --alpha / --iterations
+values is trained on the training split and scored on the held-out listens with implicit's
+ranking metrics at --top-k (precision, MAP, nDCG, AUC). Each configuration also records its
+training and evaluation time, CPU time and peak RSS (see src/utils/instrumentation.py).
+
+    - The play matrix of the counts, the split and each distinct BM25-weighted training
+      matrix are computed once and saved as .npy arrays in --cache-dir (by default the
+      directory of the matrix cache of the counts); they are reused by later sweeps over the
+      same counts, split and weighting.
+    - Configurations train in parallel: --jobs worker processes, each fit limited to
+      --threads threads (implicit's and BLAS'), so the workers do not oversubscribe the
+      cores. Every configuration runs in a fresh process, so its peak RSS is its own.
+      The workers memory-map the cached matrices instead of each receiving a copy.
+
+The report (--report, JSON) lists the configurations best first by nDCG.
+
+Usage:
+    python benchmarks/sweep_als.py <userid_artist_counts> [--k1 100,...] [--b 0.8,...]
+                                   [--factors 64,...] [--regularization 0.05,...]
+                                   [--alpha 2.0,...] [--iterations 15,...] [--test-fraction 0.2]
+                                   [--top-k 10] [--jobs N] [--threads N] [--seed N]
+                                   [--cache-dir DIR] [--report FILE]
+
+Example:
+    python benchmarks/sweep_als.py working/userid-artist-counts.csv --factors 32,64,128 \\
+        --regularization 0.01,0.05 --k1 100,200 --jobs 4 --threads 2 --report sweep.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import as_completed
+
+import numpy as np
+from implicit.evaluation import ranking_metrics_at_k
+from threadpoolctl import threadpool_limits
+
+# Ensure the project root (and the notebooks directory, for listenbrainz_model) is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+for path in (project_root, os.path.join(project_root, "notebooks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import listenbrainz_model as lb
+from src.utils.instrumentation import FreshProcessPool, StageMetrics
+from src.utils.lookup_store import invalidate, is_current, mark_built, read_manifest
+from src.utils.matrix_store import PlayMatrix
+
+ALS_GRID = ("factors", "regularization", "alpha", "iterations")
+
+def holdout_split(plays, test_fraction, seed):
+    """
+    Splits the (user, artist) entries of a play matrix at random into a training and a test
+    matrix, test_fraction of them in the test matrix. Every user keeps at least one training
+    entry, so every user of the test matrix has factors.
+    """
+    plays = plays.tocsr()
+    rng = np.random.default_rng(seed)
+    test = rng.random(plays.nnz) < test_fraction
+    # Keep the first entry of every user whose entries all went to the test set in training.
+    row_starts = plays.indptr[:-1][np.diff(plays.indptr) > 0]
+    tested = np.add.reduceat(test, row_starts) == np.diff(plays.indptr)[np.diff(plays.indptr) > 0]
+    test[row_starts[tested]] = False
+    train, held_out = plays.copy(), plays.copy()
+    train.data = np.where(test, 0, plays.data).astype(np.float32)
+    held_out.data = np.where(test, plays.data, 0).astype(np.float32)
+    train.eliminate_zeros()
+    held_out.eliminate_zeros()
+    return train, held_out
+
+def cached_matrix(prefix, counts_path, info, build):
+    """
+    Loads the PlayMatrix saved under prefix (copy-on-write memory map, as implicit needs
+    writable buffers) if it was built from counts_path with the same info, else builds it with
+    build() and saves it.
+    """
+    if is_current(prefix, counts_path) and read_manifest(prefix).get("info") == info:
+        return PlayMatrix.load(prefix, mmap_mode="c")
+    invalidate(prefix)
+    matrix = build()
+    matrix.save(prefix)
+    mark_built(prefix, counts_path, info=info)
+    return matrix
+
+def train_and_score(config, weighted_prefix, train_prefix, test_prefix, top_k, threads):
+    """
+    Worker: trains one configuration and scores it on the held-out split.
+
+    Returns:
+        dict: The configuration, its ranking metrics and its time / memory measurements.
+    """
+    weighted = PlayMatrix.load(weighted_prefix, mmap_mode="c").plays
+    train = PlayMatrix.load(train_prefix, mmap_mode="c").plays
+    test = PlayMatrix.load(test_prefix, mmap_mode="c").plays
+    with threadpool_limits(threads):
+        metrics = StageMetrics("sweep")
+        started = time.perf_counter()
+        model = lb.train_als(weighted, show_progress=False, num_threads=threads,
+                             **{name: config[name] for name in ALS_GRID})
+        train_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        scores = ranking_metrics_at_k(model, train, test, K=top_k, show_progress=False, num_threads=threads)
+        eval_seconds = time.perf_counter() - started
+        results = metrics.stop()
+    return dict(config, **{name: float(value) for name, value in scores.items()}, train_seconds=train_seconds,
+                eval_seconds=eval_seconds, cpu_seconds=results["cpu_seconds"], peak_rss_mb=results["peak_rss_mb"])
+
+def parse_values(text, cast):
+    return [cast(value) for value in text.split(",") if value.strip()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep BM25 / ALS hyperparameters on a held-out split.")
+    parser.add_argument("counts", help="userid-artist-counts table (.csv, .parquet or .npcols)")
+    parser.add_argument("--k1", default=str(lb.BM25_PARAMS["K1"]), help="Comma-separated BM25 K1 values")
+    parser.add_argument("--b", default=str(lb.BM25_PARAMS["B"]), help="Comma-separated BM25 B values")
+    parser.add_argument("--factors", default=str(lb.ALS_PARAMS["factors"]), help="Comma-separated factor counts")
+    parser.add_argument("--regularization", default=str(lb.ALS_PARAMS["regularization"]),
+                        help="Comma-separated regularization values")
+    parser.add_argument("--alpha", default=str(lb.ALS_PARAMS["alpha"]), help="Comma-separated alpha values")
+    parser.add_argument("--iterations", default="15", help="Comma-separated ALS iteration counts")
+    parser.add_argument("--test-fraction", type=float, default=0.2, help="Share of the entries held out")
+    parser.add_argument("--top-k", type=int, default=10, help="K of the ranking metrics")
+    parser.add_argument("--threads", type=int, default=1, help="Threads per fit")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Configurations trained at once (default: CPU count / threads)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the split")
+    parser.add_argument("--cache-dir", default=None, help="Directory of the cached play, split and weighted matrices")
+    parser.add_argument("--report", default=None, help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    cache_dir = args.cache_dir or os.path.dirname(lb.matrix_cache_prefix(args.counts))
+    split_info = {"test_fraction": args.test_fraction, "seed": args.seed}
+    split_prefix = os.path.join(cache_dir, os.path.basename(args.counts.rstrip("/\\")) + f".split{args.seed}")
+    started = time.perf_counter()
+    matrix_prefix = os.path.join(cache_dir, os.path.basename(lb.matrix_cache_prefix(args.counts)))
+    matrix, _ = PlayMatrix.open(matrix_prefix, args.counts, mmap_mode="r")
+    splits = {}
+    def split(part):
+        if not splits:
+            splits["train"], splits["test"] = holdout_split(matrix.plays, args.test_fraction, args.seed)
+        return PlayMatrix(splits[part], matrix.users, matrix.artists)
+    train = cached_matrix(split_prefix + ".train", args.counts, split_info, lambda: split("train"))
+    cached_matrix(split_prefix + ".test", args.counts, split_info, lambda: split("test"))
+    print(f"Split {train.plays.shape[0]:,} users x {train.plays.shape[1]:,} artists "
+          f"({time.perf_counter() - started:.1f}s)")
+
+    # One weighted training matrix per distinct (K1, B).
+    weightings = list(itertools.product(parse_values(args.k1, float), parse_values(args.b, float)))
+    weighted_prefixes = {}
+    for k1, b in weightings:
+        prefix = f"{split_prefix}.bm25_{k1:g}_{b:g}"
+        started = time.perf_counter()
+        cached_matrix(prefix, args.counts, dict(split_info, K1=k1, B=b),
+                      lambda: PlayMatrix(lb.weight_plays(train.plays, K1=k1, B=b), train.users, train.artists))
+        weighted_prefixes[k1, b] = prefix
+        print(f"BM25 K1={k1:g} B={b:g} ready ({time.perf_counter() - started:.1f}s)")
+
+    grid = [parse_values(args.factors, int), parse_values(args.regularization, float),
+            parse_values(args.alpha, float), parse_values(args.iterations, int)]
+    configs = [dict(K1=k1, B=b, **dict(zip(ALS_GRID, values)))
+               for (k1, b), values in itertools.product(weightings, itertools.product(*grid))]
+    jobs = args.jobs or max(1, (os.cpu_count() or 1) // args.threads)
+    print(f"Training {len(configs)} configurations, {jobs} at a time with {args.threads} thread(s) each\n")
+
+    results = []
+    header = ("K1", "B", "factors", "regularization", "alpha", "iterations")
+    print(" ".join(f"{name:>14}" for name in header) + f" {'ndcg':>8} {'map':>8} {'precision':>9} "
+          f"{'train s':>8} {'peak MB':>8}")
+    started = time.perf_counter()
+    # Every configuration runs in a fresh process (own peak RSS).
+    with FreshProcessPool(jobs) as pool:
+        futures = [pool.submit(train_and_score, config, weighted_prefixes[config["K1"], config["B"]],
+                               split_prefix + ".train", split_prefix + ".test", args.top_k, args.threads)
+                   for config in configs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(" ".join(f"{result[name]:>14g}" for name in header) + f" {result['ndcg']:>8.4f} "
+                  f"{result['map']:>8.4f} {result['precision']:>9.4f} {result['train_seconds']:>8.1f} "
+                  f"{result['peak_rss_mb']:>8.0f}")
+    wall_seconds = time.perf_counter() - started
+
+    results.sort(key=lambda result: -result["ndcg"])
+    best = results[0]
+    print(f"\nSwept {len(results)} configurations in {wall_seconds:.1f}s. Best nDCG@{args.top_k}: "
+          f"{best['ndcg']:.4f} with " + ", ".join(f"{name}={best[name]:g}" for name in header))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as fp:
+            json.dump({"counts": os.path.abspath(args.counts), "top_k": args.top_k, "jobs": jobs,
+                       "threads": args.threads, "wall_seconds": wall_seconds, "split": split_info,
+                       "results": results}, fp, indent=2)
+        print(f"Report saved to {args.report}")
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+synthetic_data.py
+-----------------
+Generates a synthetic, ListenBrainz-shaped dataset at a configurable scale, to run and benchmark
+the whole preprocessing pipeline (see bench_pipeline.py) without the real dumps:
+
+    listens/<i>.listens[.zst]            listen dumps (JSON Lines), split by time over --dumps files
+    listenbrainz_msid_mapping.csv        MSID -> recording MBID mapping with match types, including
+                                         rows for MSIDs that are never listened to
+    canonical_recording_redirect.csv     recording MBID -> canonical recording MBID
+    canonical_musicbrainz_data.csv       canonical recordings with their artist credits
+    musicbrainz_artist.csv               artist MBID -> name
+    synthetic.json                       parameters, paths and expected pipeline totals
+
+Recording and user popularity are Zipf-like, as in the real listens. A few listens are
+malformed or lack an MSID, some MSIDs have no (or a low quality) match, some recordings are
+redirected to a canonical recording and some canonical recordings have no metadata, so every
+branch of the pipeline is exercised. synthetic.json records how many listens the pipeline
+should turn into user-artist pairs, so a run can be checked as well as timed.
+
+The same parameters and seed always give the same files.
+
+Usage:
+    python benchmarks/synthetic_data.py <output_dir> [--listens N] [--users N] [--recordings N]
+                                        [--artists N] [--dumps N] [--compress] [--seed N]
+
+Example:
+    python benchmarks/synthetic_data.py /tmp/synthetic --listens 10000000 --dumps 4 --compress
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import uuid
+
+import numpy as np
+import zstandard
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.utils.config import CSV_CHUNK_ROWS
+
+# Share of MSIDs per match type in the mapping dump (no_match rows have no recording MBID).
+MATCH_TYPES = {"exact_match": 0.6, "high_quality": 0.15, "low_quality": 0.1, "no_match": 0.15}
+# Match types kept by filter_mapping.py
+ACCEPTED_MATCH_TYPES = ("exact_match", "high_quality")
+# MSIDs per recording, and mapping rows of never listened MSIDs per listened one
+MSIDS_PER_RECORDING = 1.5
+UNUSED_MAPPING_RATIO = 2
+# Share of recordings redirected to a canonical one, and of canonical recordings without metadata
+REDIRECT_RATIO = 0.1
+MISSING_METADATA_RATIO = 0.02
+# One listen in BAD_LINE_EVERY is malformed JSON, and one (other) has no recording_msid
+BAD_LINE_EVERY = 100_000
+FIRST_LISTENED_AT = 1704067200
+
+def random_uuids(rng, count):
+    """Returns count random UUID strings."""
+    values = rng.integers(0, 2**63, size=(count, 2), dtype=np.int64).astype(np.uint64)
+    return [str(uuid.UUID(int=(int(high) << 64) | int(low))) for high, low in values.tolist()]
+
+def zipf_indices(rng, size, count, exponent=1.1):
+    """
+    Draws size indices in [0, count) with Zipf-like popularity (index 0 most popular): index i
+    has a probability proportional to 1 / (i + 1)^exponent, normalized over the count indices.
+    """
+    weights = 1.0 / np.arange(1, count + 1, dtype=np.float64) ** exponent
+    return rng.choice(count, size, p=weights / weights.sum())
+
+def write_csv(path, header, rows):
+    with open(path, "w", newline="", encoding="utf-8") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def write_listens(path, rng, msids, user_ids, msid_indices, first_index, compress):
+    """
+    Writes listens as a JSON Lines dump, one block of CSV_CHUNK_ROWS lines at a time.
+    msid_indices gives the MSID of each listen; first_index is the position of the first one
+    in the whole listen history (for listened_at and the malformed lines).
+
+    Returns:
+        int: Number of listens written with an MSID (malformed lines and listens without an
+             MSID are not).
+    """
+    valid = 0
+    fp = open(path, "wb")
+    out = zstandard.ZstdCompressor().stream_writer(fp) if compress else fp
+    with out:
+        for start in range(0, len(msid_indices), CSV_CHUNK_ROWS):
+            block = msid_indices[start:start + CSV_CHUNK_ROWS]
+            users = user_ids[start:start + CSV_CHUNK_ROWS].tolist()
+            durations = rng.integers(60_000, 400_000, len(block)).tolist()
+            lines = []
+            for offset, (msid_index, user_id, duration) in enumerate(zip(block.tolist(), users, durations)):
+                position = first_index + start + offset
+                msid = msids[msid_index]
+                if position % BAD_LINE_EVERY == BAD_LINE_EVERY - 1:
+                    lines.append('{"listened_at": ' + str(position) + ', "user_id": \n')
+                    continue
+                record = {
+                    "listened_at": FIRST_LISTENED_AT + position * 7,
+                    "user_id": user_id,
+                    "user_name": f"user{user_id}",
+                    "recording_msid": msid,
+                    "track_metadata": {
+                        "artist_name": f"Artist, \"{msid_index % 997}\"",
+                        "track_name": f"Track {msid_index}",
+                        "release_name": "Release",
+                        "additional_info": {"recording_msid": msid, "duration_ms": duration,
+                                            "media_player": "BrainzPlayer"},
+                    },
+                }
+                if position % BAD_LINE_EVERY == BAD_LINE_EVERY // 2:
+                    del record["recording_msid"]
+                else:
+                    valid += 1
+                lines.append(json.dumps(record) + "\n")
+            out.write("".join(lines).encode("utf-8"))
+    return valid
+
+def generate_dataset(output_dir, num_listens=1_000_000, num_users=10_000, num_recordings=100_000,
+                     num_artists=20_000, num_dumps=1, compress=False, seed=0):
+    """
+    Writes the synthetic dataset to output_dir (see the module docstring).
+
+    Returns:
+        dict: The contents of synthetic.json: parameters, file paths and the expected number
+              of listens converted to user-artist pairs by the pipeline.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(output_dir, "listens"), exist_ok=True)
+
+    # Artists and recordings.
+    artists = random_uuids(rng, num_artists)
+    recordings = random_uuids(rng, num_recordings)
+    redirected = rng.random(num_recordings) < REDIRECT_RATIO
+    canonical = np.flatnonzero(~redirected)
+    redirect_to = np.arange(num_recordings)
+    redirect_to[redirected] = rng.choice(canonical, int(redirected.sum()))
+    has_metadata = np.zeros(num_recordings, dtype=bool)
+    has_metadata[canonical] = rng.random(len(canonical)) >= MISSING_METADATA_RATIO
+
+    write_csv(os.path.join(output_dir, "musicbrainz_artist.csv"), ["artist_mbid", "name"],
+              ([mbid, f"Artist {i}, \"the {i % 7}\""] for i, mbid in enumerate(artists)))
+    write_csv(os.path.join(output_dir, "canonical_recording_redirect.csv"),
+              ["recording_mbid", "canonical_recording_mbid", "canonical_release_mbid"],
+              ([recordings[i], recordings[redirect_to[i]], ""] for i in np.flatnonzero(redirected)))
+    credit_sizes = rng.integers(1, 4, num_recordings)
+    credits = zipf_indices(rng, int(credit_sizes.sum()), num_artists)
+    credit_starts = np.concatenate([[0], np.cumsum(credit_sizes)])
+    write_csv(os.path.join(output_dir, "canonical_musicbrainz_data.csv"),
+              ["id", "artist_credit_id", "artist_mbids", "artist_credit_name", "recording_name",
+               "recording_mbid", "release_name", "release_mbid", "score"],
+              ([i + 1, i + 1, ",".join(artists[a] for a in credits[credit_starts[i]:credit_starts[i + 1]]),
+                " & ".join(f"Artist {a}" for a in credits[credit_starts[i]:credit_starts[i + 1]]),
+                f"Track {i}", recordings[i], "Release", "", i + 1] for i in np.flatnonzero(has_metadata)))
+
+    # MSIDs, the mapping dump (listened and never listened MSIDs, shuffled).
+    num_msids = max(int(num_recordings * MSIDS_PER_RECORDING), 1)
+    num_unused = num_msids * UNUSED_MAPPING_RATIO
+    msids = random_uuids(rng, num_msids + num_unused)
+    match_names = list(MATCH_TYPES)
+    match_types = rng.choice(len(match_names), num_msids + num_unused, p=list(MATCH_TYPES.values()))
+    msid_recordings = rng.integers(0, num_recordings, num_msids + num_unused)
+    no_match = match_names.index("no_match")
+    write_csv(os.path.join(output_dir, "listenbrainz_msid_mapping.csv"),
+              ["recording_msid", "recording_mbid", "match_type"],
+              ([msids[i], "" if match_types[i] == no_match else recordings[msid_recordings[i]],
+                match_names[match_types[i]]] for i in rng.permutation(num_msids + num_unused)))
+
+    # An MSID yields an artist if its match is accepted and its canonical recording has metadata.
+    accepted = np.isin(match_types[:num_msids], [match_names.index(name) for name in ACCEPTED_MATCH_TYPES])
+    resolves = accepted & has_metadata[redirect_to[msid_recordings[:num_msids]]]
+
+    # Listens, in time order, split over the dumps.
+    listen_msids = rng.permutation(num_msids)[zipf_indices(rng, num_listens, num_msids)]
+    user_ids = rng.permutation(num_users)[zipf_indices(rng, num_listens, num_users, 1.3)] + 1
+    dump_paths = []
+    valid_listens = 0
+    bounds = np.linspace(0, num_listens, num_dumps + 1).astype(np.int64)
+    suffix = ".listens.zst" if compress else ".listens"
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        path = os.path.join(output_dir, "listens", f"{i}{suffix}")
+        valid_listens += write_listens(path, rng, msids, user_ids[start:end], listen_msids[start:end],
+                                       int(start), compress)
+        dump_paths.append(path)
+    positions = np.arange(num_listens)
+    written = ((positions % BAD_LINE_EVERY != BAD_LINE_EVERY - 1)
+               & (positions % BAD_LINE_EVERY != BAD_LINE_EVERY // 2))
+    converted_listens = int((resolves[listen_msids] & written).sum())
+
+    manifest = {
+        "parameters": {"listens": num_listens, "users": num_users, "recordings": num_recordings,
+                       "artists": num_artists, "dumps": num_dumps, "compress": compress, "seed": seed},
+        "listens_dir": os.path.join(output_dir, "listens"),
+        "listen_dumps": dump_paths,
+        "mapping_file": os.path.join(output_dir, "listenbrainz_msid_mapping.csv"),
+        "redirect_file": os.path.join(output_dir, "canonical_recording_redirect.csv"),
+        "metadata_file": os.path.join(output_dir, "canonical_musicbrainz_data.csv"),
+        "artist_file": os.path.join(output_dir, "musicbrainz_artist.csv"),
+        "expected": {"valid_listens": valid_listens, "converted_listens": converted_listens},
+    }
+    with open(os.path.join(output_dir, "synthetic.json"), "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2)
+    return manifest
+
+def load_dataset(output_dir):
+    """Returns the synthetic.json manifest of a generated dataset, or None."""
+    try:
+        with open(os.path.join(output_dir, "synthetic.json"), encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic ListenBrainz-shaped dataset.")
+    parser.add_argument("output_dir", help="Directory to write the dataset to")
+    parser.add_argument("--listens", type=int, default=1_000_000, help="Number of listens")
+    parser.add_argument("--users", type=int, default=10_000, help="Number of distinct users")
+    parser.add_argument("--recordings", type=int, default=100_000, help="Number of recordings")
+    parser.add_argument("--artists", type=int, default=20_000, help="Number of artists")
+    parser.add_argument("--dumps", type=int, default=1, help="Number of listen dump files")
+    parser.add_argument("--compress", action="store_true", help="Write the listen dumps zstd-compressed")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    manifest = generate_dataset(args.output_dir, args.listens, args.users, args.recordings, args.artists,
+                                args.dumps, args.compress, args.seed)
+    print(f"Wrote {args.listens} listens in {args.dumps} dumps to {manifest['listens_dir']}; "
+          f"{manifest['expected']['converted_listens']} should resolve to an artist")
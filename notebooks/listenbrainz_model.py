@@ -1,55 +1,266 @@
-import csv
+import json
+import os
+import sys
 
 import pandas
-from scipy.sparse import coo_matrix
 import numpy as np
 from implicit.nearest_neighbours import bm25_weight
 from implicit.als import AlternatingLeastSquares
 
+# Add the project root so the src.utils helpers are importable from the notebooks directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
 
-def load_data_matrix(user_artist_counts_path):
+from src.preprocessing.artist_mapping import build_artist_table
+from src.utils.ann import open_ann_index
+from src.utils.batch_export import EXPORT_COLUMNS, SHARD_ROWS, export_model
+from src.utils.columnar import time_bound
+from src.utils.config import DICTIONARY_DIRNAME
+from src.utils.interning import UuidStringTable, uuid_keys
+from src.utils.lookup_store import invalidate, is_current, mark_built
+from src.utils.matrix_store import ArtistIndex, PlayMatrix
+from src.utils.model_store import SavedModel
+from src.utils.similarity import DEFAULT_TOP_K, SimilarityService
+
+# BM25 weighting and ALS parameters of build_model
+BM25_PARAMS = {"K1": 100, "B": 0.8}
+ALS_PARAMS = {"factors": 64, "regularization": 0.05, "alpha": 2.0}
+# Exports written by export_batch
+EXPORT_KINDS = tuple(EXPORT_COLUMNS)
+# ALS iterations of a warm-started retrain (a full training runs implicit's default of 15)
+WARM_START_ITERATIONS = 5
+
+
+def load_data_matrix(user_artist_counts_path, cache=True, since=None, until=None):
     """Load a CSV file containing user,artist_id,count lines into a matrix
-    that can be used to build a CF model"""
-    # from https://github.com/benfred/implicit/blob/871e0c7229b012108131b6211cd617e23a3b24bf/implicit/datasets/lastfm.py#L58
-    data = pandas.read_table(
-        user_artist_counts_path, sep=',', header=1, usecols=[0, 1, 2], names=["user", "artist", "plays"], dtype={'user': str, 'artist': str, 'plays': np.int32}, na_filter=False
-    )
-    data["user"] = data["user"].astype("category")
-    data["artist"] = data["artist"].astype("category")
-    plays = coo_matrix(
-        (
-            data["plays"].astype(np.float32),
-            (data["user"].cat.codes.copy(), data["artist"].cat.codes.copy()),
-        )
-    ).tocsr()
-    return data["artist"].cat.categories, data["user"].cat.categories, plays
-
-
-def build_model(plays):
+    that can be used to build a CF model. Parquet and .npcols tables written by
+    the preprocessing scripts are read directly, without parsing text.
+
+    The counts are streamed into a CSR matrix (see src/utils/matrix_store.py).
+    With cache=True the matrix is saved in the "dictionaries" directory next to
+    the counts, and later calls load it from there, without parsing the counts,
+    as long as the counts file is unchanged.
+
+    A month-partitioned counts store (userid-artist-counts.months, see
+    aggregate_counts.py) can be loaded for a date range [since, until): only
+    the partitions of the months it overlaps are read, and their counts summed,
+    e.g. since="2024-01", until="2024-04" for the first quarter of 2024.
+
+    Returns the artist MBIDs of the columns, the user IDs (as strings) of the
+    rows and the float32 users x artists CSR matrix of listen counts."""
+    if cache:
+        matrix, _ = PlayMatrix.open(matrix_cache_prefix(user_artist_counts_path, since, until),
+                                    user_artist_counts_path, since=since, until=until)
+    else:
+        matrix = PlayMatrix.build(user_artist_counts_path, since=since, until=until)
+    return pandas.Index(matrix.artist_ids()), pandas.Index(matrix.user_ids()), matrix.plays
+
+
+def prune_data_matrix(matrix_artists, matrix_users, plays, min_artist_users=2, min_user_artists=2,
+                      min_user_plays=0, min_artist_plays=0):
+    """Drop the long tail of a matrix returned by load_data_matrix before
+    build_model: the artists with fewer than min_artist_users users (or
+    min_artist_plays listens) and the users with fewer than min_user_artists
+    artists (or min_user_plays listens), repeated until stable (see
+    PlayMatrix.prune in src/utils/matrix_store.py).
+
+    Returns the artists, users and play matrix of the survivors, re-indexed, in
+    the form load_data_matrix returns them."""
+    matrix = PlayMatrix(plays, np.asarray(matrix_users, dtype=str).astype(np.int64),
+                        uuid_keys(list(matrix_artists))[0])
+    pruned, _ = matrix.prune(min_artist_users, min_user_artists, min_user_plays, min_artist_plays)
+    return pandas.Index(pruned.artist_ids()), pandas.Index(pruned.user_ids()), pruned.plays
+
+
+def matrix_cache_prefix(user_artist_counts_path, since=None, until=None):
+    """Path prefix of the cached play matrix of a counts table (and date range)"""
+    path = user_artist_counts_path.rstrip("/\\")
+    window = ""
+    if since is not None or until is not None:
+        window = "." + "_".join(str(time_bound(bound)) if bound is not None else "" for bound in (since, until))
+    return os.path.join(os.path.dirname(path), DICTIONARY_DIRNAME, os.path.basename(path) + window + ".matrix")
+
+
+def weight_plays(plays, K1=BM25_PARAMS["K1"], B=BM25_PARAMS["B"]):
+    """BM25-weight a users x artists play matrix for ALS training (float32 CSR)."""
     # weight the matrix, both to reduce impact of users that have played the same artist thousands of times
     # and to reduce the weight given to popular items
-    artist_user_plays = bm25_weight(plays, K1=100, B=0.8)
-    model = AlternatingLeastSquares(factors=64, regularization=0.05, alpha=2.0)
-    model.fit(artist_user_plays.tocsr())
+    return bm25_weight(plays, K1=K1, B=B).tocsr().astype(np.float32)
+
+
+def train_als(weighted_plays, warm_start=None, show_progress=True, **params):
+    """Train an ALS model on a weighted play matrix (see weight_plays), with
+    ALS_PARAMS overridden by params (e.g. factors, iterations, num_threads).
+
+    warm_start is an optional (user_factors, item_factors) pair to start from
+    instead of random factors (see retrain_model); the model is then trained on
+    the CPU."""
+    params = dict(ALS_PARAMS, **params)
+    if warm_start is not None:
+        model = AlternatingLeastSquares(**params, use_gpu=False)
+        model.user_factors, model.item_factors = warm_start
+    else:
+        model = AlternatingLeastSquares(**params)
+    model.fit(weighted_plays, show_progress=show_progress)
     return model
 
 
+def build_model(plays, warm_start=None, iterations=None):
+    """Train an ALS model on a users x artists play matrix, with the BM25_PARAMS
+    weighting and ALS_PARAMS. iterations overrides implicit's default number of
+    ALS iterations; for warm_start see train_als."""
+    params = {} if iterations is None else {"iterations": iterations}
+    return train_als(weight_plays(plays, **BM25_PARAMS), warm_start, **params)
+
+
+def save_model(model_dir, model, matrix_artists, matrix_users, user_artist_counts_path=None,
+               bm25_params=BM25_PARAMS, **info):
+    """Save a trained model to model_dir (see src/utils/model_store.py): its
+    factors, the artists (MBIDs or an ArtistIndex) and user IDs of the matrix it
+    was trained on, and the BM25 (bm25_params, if not the defaults) and ALS
+    parameters. Extra keyword arguments are saved in its model.json (e.g.
+    training_seconds).
+
+    Returns the SavedModel."""
+    if not isinstance(model.item_factors, np.ndarray):
+        model = model.to_cpu()
+    if not isinstance(matrix_artists, ArtistIndex):
+        matrix_artists = ArtistIndex.from_mbids(matrix_artists)
+    saved = SavedModel.from_factors(model.user_factors, model.item_factors,
+                                    np.asarray(matrix_users, dtype=str).astype(np.int64), matrix_artists,
+                                    user_artist_counts_path, bm25=dict(bm25_params),
+                                    als={"factors": model.factors, "regularization": model.regularization,
+                                         "alpha": model.alpha, "iterations": model.iterations}, **info)
+    saved.save(model_dir)
+    return saved
+
+
+def load_model(model_dir, artist_map=None):
+    """Load a model saved by save_model, with its factors memory-mapped, so it
+    is ready in milliseconds and can be queried like a freshly trained one.
+
+    Returns the model, an ArtistIndex of its artists (use it where
+    matrix_artists is used, e.g. with artist_index; names come from artist_map)
+    and the user IDs of its rows."""
+    saved = SavedModel.load(model_dir)
+    model = AlternatingLeastSquares(**saved.params["als"], use_gpu=False)
+    model.user_factors = saved.user_factors
+    model.item_factors = saved.item_factors
+    return model, saved.artist_index.with_names(artist_map), pandas.Index(saved.users.astype(str))
+
+
+def load_similarity_service(model_dir, artist_map=None, k=DEFAULT_TOP_K, ann_backend=None, ann_query=None):
+    """Similar-artist service over a model saved by save_model (see
+    src/utils/similarity.py). The k nearest artists of every artist are computed
+    in batches the first time and saved in model_dir; queries for up to k
+    similar artists are then table lookups:
+
+        service.similar_artists(mbid, n=20) -> [(mbid, name, score), ...]
+
+    For catalogs too large to precompute, pass ann_backend ("ivf" or "hnsw",
+    see src/utils/ann.py): queries then search an approximate nearest-neighbour
+    index saved in model_dir, with the ann_query parameters (e.g. {"nprobe": 32}
+    for "ivf", {"ef": 128} for "hnsw")."""
+    saved = SavedModel.load(model_dir)
+    saved.artist_index.with_names(artist_map)
+    if ann_backend is not None:
+        ann, _ = open_ann_index(model_dir, saved.item_factors, ann_backend)
+        return SimilarityService(saved, ann=ann, ann_query=ann_query)
+    return SimilarityService.open(model_dir, saved, k)
+
+
+def export_batch(model_dir, output_dir, n=20, user_artist_counts_path=None, kinds=EXPORT_KINDS,
+                 table_suffix=".csv", shard_rows=SHARD_ROWS, jobs=None, threads=1, progress=print):
+    """Export the top-n recommended artists of every user and the top-n most
+    similar artists of every artist of a model saved by save_model, into
+    output_dir/recommendations and output_dir/neighbours (see
+    src/utils/batch_export.py): sharded tables written by parallel workers
+    that memory-map the factors, instead of one recommend / similar_items call
+    per user or artist.
+
+    The recommendations leave out the artists a user listened to in
+    user_artist_counts_path, by default the counts the model was trained on
+    (pass "" to keep them); its play matrix is loaded from the matrix cache.
+
+    Returns the export manifests by kind (rows, seconds, throughput, shards)."""
+    if user_artist_counts_path is None:
+        user_artist_counts_path = SavedModel.load(model_dir).params.get("trained_on", {}).get("path")
+    matrix_prefix = None
+    if "recommendations" in kinds and user_artist_counts_path:
+        matrix_prefix = matrix_cache_prefix(user_artist_counts_path)
+        PlayMatrix.open(matrix_prefix, user_artist_counts_path, mmap_mode="r")
+    return {kind: export_model(model_dir, os.path.join(output_dir, kind), kind, n, matrix_prefix, table_suffix,
+                               shard_rows, jobs, threads, progress)
+            for kind in kinds}
+
+
+def retrain_model(plays, matrix_artists, matrix_users, previous_model_dir, iterations=WARM_START_ITERATIONS):
+    """Train a model on a new play matrix (e.g. after adding a month of counts)
+    starting from the factors of the model saved in previous_model_dir: users
+    and artists it already knows keep their factors, so a few iterations are
+    enough instead of a full training."""
+    previous = SavedModel.load(previous_model_dir)
+    if previous.item_factors.shape[1] != ALS_PARAMS["factors"]:
+        raise ValueError(f"Model in {previous_model_dir} has {previous.item_factors.shape[1]} factors, "
+                         f"expected {ALS_PARAMS['factors']}")
+    if isinstance(matrix_artists, ArtistIndex):
+        artist_keys = matrix_artists.keys
+    else:
+        artist_keys, _ = uuid_keys(list(matrix_artists))
+    user_factors, item_factors, reused = previous.warm_start_factors(
+        np.asarray(matrix_users, dtype=str).astype(np.int64), artist_keys)
+    print(f"Warm start from {previous_model_dir}: {reused['users']} of {len(matrix_users)} users, "
+          f"{reused['artists']} of {len(matrix_artists)} artists")
+    return build_model(plays, warm_start=(user_factors, item_factors), iterations=iterations)
+
+
 def get_artist_map(musicbrainz_artist_path):
-    """Load a MusicBrainz data file which maps artist MBIDs to the Artist name"""
-    artist_map = {}
-    with open(musicbrainz_artist_path) as fp:
-        r = csv.DictReader(fp)
-        for line in r:
-            artist_map[line['artist_mbid']] = line['name']
-    return artist_map
+    """Load the mapping of artist MBIDs to the Artist name, as a memory-mapped
+    UuidStringTable: dict-style get(mbid, default), mbid in / [mbid] lookups,
+    get_many(mbids) for batches and to_dict() for a plain dict.
+
+    musicbrainz_artist_path is the MusicBrainz artist CSV, whose table is built
+    on the first call and cached in the "dictionaries" directory next to it
+    (rebuilt when the CSV changes), or the path prefix of a table written by
+    artist_mapping.py. An artist_mapping.json export is loaded as a dict."""
+    if os.path.exists(musicbrainz_artist_path + UuidStringTable.SUFFIXES[0]):
+        return UuidStringTable.load(musicbrainz_artist_path)
+    if musicbrainz_artist_path.endswith(".json"):
+        with open(musicbrainz_artist_path, encoding="utf-8") as fp:
+            return json.load(fp)
+    prefix = os.path.join(os.path.dirname(musicbrainz_artist_path), DICTIONARY_DIRNAME,
+                          os.path.basename(musicbrainz_artist_path) + ".names")
+    if not is_current(prefix, musicbrainz_artist_path):
+        invalidate(prefix)
+        table = build_artist_table(musicbrainz_artist_path)
+        table.save(prefix)
+        mark_built(prefix, musicbrainz_artist_path, rows=len(table))
+    return UuidStringTable.load(prefix)
+
+
+def build_artist_index(artists, artist_map=None):
+    """Build an ArtistIndex over the matrix artists returned by load_data_matrix,
+    for constant-time MBID -> index and index -> MBID / name lookups (the names
+    come from artist_map, e.g. the result of get_artist_map). Lookups of many
+    artists at once go through ArtistIndex.rows."""
+    return ArtistIndex.from_mbids(artists, artist_map)
 
 
 def artist_index(artists, artist_mbid):
-    """Given an artist MBID, find its index in the matrix used to build the CF model"""
+    """Given an artist MBID, find its index in the matrix used to build the CF model.
+    artists is an ArtistIndex (see build_artist_index) or the artist MBIDs returned
+    by load_data_matrix; a pandas Index is searched through its hash table."""
+    if isinstance(artists, ArtistIndex):
+        return artists.row(artist_mbid)
+    if isinstance(artists, pandas.Index) and artists.is_unique:
+        try:
+            return artists.get_loc(artist_mbid)
+        except KeyError:
+            raise ValueError("Not found") from None
     positions = np.nonzero(artists == artist_mbid)[0]
     if positions.size == 0:
         raise ValueError("Not found")
     if positions.size > 1:
         raise ValueError("Unexpectedly found >1")
     return positions[0]
-
@@ -6,17 +6,68 @@ This script aggregates user-artist listen events to create a matrix of listen co
 It reads the "userid-artist.csv" file (which maps each individual event to an artist),
 sums up the counts for each (user, artist) pair, and writes the aggregated data to a new CSV file.
 
+Three implementations are available:
+    - "vectorized" (default): reads the input in chunks with pandas, factorizes users and
+      artists to integer codes and counts pairs with NumPy on a combined int64 key.
+    - "dict": the original row-by-row csv.DictReader / defaultdict implementation.
+    - "external": out-of-core aggregation for inputs whose distinct pairs do not fit in RAM.
+      Counts are kept in memory up to --memory-budget MB, then spilled as sorted runs to
+      temporary files which are k-way merged into the output.
+"vectorized" and "dict" write the same file (pairs in order of first occurrence); "external"
+writes the same counts sorted by user_id, artist_id.
+
+The "vectorized" and "external" implementations read and write CSV, Parquet or .npcols tables
+(see src/utils/columnar.py), following the file extensions; "dict" works on CSV only.
+
+Both also take a date range (--since / --until) and then count only the listens in it; from a
+month-partitioned store (userid-artist.months, see canonicalize.py) only the partitions of the
+months in the range are read. "vectorized" writes a ".months" output month by month: the
+counts of each month of the input in their own partition, which load_data_matrix sums over
+any window of months.
+
 Usage:
     python aggregate_counts.py <input_user_artist_csv> <output_user_artist_counts_csv>
+                               [--engine vectorized|dict|external] [--memory-budget MB] [--tmp-dir DIR]
+                               [--since DATE] [--until DATE] [--metrics REPORT_JSON]
 
 Example:
     python aggregate_counts.py /mnt/j/MusicBrainz/working/userid-artist.csv /mnt/j/MusicBrainz/working/userid-artist-counts.csv
 """
 
+import argparse
 import csv
+import heapq
 import sys
 import os
+import tempfile
 from collections import defaultdict
+from itertools import groupby
+
+import numpy as np
+import pandas as pd
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.utils.columnar import TableWriter, is_partitioned, iter_table, map_partitions, table_format, to_text
+from src.utils.config import CSV_CHUNK_ROWS
+from src.utils.file_utils import iter_chunks
+from src.utils.instrumentation import count_rows, measure
+
+# Rows read per pandas chunk by the vectorized implementation
+AGGREGATE_CHUNK_ROWS = 10 * CSV_CHUNK_ROWS
+
+# Default memory budget of the external implementation, in MB
+DEFAULT_MEMORY_BUDGET_MB = 2048
+
+# Rough memory cost of one (user_id, artist_id) -> count entry in a Python dict: the dict slot,
+# the key tuple and its two strings (a 36-char artist MBID alone is ~85 bytes).
+PAIR_BYTES = 300
+
+# Maximum number of run files merged at once (bounds the number of open files)
+MAX_MERGE_FANIN = 128
 
 def aggregate_listens(input_file, output_file):
     """
@@ -35,6 +86,7 @@ def aggregate_listens(input_file, output_file):
         for row in reader:
             key = (row["user_id"], row["artist_id"])
             counts[key] += 1
+    count_rows(sum(counts.values()))
     
     # Ensure the output directory exists.
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
@@ -53,11 +105,283 @@ def aggregate_listens(input_file, output_file):
     
     print(f"Aggregated counts written to {output_file}")
 
+class _Factorizer:
+    """
+    Incrementally assigns integer codes to values (strings, integers or binary UUID keys)
+    across chunks.
+    """
+
+    def __init__(self):
+        self.categories = pd.Index([], dtype=object)
+        self.dtype = None
+
+    def encode(self, values):
+        if self.dtype is None:
+            self.dtype = values.dtype
+        codes, uniques = pd.factorize(values)
+        positions = self.categories.get_indexer(uniques)
+        new = positions == -1
+        if new.any():
+            positions[new] = np.arange(len(self.categories), len(self.categories) + int(new.sum()))
+            self.categories = self.categories.append(pd.Index(uniques[new], dtype=object))
+        return positions[codes]
+
+    def decode(self, codes):
+        """Maps codes back to their values, with the dtype of the encoded arrays."""
+        values = self.categories.to_numpy()[codes]
+        return values if self.dtype is None or self.dtype == object else values.astype(self.dtype)
+
+def _reduce_counts(keys, counts, first_seen):
+    """
+    Merges partial counts: sums the counts of equal keys and keeps each key's earliest position.
+    The inputs must be ordered so that, for each key, its earliest partial comes first.
+    """
+    unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    summed = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(unique_keys)).astype(np.int64)
+    return unique_keys, summed, first_seen[first]
+
+def _count_pairs(chunks, chunk_rows):
+    """
+    Counts (user, artist) pairs over chunks of (user_values, artist_values, weights) arrays,
+    where weights is None for one listen per row. User and artist values are factorized to
+    integer codes (kept consistent across chunks) and combined into one int64 key per row.
+    Each chunk is counted with np.unique and partial counts are merged as they accumulate.
+
+    Returns:
+        tuple: (users, artists, keys, counts) with the keys and counts in order of first
+               occurrence; the factorizers decode the user (keys >> 32) and artist
+               (keys & 0xFFFFFFFF) codes.
+    """
+    users = _Factorizer()
+    artists = _Factorizer()
+    merged = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    pending = []
+    pending_size = 0
+    offset = 0
+    for user_values, artist_values, weights in chunks:
+        user_codes = users.encode(np.asarray(user_values))
+        artist_codes = artists.encode(np.asarray(artist_values))
+        keys = (user_codes.astype(np.int64) << 32) | artist_codes.astype(np.int64)
+        if weights is None:
+            chunk_keys, first, chunk_counts = np.unique(keys, return_index=True, return_counts=True)
+        else:
+            chunk_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            chunk_counts = np.bincount(inverse.reshape(-1), weights=weights, minlength=len(chunk_keys)).astype(np.int64)
+        pending.append((chunk_keys, chunk_counts, first + offset))
+        pending_size += len(chunk_keys)
+        offset += len(keys)
+        # Merge once the partials outgrow the merged table (amortizes the cost of merging).
+        if pending_size > max(len(merged[0]), chunk_rows):
+            merged = _reduce_counts(*(np.concatenate(parts) for parts in zip(merged, *pending)))
+            pending = []
+            pending_size = 0
+    if pending:
+        merged = _reduce_counts(*(np.concatenate(parts) for parts in zip(merged, *pending)))
+    
+    keys, counts, first_seen = merged
+    order = np.argsort(first_seen, kind="stable")
+    return users, artists, keys[order], counts[order]
+
+def _write_counts(output_file, users, artists, keys, counts):
+    """Writes the counts returned by _count_pairs, a block of rows at a time."""
+    with TableWriter(output_file, ['user_id', 'artist_id', 'listen_count']) as writer:
+        for start in range(0, len(keys), CSV_CHUNK_ROWS):
+            block = keys[start:start + CSV_CHUNK_ROWS]
+            writer.write_columns({
+                'user_id': users.decode(block >> 32),
+                'artist_id': artists.decode(block & 0xFFFFFFFF),
+                'listen_count': counts[start:start + CSV_CHUNK_ROWS],
+            })
+
+def aggregate_listens_vectorized(input_file, output_file, chunk_rows=AGGREGATE_CHUNK_ROWS, since=None, until=None):
+    """
+    Columnar version of aggregate_listens: same output, computed with pandas/NumPy.
+    
+    The input is read in chunks; user and artist IDs are factorized to integer codes (kept
+    consistent across chunks) and combined into one int64 key per event. Each chunk is counted
+    with np.unique, partial counts are merged as they accumulate, and the result is written
+    in bulk in order of first occurrence.
+    
+    Parameters:
+        input_file (str): Path to the table (.csv, .parquet, .npcols or a .months store) with
+                          columns "user_id" and "artist_id".
+        output_file (str): Path to the output aggregated table with columns "user_id,artist_id,listen_count";
+                           a .months output gets one partition of counts per month of the input.
+        chunk_rows (int): Number of input rows per chunk.
+        since, until: Optional date range [since, until) of the listens to count (see
+                      columnar.iter_table).
+    """
+    if is_partitioned(output_file):
+        map_partitions(input_file, output_file, ['user_id', 'artist_id', 'listen_count'],
+                       lambda path, start, end: aggregate_listens_vectorized(input_file, path, chunk_rows, start, end),
+                       since, until)
+        return
+    if table_format(input_file) == "csv" and since is None and until is None:
+        # pandas' C parser is the fastest way to read CSV; IDs are kept as text.
+        reader = (chunk.to_dict("series") for chunk in pd.read_csv(
+            input_file, usecols=["user_id", "artist_id"], dtype=str,
+            na_filter=False, chunksize=chunk_rows, encoding="utf-8"))
+    else:
+        # Binary tables (or a date range): typed columns (int64 user IDs, 16-byte artist keys).
+        reader = iter_table(input_file, ["user_id", "artist_id"], chunk_rows=chunk_rows, since=since, until=until)
+    chunks = ((chunk["user_id"], chunk["artist_id"], None) for chunk in reader)
+    users, artists, keys, counts = _count_pairs(chunks, chunk_rows)
+    # One listen per input row.
+    count_rows(counts.sum())
+    _write_counts(output_file, users, artists, keys, counts)
+    
+    print(f"Aggregated counts written to {output_file}")
+
+def merge_counts(count_files, output_file, chunk_rows=AGGREGATE_CHUNK_ROWS):
+    """
+    Adds up user-artist count tables (e.g. the existing counts and the partial counts of newly
+    processed dumps) into one table. Pairs are written in order of first occurrence across the
+    inputs taken in the given order, so merging the counts of consecutive parts of a listen
+    history gives the same file as aggregating the whole history at once.
+    
+    Parameters:
+        count_files (list): Tables (.csv, .parquet or .npcols) with user_id, artist_id and listen_count.
+        output_file (str): Path of the merged table; may be one of the inputs.
+        chunk_rows (int): Number of input rows per chunk.
+    """
+    columns = ["user_id", "artist_id", "listen_count"]
+    # All inputs are read typed (int64 user IDs, 16-byte artist keys) so they factorize alike.
+    chunks = ((chunk["user_id"], chunk["artist_id"], chunk["listen_count"])
+              for count_file in count_files
+              for chunk in iter_table(count_file, columns, chunk_rows=chunk_rows))
+    counted = _count_pairs(chunks, chunk_rows)
+    # The inputs are fully read at this point, so output_file may overwrite one of them.
+    _write_counts(output_file, *counted)
+    
+    print(f"Merged {len(count_files)} count tables into {output_file}")
+
+def _write_run(counts, run_dir, run_index):
+    """
+    Writes the in-memory counts, sorted by (user_id, artist_id), to a run file and returns its path.
+    """
+    path = os.path.join(run_dir, f"run-{run_index:05d}.csv")
+    with open(path, 'w', newline='', encoding='utf-8') as fp:
+        writer = csv.writer(fp)
+        for (user_id, artist_id), count in sorted(counts.items()):
+            writer.writerow([user_id, artist_id, count])
+    return path
+
+def _iter_merged_runs(run_files):
+    """
+    K-way merges sorted run files, yielding [user_id, artist_id, count] rows with the counts
+    of equal pairs summed.
+    """
+    files = [open(path, 'r', newline='', encoding='utf-8') for path in run_files]
+    try:
+        readers = [csv.reader(fp) for fp in files]
+        merged = heapq.merge(*readers, key=lambda row: (row[0], row[1]))
+        for (user_id, artist_id), rows in groupby(merged, key=lambda row: (row[0], row[1])):
+            yield [user_id, artist_id, sum(int(row[2]) for row in rows)]
+    finally:
+        for fp in files:
+            fp.close()
+
+def _iter_text_pairs(input_file, since=None, until=None):
+    """
+    Yields (user_id, artist_id) pairs as text from a table of any format (of the listens in
+    the date range [since, until), if given).
+    """
+    if table_format(input_file) == "csv" and since is None and until is None:
+        with open(input_file, 'r', encoding='utf-8') as infile:
+            reader = csv.reader(infile)
+            header = next(reader)
+            user_col = header.index("user_id")
+            artist_col = header.index("artist_id")
+            for row in reader:
+                if not row:
+                    continue
+                yield row[user_col], row[artist_col]
+        return
+    for chunk in iter_table(input_file, ["user_id", "artist_id"], since=since, until=until):
+        user_ids = [str(user_id) for user_id in to_text("user_id", chunk["user_id"])]
+        yield from zip(user_ids, to_text("artist_id", chunk["artist_id"]))
+
+def aggregate_listens_external(input_file, output_file, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, tmp_dir=None,
+                               since=None, until=None):
+    """
+    Out-of-core version of aggregate_listens for inputs whose distinct (user, artist) pairs
+    do not fit in memory.
+    
+    Pairs are counted in a dict until its estimated size passes the memory budget; the counts
+    are then written, sorted, to a temporary run file and the dict is cleared. Finally the runs
+    are k-way merged (in several passes if there are more than MAX_MERGE_FANIN of them) into
+    the output, which is sorted by user_id, artist_id. When everything fits in the budget a
+    single run is written and the merge is a plain copy.
+    
+    Parameters:
+        input_file (str): Path to the table (.csv, .parquet or .npcols) with columns "user_id" and "artist_id".
+        output_file (str): Path to the output aggregated table with columns "user_id,artist_id,listen_count".
+        memory_budget_mb (float): Memory budget for the in-memory counts, in MB.
+        tmp_dir (str): Directory for the run files (defaults to the output directory).
+        since, until: Optional date range [since, until) of the listens to count.
+    """
+    max_pairs = max(int(memory_budget_mb * 1024 * 1024 // PAIR_BYTES), 1)
+    
+    # Ensure the output directory exists.
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    
+    with tempfile.TemporaryDirectory(prefix="aggregate-runs-", dir=tmp_dir or os.path.dirname(output_file)) as run_dir:
+        run_files = []
+        counts = defaultdict(int)
+        total_rows = 0
+        for pair in _iter_text_pairs(input_file, since, until):
+            counts[pair] += 1
+            if len(counts) >= max_pairs:
+                total_rows += sum(counts.values())
+                run_files.append(_write_run(counts, run_dir, len(run_files)))
+                counts.clear()
+        total_rows += sum(counts.values())
+        count_rows(total_rows)
+        if counts or not run_files:
+            run_files.append(_write_run(counts, run_dir, len(run_files)))
+        del counts
+        print(f"Spilled {len(run_files)} sorted runs to {run_dir}")
+        
+        # Reduce the number of runs until they can be merged in one pass.
+        while len(run_files) > MAX_MERGE_FANIN:
+            merged_files = []
+            for start in range(0, len(run_files), MAX_MERGE_FANIN):
+                path = os.path.join(run_dir, f"merge-{len(run_files)}-{start:05d}.csv")
+                with open(path, 'w', newline='', encoding='utf-8') as fp:
+                    csv.writer(fp).writerows(_iter_merged_runs(run_files[start:start + MAX_MERGE_FANIN]))
+                for merged in run_files[start:start + MAX_MERGE_FANIN]:
+                    os.remove(merged)
+                merged_files.append(path)
+            run_files = merged_files
+        
+        with TableWriter(output_file, ['user_id', 'artist_id', 'listen_count']) as writer:
+            for rows in iter_chunks(_iter_merged_runs(run_files), CSV_CHUNK_ROWS):
+                writer.write_rows(rows)
+    
+    print(f"Aggregated counts written to {output_file}")
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python aggregate_counts.py <input_user_artist_csv> <output_user_artist_counts_csv>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Aggregate user-artist listen events into listen counts.")
+    parser.add_argument("input_file", help="CSV with user_id,artist_id columns (one row per listen)")
+    parser.add_argument("output_file", help="Output CSV with user_id,artist_id,listen_count columns")
+    parser.add_argument("--engine", choices=["vectorized", "dict", "external"], default="vectorized",
+                        help="Aggregation implementation; use external when the pairs do not fit in memory")
+    parser.add_argument("--memory-budget", type=float, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help="Memory budget in MB for the in-memory counts (external engine)")
+    parser.add_argument("--tmp-dir", default=None, help="Directory for temporary run files (external engine)")
+    parser.add_argument("--since", default=None,
+                        help="Count the listens from this date or time (ISO 8601, UTC, or Unix seconds)")
+    parser.add_argument("--until", default=None, help="Count the listens before this date or time")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
+    if args.engine == "dict" and (args.since or args.until):
+        parser.error("--since / --until need the vectorized or external engine")
     
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
-    aggregate_listens(input_file, output_file)
+    with measure("aggregate_counts", args.metrics):
+        if args.engine == "dict":
+            aggregate_listens(args.input_file, args.output_file)
+        elif args.engine == "external":
+            aggregate_listens_external(args.input_file, args.output_file, args.memory_budget, args.tmp_dir,
+                                       args.since, args.until)
+        else:
+            aggregate_listens_vectorized(args.input_file, args.output_file, since=args.since, until=args.until)
@@ -2,29 +2,52 @@
 """
 artist_mapping.py
 -----------------
-This script processes the musicbrainz_artist.csv file to create a dictionary mapping
-artist MBIDs to their textual names.
+This script processes the musicbrainz_artist.csv file to create a mapping of artist MBIDs to
+their textual names.
+
+The mapping is saved as a compact binary string table (a UuidStringTable, see
+src/utils/interning.py): the sorted 16-byte MBID keys, an offsets array and one UTF-8 blob of
+names, as three .npy files sharing the output path prefix. Loaded memory-mapped (e.g. by
+listenbrainz_model.get_artist_map), it opens instantly and answers single and batch lookups
+without reading the whole file. An output path ending in ".json" (or --json) writes the same
+mapping as a JSON object, the format of the former artist_mapping.json.
 
 Usage:
-    python artist_mapping.py <input_artist_csv> <output_mapping_json>
+    python artist_mapping.py <input_artist_csv> <output_prefix> [--json MAPPING_JSON] [--metrics REPORT_JSON]
 
 Example:
+    python artist_mapping.py /mnt/j/MusicBrainz/musicbrainz_artist.csv /mnt/j/MusicBrainz/working/artist_names
     python artist_mapping.py /mnt/j/MusicBrainz/musicbrainz_artist.csv /mnt/j/MusicBrainz/working/artist_mapping.json
 """
 
+import argparse
 import csv
 import json
 import sys
 import os
 
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.utils.config import CSV_CHUNK_ROWS
+from src.utils.file_utils import csv_column, iter_chunks, open_input
+from src.utils.instrumentation import count_rows, measure
+from src.utils.interning import UuidStringTable, uuid_keys
+
 def build_artist_mapping(artist_csv):
     """
     Reads the musicbrainz_artist.csv file and returns a dictionary mapping
     artist MBIDs to their textual names.
-    
+
+    This is the former dict API, kept for its callers and for the JSON export: the MBIDs are
+    kept as written in the CSV, in file order, including malformed ones, whereas
+    build_artist_table normalizes them to binary keys and skips the malformed ones.
+
     Parameters:
         artist_csv (str): Path to the musicbrainz_artist.csv file.
-        
+
     Returns:
         dict: A dictionary where keys are artist MBIDs and values are artist names.
     """
@@ -38,20 +61,68 @@ def build_artist_mapping(artist_csv):
                 mapping[artist_mbid] = name
     return mapping
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python artist_mapping.py <input_artist_csv> <output_mapping_json>")
-        sys.exit(1)
-    
-    artist_csv = sys.argv[1]
-    output_file = sys.argv[2]
-    
-    mapping = build_artist_mapping(artist_csv)
-    print(f"Built mapping for {len(mapping)} artists.")
-    
-    # Save the mapping as a JSON file for later use.
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+def build_artist_table(artist_csv):
+    """
+    Reads the musicbrainz_artist.csv file (plain or .zst) in chunks into a UuidStringTable of
+    artist MBID keys -> names. Rows without a name or with a malformed MBID are skipped.
+
+    Parameters:
+        artist_csv (str): Path to the musicbrainz_artist.csv file.
+
+    Returns:
+        UuidStringTable: The artist names by MBID.
+    """
+    key_chunks = []
+    name_chunks = []
+    with open_input(artist_csv, errors="replace") as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        mbid_col, name_col = header.index("artist_mbid"), header.index("name")
+        for rows in iter_chunks(reader, CSV_CHUNK_ROWS):
+            keys, valid = uuid_keys(csv_column(rows, mbid_col))
+            names = csv_column(rows, name_col)
+            keep = [ok and bool(name) for ok, name in zip(valid.tolist(), names)]
+            key_chunks.append(keys[keep])
+            name_chunks.append([name for name, ok in zip(names, keep) if ok])
+    return UuidStringTable.from_pairs(key_chunks, name_chunks)
+
+def export_artist_json(mapping, output_file):
+    """
+    Writes a mapping of MBID -> name (see build_artist_mapping) as the JSON object of the former
+    artist_mapping.json, byte for byte.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
     with open(output_file, "w", encoding="utf-8") as f:
         json.dump(mapping, f, ensure_ascii=False, indent=2)
-    
+
+def write_artist_mapping(artist_csv, output_file, json_file=None):
+    """
+    Builds the artist mapping from artist_csv and saves it as a string table under the
+    output_file prefix, or as JSON if output_file ends in ".json". json_file optionally
+    exports the JSON as well.
+    """
+    if output_file.endswith(".json"):
+        mapping = build_artist_mapping(artist_csv)
+        count_rows(len(mapping))
+        print(f"Built mapping for {len(mapping)} artists.")
+        export_artist_json(mapping, output_file)
+    else:
+        table = build_artist_table(artist_csv)
+        count_rows(len(table))
+        print(f"Built mapping for {len(table)} artists.")
+        table.save(output_file)
     print(f"Mapping saved to {output_file}")
+    if json_file:
+        export_artist_json(build_artist_mapping(artist_csv), json_file)
+        print(f"JSON export saved to {json_file}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map MusicBrainz artist MBIDs to their names.")
+    parser.add_argument("artist_csv", help="Path to the musicbrainz_artist.csv file")
+    parser.add_argument("output_file", help="Path prefix of the string table to write (or a .json file)")
+    parser.add_argument("--json", default=None, help="Also export the mapping as a JSON file")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
+
+    with measure("artist_mapping", args.metrics):
+        write_artist_mapping(args.artist_csv, args.output_file, args.json)
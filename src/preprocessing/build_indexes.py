@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+build_indexes.py
+----------------
+One-time build step that turns the reference dumps into persistent, memory-mapped indexes
+(see src/utils/lookup_store.py):
+
+    - msid_mapping.*:       the ListenBrainz MSID mapping, sorted by MSID (used by filter_mapping.py)
+    - canonical_redirect.*: recording MBID -> canonical recording MBID (used by canonicalize.py)
+    - canonical_artist.*:   canonical recording MBID -> first artist MBID (used by canonicalize.py)
+
+Pass the same directory as --index-dir to filter_mapping.py and canonicalize.py. An index whose
+source dump still has the size and mtime it was built from is left as is, so re-running this
+script after downloading a new dump only rebuilds the indexes of that dump.
+
+Usage:
+    python build_indexes.py <index_dir> [--mapping FILE] [--redirect FILE] [--metadata FILE]
+                            [--metrics REPORT_JSON]
+
+Example:
+    python build_indexes.py /mnt/j/MusicBrainz/indexes \\
+                            --mapping /mnt/j/MusicBrainz/listenbrainz_msid_mapping.csv-003.zst \\
+                            --redirect /mnt/j/MusicBrainz/canonical_recording_redirect.csv.zst \\
+                            --metadata /mnt/j/MusicBrainz/canonical_musicbrainz_data.csv.zst
+"""
+
+import argparse
+import sys
+import os
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.preprocessing.canonicalize import load_canonical_metadata, load_canonical_redirect
+from src.utils.instrumentation import count_rows, measure
+from src.utils.lookup_store import MsidMappingIndex
+
+def build_indexes(index_dir, mapping_file=None, redirect_file=None, metadata_file=None):
+    """
+    Builds (or checks) the indexes of the given dumps in index_dir.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    if mapping_file:
+        index, built = MsidMappingIndex.open(os.path.join(index_dir, "msid_mapping"), mapping_file)
+        print(f"{'Built' if built else 'Up to date'}: mapping index of {mapping_file} ({len(index)} rows)")
+        count_rows(len(index))
+    if redirect_file:
+        count_rows(len(load_canonical_redirect(redirect_file, os.path.join(index_dir, "canonical_redirect"))))
+    if metadata_file:
+        count_rows(len(load_canonical_metadata(metadata_file, os.path.join(index_dir, "canonical_artist"))))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build memory-mapped indexes of the reference dumps.")
+    parser.add_argument("index_dir", help="Directory to write the indexes to")
+    parser.add_argument("--mapping", default=None, help="ListenBrainz MSID mapping dump")
+    parser.add_argument("--redirect", default=None, help="Canonical recording redirect file")
+    parser.add_argument("--metadata", default=None, help="Canonical MusicBrainz data file")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
+
+    if not (args.mapping or args.redirect or args.metadata):
+        parser.error("give at least one of --mapping, --redirect, --metadata")
+    with measure("build_indexes", args.metrics):
+        build_indexes(args.index_dir, args.mapping, args.redirect, args.metadata)
@@ -6,8 +6,24 @@ This script processes user listening events by joining user–MSID data with the
 MSID mapping, applying canonical redirect mapping, and extracting artist information from the canonical
 metadata file. The final output is a CSV mapping each user_id to an artist_id (derived from the recording's artist credit).
 
+With --counts, the listen events are aggregated during the join and the script writes the
+user-artist listen counts (user_id, artist_id, listen_count) directly, the same output as
+running aggregate_counts.py on the per-event file, without writing that file.
+
+The user-MSID and filtered mapping inputs and the output may be CSV, Parquet or .npcols
+tables (see src/utils/columnar.py); the format follows the file extension.
+
+--since / --until restrict the run to the listens in a date range. From a month-partitioned
+listen store (userid-msid.months, see extract_listens.py) only the partitions of the months in
+the range are read. A ".months" output is written with one partition per month of the input
+(per-month events, or per-month counts with --counts).
+
 Usage:
     python canonicalize.py <userid_msid_csv> <small_msid_mapping_csv> <canonical_redirect_file> <canonical_metadata_file> <output_user_artist_csv>
+    python canonicalize.py <userid_msid_csv> <small_msid_mapping_csv> <canonical_redirect_file> <canonical_metadata_file> <output_user_artist_counts_csv> --counts
+    Add --index-dir DIR to use the canonical redirect/metadata indexes built by build_indexes.py,
+    --since DATE / --until DATE to keep the listens of a date range (until excluded),
+    and --metrics REPORT_JSON to save the run's performance metrics.
 
 Example:
     python canonicalize.py /mnt/j/MusicBrainz/working/userid-msid.csv \
@@ -17,9 +33,10 @@ Example:
                             /mnt/j/MusicBrainz/working/userid-artist.csv
 """
 
-import csv
+import argparse
 import sys
 import os
+import numpy as np
 from tqdm import tqdm
 
 # Ensure the project root is in sys.path
@@ -27,67 +44,98 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
-from src.utils.file_utils import decompress_if_needed
+from src.utils.columnar import (NULL_KEY, TableWriter, column_kind, is_partitioned, iter_table, map_partitions,
+                                table_size)
+from src.utils.config import CSV_CHUNK_ROWS, DICTIONARY_DIRNAME
+from src.utils.instrumentation import count_rows, measure
+from src.utils.interning import UuidDictionary, UuidMapping, uuid_keys
+from src.utils.lookup_store import invalidate, is_current, mark_built
 
-def load_user_msids(userid_msid_csv):
+def iter_user_msids(userid_msid_csv, progress=None, since=None, until=None):
     """
-    Loads the user_id and recording_msid pairs from the extracted CSV.
+    Streams the user_id and recording_msid pairs from the extracted table in chunks.
     
-    Returns a list of dictionaries with keys: 'user_id', 'recording_msid'
+    Parameters:
+        userid_msid_csv (str): Path to the table (.csv / .csv.zst, .parquet, .npcols or a
+                               .months store) with user_id and recording_msid.
+        progress (callable): Optional callback receiving the number of bytes read.
+        since, until: Optional date range [since, until) of the listens to read (see
+                      columnar.iter_table).
+    
+    Yields tuples of aligned arrays (user_ids, msid_keys, valid): integer user IDs,
+    16-byte binary MSID keys and a flag for well-formed MSIDs.
     """
-    data = []
-    with open(userid_msid_csv, "r", encoding="utf-8") as fp:
-        reader = csv.DictReader(fp)
-        for row in reader:
-            data.append({
-                "user_id": row["user_id"],
-                "recording_msid": row["recording_msid"]
-            })
-    print(f"Loaded {len(data)} user listening events from {userid_msid_csv}")
-    return data
+    for chunk in iter_table(userid_msid_csv, ["user_id", "recording_msid"], progress=progress,
+                            since=since, until=until):
+        msid_keys = chunk["recording_msid"]
+        yield chunk["user_id"], msid_keys, msid_keys != NULL_KEY
+
+def _load_uuid_mapping(source_file, key_column, value_column, cache_prefix=None, value_transform=None):
+    """
+    Reads two UUID columns of a table (CSV, possibly .zst, Parquet or .npcols) into a
+    UuidMapping, skipping rows where either is empty or malformed. If cache_prefix is given,
+    the mapping is persisted there and reused (memory-mapped) on later runs as long as the
+    size and mtime of source_file are unchanged (see src/utils/lookup_store.py).
+    
+    If the value column is not a UUID column, value_transform (if given) is applied to its
+    text before it is parsed as a UUID.
+
+    Returns:
+        tuple: (mapping, loaded_from_cache)
+    """
+    if cache_prefix and is_current(cache_prefix, source_file):
+        return UuidMapping.load(cache_prefix), True
+    if cache_prefix:
+        invalidate(cache_prefix)
+
+    key_chunks = []
+    value_chunks = []
+    # Compressed (.zst) files are decompressed on the fly while reading.
+    for chunk in iter_table(source_file, [key_column, value_column], errors="replace"):
+        keys = chunk[key_column]
+        values = chunk[value_column]
+        if column_kind(value_column) != "uuid":
+            # Text column (e.g. artist_mbids): extract the UUID from it, then parse it.
+            if value_transform:
+                values = [value_transform(value) for value in values]
+            values = uuid_keys(values)[0]
+        valid = (keys != NULL_KEY) & (values != NULL_KEY)
+        key_chunks.append(keys[valid])
+        value_chunks.append(values[valid])
+    mapping = UuidMapping.from_pairs(key_chunks, value_chunks)
+    if cache_prefix:
+        mapping.save(cache_prefix)
+        mark_built(cache_prefix, source_file, rows=len(mapping))
+    return mapping, False
 
-def load_filtered_mapping(filtered_mapping_csv):
+def load_filtered_mapping(filtered_mapping_csv, cache_prefix=None):
     """
     Loads the filtered mapping (MSID -> MBID) from CSV.
     
-    Returns a dictionary mapping recording_msid -> recording_mbid.
+    Returns a UuidMapping from recording_msid keys to recording_mbid keys.
     """
-    mapping = {}
-    with open(filtered_mapping_csv, "r", encoding="utf-8") as fp:
-        reader = csv.DictReader(fp)
-        for row in reader:
-            msid = row["recording_msid"]
-            mbid = row["recording_mbid"]
-            mapping[msid] = mbid
-    print(f"Loaded {len(mapping)} MSID-to-MBID mappings from {filtered_mapping_csv}")
+    mapping, cached = _load_uuid_mapping(filtered_mapping_csv, "recording_msid", "recording_mbid", cache_prefix)
+    source = cache_prefix if cached else filtered_mapping_csv
+    print(f"Loaded {len(mapping)} MSID-to-MBID mappings from {source}")
     return mapping
 
-def load_canonical_redirect(redirect_file):
+def load_canonical_redirect(redirect_file, cache_prefix=None):
     """
     Loads the canonical redirect mapping from the canonical redirect CSV.
     
-    Returns a dictionary mapping non-canonical MBID -> canonical MBID.
-    """
-    # Decompress the redirect file if needed.
-    redirect_file = decompress_if_needed(redirect_file)
-    
-    redirect = {}
-    with open(redirect_file, "r", encoding="utf-8", errors="replace") as fp:
-        reader = csv.DictReader(fp)
-        # Assume header contains columns: "recording_mbid" and "canonical_recording_mbid"
-        for row in reader:
-            non_canonical = row.get("recording_mbid")
-            canonical = row.get("canonical_recording_mbid")
-            if non_canonical and canonical:
-                redirect[non_canonical] = canonical
-    print(f"Loaded {len(redirect)} canonical redirects from {redirect_file}")
+    Returns a UuidMapping from non-canonical MBID keys to canonical MBID keys.
+    """
+    # Assume header contains columns: "recording_mbid" and "canonical_recording_mbid"
+    redirect, cached = _load_uuid_mapping(redirect_file, "recording_mbid", "canonical_recording_mbid", cache_prefix)
+    source = cache_prefix if cached else redirect_file
+    print(f"Loaded {len(redirect)} canonical redirects from {source}")
     return redirect
 
-def load_canonical_metadata(metadata_file):
+def load_canonical_metadata(metadata_file, cache_prefix=None):
     """
     Loads the canonical metadata which includes artist information.
     
-    Returns a dictionary mapping canonical recording MBID -> first artist MBID.
+    Returns a UuidMapping from canonical recording MBID keys to first artist MBID keys.
     
     The metadata file is assumed to have a header with at least these columns:
        - recording_mbid
@@ -95,86 +143,194 @@ def load_canonical_metadata(metadata_file):
        
     For simplicity, we take the first artist MBID from the 'artist_mbids' field.
     """
-    metadata = {}
-    # Decompress if needed.
-    metadata_file = decompress_if_needed(metadata_file)
-    
-    with open(metadata_file, "r", encoding="utf-8", errors="replace") as fp:
-        reader = csv.DictReader(fp)
-        for row in reader:
-            rec_mbid = row.get("recording_mbid")
-            artist_mbids = row.get("artist_mbids")
-            if rec_mbid and artist_mbids:
-                # Split the artist_mbids by comma and take the first entry.
-                first_artist = artist_mbids.split(",")[0].strip()
-                metadata[rec_mbid] = first_artist
-    print(f"Loaded artist metadata for {len(metadata)} recordings from {metadata_file}")
+    # Split the artist_mbids by comma and take the first entry.
+    first_artist = lambda artist_mbids: artist_mbids.split(",")[0].strip()
+    metadata, cached = _load_uuid_mapping(metadata_file, "recording_mbid", "artist_mbids", cache_prefix, first_artist)
+    source = cache_prefix if cached else metadata_file
+    print(f"Loaded artist metadata for {len(metadata)} recordings from {source}")
     return metadata
 
 
-def process_user_artist(userid_msid_csv, filtered_mapping_csv, redirect_file, metadata_file, output_csv):
+def resolve_msid_artists(msid_to_mbid, redirect, metadata):
+    """
+    Resolves every mapped MSID to its artist once, so that each listen event then needs a
+    single lookup:
+    1. Map recording_msid to recording_mbid using the filtered mapping.
+    2. Apply canonical redirect if available.
+    3. Look up artist information in the metadata.
+    
+    Returns a UuidMapping from MSID keys to artist MBID keys (MSIDs without an artist are dropped).
+    """
+    canonical_mbids, _ = redirect.get(msid_to_mbid.values, default=msid_to_mbid.values)
+    artists, has_artist = metadata.lookup(canonical_mbids)
+    # msid_to_mbid.keys is sorted, so the filtered keys still are.
+    return UuidMapping(msid_to_mbid.keys[has_artist], artists[has_artist])
+
+def load_msid_artists(filtered_mapping_csv, redirect_file, metadata_file, dictionary_dir, index_dir=None):
+    """
+    Loads the lookup tables and resolves them into a single MSID -> artist UuidMapping.
+    The filtered mapping is persisted in dictionary_dir; the canonical redirect and metadata
+    indexes in index_dir (default: dictionary_dir), e.g. as built by build_indexes.py.
+    """
+    index_dir = index_dir or dictionary_dir
+    msid_to_mbid = load_filtered_mapping(filtered_mapping_csv, os.path.join(dictionary_dir, "msid_to_mbid"))
+    redirect = load_canonical_redirect(redirect_file, os.path.join(index_dir, "canonical_redirect"))
+    metadata = load_canonical_metadata(metadata_file, os.path.join(index_dir, "canonical_artist"))
+    return resolve_msid_artists(msid_to_mbid, redirect, metadata)
+
+def iter_user_artists(userid_msid_csv, msid_to_artist, stats, since=None, until=None):
+    """
+    Streams the listen events (of the date range [since, until), if given) mapped to artists,
+    in chunks, with a progress bar.
+    
+    Yields tuples of aligned arrays (user_ids, artist_keys); events whose MSID has no
+    mapping or no artist are skipped. Event counts are accumulated in the stats dict.
+    """
+    with tqdm(total=table_size(userid_msid_csv, since, until), unit='B', unit_scale=True,
+              desc="Processing user events") as pbar:
+        for user_ids, msid_keys, valid in iter_user_msids(userid_msid_csv, pbar.update, since, until):
+            artist_keys, found = msid_to_artist.lookup(msid_keys)
+            found &= valid
+            stats["total_events"] += len(user_ids)
+            stats["converted_events"] += int(found.sum())
+            yield user_ids[found], artist_keys[found]
+
+def process_user_artist(userid_msid_csv, filtered_mapping_csv, redirect_file, metadata_file, output_csv,
+                        dictionary_dir=None, index_dir=None, since=None, until=None):
     """
     Joins the user listening data with the filtered MSID mapping, applies canonical redirects,
     and then extracts artist information using the canonical metadata.
     
+    The join is streamed: listen events are read, mapped to artists and written in chunks,
+    so only the lookup tables stay in memory whatever the number of events. The lookups use
+    16-byte binary UUID keys held in NumPy arrays; the tables are persisted in dictionary_dir
+    (default: "dictionaries" next to output_csv), or index_dir for the canonical dumps, and
+    reused on later runs while their source files keep the same size and mtime.
+    
+    Only the listens in the date range [since, until) are processed, if one is given. A
+    .months output is written month by month from a .months input (see map_partitions).
+    
     Outputs a CSV file with columns: user_id, artist_id.
     """
-    # Load data
-    user_data = load_user_msids(userid_msid_csv)
-    msid_to_mbid = load_filtered_mapping(filtered_mapping_csv)
-    redirect = load_canonical_redirect(redirect_file)
-    metadata = load_canonical_metadata(metadata_file)
-    
-    # Process each user listening event:
-    # 1. Map recording_msid to recording_mbid using the filtered mapping.
-    # 2. Apply canonical redirect if available.
-    # 3. Look up artist information in the metadata.
-    total_events = 0
-    converted_events = 0
-    output_rows = []
-    
-    for event in tqdm(user_data, desc="Processing user events"):
-        total_events += 1
-        msid = event["recording_msid"]
-        user_id = event["user_id"]
-        mbid = msid_to_mbid.get(msid)
-        if not mbid:
-            # Skip if no mapping is available.
-            continue
-        # Apply canonical redirect if available.
-        canonical_mbid = redirect.get(mbid, mbid)
-        # Look up artist info in metadata.
-        artist_id = metadata.get(canonical_mbid)
-        if not artist_id:
-            continue
-        # Create an output row: we map the listen event to an artist.
-        output_rows.append({
-            "user_id": user_id,
-            "artist_id": artist_id
-        })
-        converted_events += 1
+    if dictionary_dir is None:
+        dictionary_dir = os.path.join(os.path.dirname(output_csv.rstrip("/\\")), DICTIONARY_DIRNAME)
+    msid_to_artist = load_msid_artists(filtered_mapping_csv, redirect_file, metadata_file, dictionary_dir, index_dir)
+    stats = {"total_events": 0, "converted_events": 0}
+    
+    def write_user_artists(path, start, end):
+        # Stream the user listening events into the final user-artist mapping.
+        with TableWriter(path, ["user_id", "artist_id"]) as writer:
+            for user_ids, artist_keys in iter_user_artists(userid_msid_csv, msid_to_artist, stats, start, end):
+                writer.write_columns({"user_id": user_ids, "artist_id": artist_keys})
     
     # Ensure the output directory exists.
-    os.makedirs(os.path.dirname(output_csv), exist_ok=True)
-    # Write out the final user-artist mapping.
-    with open(output_csv, "w", newline='', encoding="utf-8") as fp:
-        fieldnames = ["user_id", "artist_id"]
-        writer = csv.DictWriter(fp, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(output_rows)
-    
-    print(f"Processed {total_events} user events; converted {converted_events} events to user-artist pairs.")
+    os.makedirs(os.path.dirname(output_csv.rstrip("/\\")), exist_ok=True)
+    if is_partitioned(output_csv):
+        map_partitions(userid_msid_csv, output_csv, ["user_id", "artist_id"], write_user_artists, since, until)
+    else:
+        write_user_artists(output_csv, since, until)
+    count_rows(stats["total_events"])
+    
+    print(f"Processed {stats['total_events']} user events; converted {stats['converted_events']} events to user-artist pairs.")
     print(f"Output written to {output_csv}")
 
-if __name__ == "__main__":
-    if len(sys.argv) != 6:
-        print("Usage: python canonicalize.py <userid_msid_csv> <filtered_mapping_csv> <canonical_redirect_file> <canonical_metadata_file> <output_user_artist_csv>")
-        sys.exit(1)
+def process_user_artist_counts(userid_msid_csv, filtered_mapping_csv, redirect_file, metadata_file, output_counts_csv,
+                               dictionary_dir=None, index_dir=None, since=None, until=None):
+    """
+    Fused canonicalize + aggregate: performs the same streaming join as process_user_artist but
+    counts (user_id, artist_id) pairs on the fly instead of writing one row per event, so the
+    per-event userid-artist.csv is never written.
+    
+    Pairs are counted on integer codes (user_id combined with the artist's position in the
+    artist dictionary) and written in order of first occurrence, so the output is identical
+    to running process_user_artist followed by aggregate_counts.aggregate_listens.
+    
+    Only the listens in the date range [since, until) are counted, if one is given. A .months
+    output gets the counts of each month of a .months input in its own partition.
+    
+    Outputs a CSV file with columns: user_id, artist_id, listen_count.
+    """
+    if dictionary_dir is None:
+        dictionary_dir = os.path.join(os.path.dirname(output_counts_csv.rstrip("/\\")), DICTIONARY_DIRNAME)
+    msid_to_artist = load_msid_artists(filtered_mapping_csv, redirect_file, metadata_file, dictionary_dir, index_dir)
+    if is_partitioned(output_counts_csv):
+        total_events = 0
+        def write_month(path, start, end):
+            nonlocal total_events
+            total_events += write_user_artist_counts(userid_msid_csv, msid_to_artist, path, start, end)["total_events"]
+        map_partitions(userid_msid_csv, output_counts_csv, ["user_id", "artist_id", "listen_count"], write_month,
+                       since, until)
+        count_rows(total_events)
+    else:
+        stats = write_user_artist_counts(userid_msid_csv, msid_to_artist, output_counts_csv, since, until)
+        count_rows(stats["total_events"])
+
+def write_user_artist_counts(userid_msid_csv, msid_to_artist, output_counts_csv, since=None, until=None):
+    """
+    Counting half of process_user_artist_counts: streams the listen events of userid_msid_csv
+    (in the date range [since, until), if given) through an already resolved MSID -> artist
+    UuidMapping and writes the user-artist counts.
+    
+    Returns:
+        dict: Event counts (total_events, converted_events).
+    """
+    artists = UuidDictionary.from_keys([msid_to_artist.values])
+    num_artists = max(len(artists), 1)
+    stats = {"total_events": 0, "converted_events": 0}
+    
+    # Insertion-ordered dict: pair code -> count.
+    counts = {}
+    for user_ids, artist_keys in iter_user_artists(userid_msid_csv, msid_to_artist, stats, since, until):
+        codes = user_ids * num_artists + artists.encode_keys(artist_keys)
+        # Count the chunk vectorized, then merge its pairs in order of first occurrence.
+        unique_codes, first_index, chunk_counts = np.unique(codes, return_index=True, return_counts=True)
+        order = np.argsort(first_index, kind="stable")
+        for code, count in zip(unique_codes[order].tolist(), chunk_counts[order].tolist()):
+            counts[code] = counts.get(code, 0) + count
+    
+    codes = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    listen_counts = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    del counts
     
-    userid_msid_csv = sys.argv[1]
-    filtered_mapping_csv = sys.argv[2]
-    redirect_file = sys.argv[3]
-    metadata_file = sys.argv[4]
-    output_csv = sys.argv[5]
+    # Ensure the output directory exists.
+    os.makedirs(os.path.dirname(output_counts_csv.rstrip("/\\")), exist_ok=True)
+    with TableWriter(output_counts_csv, ["user_id", "artist_id", "listen_count"]) as writer:
+        for start in range(0, len(codes), CSV_CHUNK_ROWS):
+            user_ids, artist_ids = np.divmod(codes[start:start + CSV_CHUNK_ROWS], num_artists)
+            writer.write_columns({
+                "user_id": user_ids,
+                "artist_id": artists.keys[artist_ids],
+                "listen_count": listen_counts[start:start + CSV_CHUNK_ROWS],
+            })
+    
+    print(f"Processed {stats['total_events']} user events; converted {stats['converted_events']} events to user-artist pairs.")
+    print(f"Aggregated counts written to {output_counts_csv}")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Join user listens with the MSID mapping and canonical data to get user-artist pairs.")
+    parser.add_argument("userid_msid_csv", help="Path to the userid-msid table")
+    parser.add_argument("filtered_mapping_csv", help="Path to the filtered MSID mapping")
+    parser.add_argument("redirect_file", help="Path to the canonical recording redirect file")
+    parser.add_argument("metadata_file", help="Path to the canonical MusicBrainz data file")
+    parser.add_argument("output_csv", help="Path to the output user-artist (or, with --counts, user-artist counts) table")
+    parser.add_argument("--counts", action="store_true",
+                        help="Aggregate during the join and write user_id,artist_id,listen_count directly")
+    parser.add_argument("--index-dir", default=None,
+                        help="Directory of the canonical redirect/metadata indexes (see build_indexes.py)")
+    parser.add_argument("--since", default=None,
+                        help="Keep the listens from this date or time (ISO 8601, UTC, or Unix seconds)")
+    parser.add_argument("--until", default=None, help="Keep the listens before this date or time")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
     
-    process_user_artist(userid_msid_csv, filtered_mapping_csv, redirect_file, metadata_file, output_csv)
+    with measure("canonicalize", args.metrics):
+        if args.counts:
+            # Fused mode: write userid-artist-counts.csv directly.
+            process_user_artist_counts(args.userid_msid_csv, args.filtered_mapping_csv, args.redirect_file,
+                                       args.metadata_file, args.output_csv, index_dir=args.index_dir,
+                                       since=args.since, until=args.until)
+        else:
+            process_user_artist(args.userid_msid_csv, args.filtered_mapping_csv, args.redirect_file,
+                                args.metadata_file, args.output_csv, index_dir=args.index_dir,
+                                since=args.since, until=args.until)
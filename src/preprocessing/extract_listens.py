@@ -4,31 +4,73 @@ extract_listens.py
 ------------------
 This script reads a ListenBrainz JSON Lines file, inspects its structure by printing
 a few sample records, and then extracts the 'user_id' and 'recording_msid' fields into a CSV file.
+Additional top-level fields (e.g. 'listened_at') can be projected with --fields, and a faster
+parsing engine that only decodes the projected fields can be selected with --engine
+(see src/utils/json_fields.py).
+
+When the input is a directory or a glob pattern (e.g. "/mnt/j/MusicBrainz/*.listens.zst"),
+all matching dumps are extracted in parallel on a process pool: one worker per compressed
+file, or per byte range for large uncompressed files. Each shard is written to its own CSV
+in "<output_csv stem>.shards/" and the shards are then merged into <output_csv>.
+
+The output format follows the output path: ".csv" (default), ".parquet" or ".npcols"
+(see src/utils/columnar.py). A ".months" output is a month-partitioned listen store: the
+listens are kept with their listened_at and written to one table per month, so later stages
+can read a date range without scanning the whole history.
+
+A listen is kept only if it has the required fields (user_id and recording_msid, plus
+listened_at for a .months output) and every numeric field projected with --fields (e.g.
+listened_at): such a field has no value to store in the int64 columns of the binary formats,
+so the listens missing one are left out of every format alike, and the CSV holds the same rows.
 
 Usage:
-    python extract_listens.py <input_file> <output_csv>
+    python extract_listens.py <input_file_dir_or_glob> <output_csv> [--workers N]
+                              [--fields user_id,recording_msid,...] [--engine json|orjson|scan]
+                              [--metrics REPORT_JSON]
 
 Example:
     python extract_listens.py /mnt/j/MusicBrainz/1.listens.zst /mnt/j/MusicBrainz/working/userid-msid.csv
+    python extract_listens.py "/mnt/j/MusicBrainz/*.listens.zst" /mnt/j/MusicBrainz/working/userid-msid.csv --workers 8
+    python extract_listens.py /mnt/j/MusicBrainz/1.listens.zst /mnt/j/MusicBrainz/working/userid-msid.csv \
+                              --fields user_id,recording_msid,listened_at --engine scan
+    python extract_listens.py "/mnt/j/MusicBrainz/*.listens.zst" /mnt/j/MusicBrainz/working/userid-msid.months
 """
 
+import argparse
+import glob
 import json
-import csv
 import sys
 import os
-import subprocess
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.utils.columnar import (MONTHS_SUFFIX, NPCOLS_SUFFIX, PARQUET_SUFFIX, TIME_COLUMN, PartitionedWriter,
+                                column_kind, concat_tables, is_partitioned, open_table_writer, table_format)
+from src.utils.config import COMPRESSED_EXTENSION, CSV_CHUNK_ROWS
+from src.utils.file_utils import iter_byte_range, open_input, plan_shards
+from src.utils.instrumentation import count_rows, measure
+from src.utils.json_fields import ENGINES, make_record_parser
+
+# Fields extracted by default; a listen is only kept if all of them are present.
+REQUIRED_FIELDS = ('user_id', 'recording_msid')
+
 def inspect_file(input_file, num_lines=5):
     """
     Reads and prints the first few lines of the JSON Lines file to inspect its structure.
 
     Parameters:
-        input_file (str): Path to the JSON Lines file.
+        input_file (str): Path to the JSON Lines file (plain or .zst compressed).
         num_lines (int): Number of lines to inspect.
     """
     print(f"Inspecting the first {num_lines} lines of {input_file}:")
-    with open(input_file, 'r', encoding='utf-8') as infile:
+    with open_input(input_file) as infile:
         for i in range(num_lines):
             line = infile.readline().strip()
             if not line:
@@ -39,77 +81,228 @@ def inspect_file(input_file, num_lines=5):
             except json.JSONDecodeError as e:
                 print(f"Error decoding line {i+1}: {e}")
 
-def extract_listen_events(input_file, output_csv):
+def required_fields(partitioned=False):
+    """
+    Returns the fields a listen must have to be kept: REQUIRED_FIELDS, plus listened_at for a
+    month-partitioned output (it selects the partition).
+    """
+    return list(REQUIRED_FIELDS) + ([TIME_COLUMN] if partitioned else [])
+
+def output_fields(fields=None, partitioned=False):
+    """
+    Returns the list of fields to project: the required fields followed by any extra ones.
+    """
+    required = required_fields(partitioned)
+    extra = [field for field in (fields or []) if field not in required]
+    return required + extra
+
+def write_listen_rows(lines, writer, fields=None, engine="json"):
     """
-    Reads the ListenBrainz JSON Lines file, extracts user_id and recording_msid,
-    and writes the results to a CSV file. Displays a progress bar indicating the progress.
+    Parses JSON Lines records and writes the projected fields to a table writer.
 
     Parameters:
-        input_file (str): Path to the JSON Lines input file.
-        output_csv (str): Path to the CSV file to output extracted data.
+        lines (iterable): JSON Lines records (str or bytes).
+        writer (TableWriter): Writer receiving one row per valid listen (in chunks); a
+                              PartitionedWriter also gets (and requires) listened_at.
+        fields (list): Fields to project (defaults to user_id and recording_msid).
+        engine (str): Parsing engine, one of json, orjson or scan.
+
+    Listens missing a required field, or a numeric (int or float column) extra field, are
+    skipped (see the module docstring).
+
+    Returns:
+        tuple: (total_lines, extracted_lines)
     """
+    partitioned = isinstance(writer, PartitionedWriter)
+    fields = output_fields(fields, partitioned)
+    parse = make_record_parser(fields, engine)
+    num_required = len(required_fields(partitioned))
+    # Positions of the values a listen must have: the required fields and the numeric extra ones
+    # (a value of 0, e.g. listened_at, counts as present).
+    checked = list(range(num_required)) + [i for i in range(num_required, len(fields))
+                                           if column_kind(fields[i]) in ("int", "float")]
     total_lines = 0
     extracted_lines = 0
+    rows = []
+    for line in lines:
+        total_lines += 1
+        try:
+            values = parse(line)
+            
+            if all(values[i] is not None and values[i] != "" for i in checked):
+                rows.append(values)
+                extracted_lines += 1
+                if len(rows) == CSV_CHUNK_ROWS:
+                    writer.write_rows(rows)
+                    rows = []
+        except json.JSONDecodeError as e:
+            print(f"Error parsing line {total_lines}: {e}")
+    writer.write_rows(rows)
+    return total_lines, extracted_lines
+
+def extract_listen_events(input_file, output_csv, fields=None, engine="json"):
+    """
+    Reads the ListenBrainz JSON Lines file, extracts user_id and recording_msid (plus any
+    extra fields requested), and writes the results to a CSV file. Displays a progress bar
+    indicating the progress.
+
+    Compressed (.zst) inputs are decompressed as a stream while reading; the progress
+    bar then tracks the compressed bytes read from disk.
 
+    Parameters:
+        input_file (str): Path to the JSON Lines input file (plain or .zst compressed).
+        output_csv (str): Path to the CSV file to output extracted data (or a .months store).
+        fields (list): Extra top-level fields to project, e.g. ['listened_at'].
+        engine (str): Parsing engine, one of json, orjson or scan.
+    """
     # Ensure the output directory exists
     os.makedirs(os.path.dirname(output_csv), exist_ok=True)
+    partitioned = is_partitioned(output_csv)
 
     # Get the total size of the file in bytes for the progress bar.
     total_size = os.path.getsize(input_file)
 
-    with open(input_file, 'r', encoding='utf-8') as infile, \
-         open(output_csv, 'w', newline='', encoding='utf-8') as outfile:
-        
-        writer = csv.writer(outfile)
-        writer.writerow(['user_id', 'recording_msid'])
+    # Create a progress bar based on file size; it is advanced by the bytes read from disk.
+    with tqdm(total=total_size, unit='B', unit_scale=True, desc="Processing") as pbar, \
+         open_input(input_file, progress=pbar.update, binary_mode=engine != "json") as infile, \
+         open_table_writer(output_csv, output_fields(fields, partitioned)) as writer:
         
-        # Create a progress bar based on file size
-        with tqdm(total=total_size, unit='B', unit_scale=True, desc="Processing") as pbar:
-            for line in infile:
-                total_lines += 1
-                # Update progress bar by the number of bytes in the line
-                pbar.update(len(line))
-                try:
-                    record = json.loads(line)
-                    user_id = record.get('user_id')
-                    recording_msid = record.get('recording_msid')
-                    
-                    if user_id and recording_msid:
-                        writer.writerow([user_id, recording_msid])
-                        extracted_lines += 1
-                except json.JSONDecodeError as e:
-                    print(f"Error parsing line {total_lines}: {e}")
+        total_lines, extracted_lines = write_listen_rows(infile, writer, fields, engine)
+    count_rows(total_lines)
     
     print(f"\nFinished processing {total_lines} lines.")
     print(f"Extracted {extracted_lines} valid records to '{output_csv}'.")
 
-def decompress_if_needed(input_path):
+def find_listen_dumps(input_spec):
+    """
+    Resolves a directory or glob pattern into a sorted list of listen dump files.
+
+    Parameters:
+        input_spec (str): A directory (all "*.listens" / "*.listens.zst" files in it are used),
+                          a glob pattern, or a single file path.
+
+    Returns:
+        list: Sorted list of file paths.
+    """
+    if os.path.isdir(input_spec):
+        patterns = [os.path.join(input_spec, "*.listens"),
+                    os.path.join(input_spec, "*.listens" + COMPRESSED_EXTENSION)]
+        files = [path for pattern in patterns for path in glob.glob(pattern)]
+    else:
+        files = glob.glob(input_spec)
+    return sorted(files)
+
+def extract_shard(shard, shard_csv, fields=None, engine="json"):
+    """
+    Worker entry point: extracts one shard to its own table (CSV with header, or binary).
+
+    Returns:
+        dict: Shard statistics (lines, extracted, seconds, worker pid).
+    """
+    input_file, start, end = shard
+    started = time.perf_counter()
+    with open_table_writer(shard_csv, output_fields(fields, is_partitioned(shard_csv))) as writer:
+        if start is None:
+            with open_input(input_file, binary_mode=engine != "json") as infile:
+                total_lines, extracted_lines = write_listen_rows(infile, writer, fields, engine)
+        else:
+            lines = iter_byte_range(input_file, start, end)
+            total_lines, extracted_lines = write_listen_rows(lines, writer, fields, engine)
+    return {
+        "shard_csv": shard_csv,
+        "lines": total_lines,
+        "extracted": extracted_lines,
+        "seconds": time.perf_counter() - started,
+        "pid": os.getpid(),
+    }
+
+def extract_shards(shards, shard_csvs, num_workers, fields=None, engine="json"):
+    """
+    Extracts shards (see plan_shards) to their tables on a process pool, reporting the
+    throughput of each shard as it completes.
+
+    Returns:
+        list: The statistics returned by extract_shard, in completion order.
     """
-    Checks if the input file is compressed (.zst) and decompresses it if needed.
-    Returns the path to the decompressed file.
+    results = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(extract_shard, shard, shard_csv, fields, engine) for shard, shard_csv in zip(shards, shard_csvs)]
+        for future in tqdm(as_completed(futures), total=len(futures), unit="shard", desc="Extracting"):
+            result = future.result()
+            results.append(result)
+            rate = result["lines"] / result["seconds"] if result["seconds"] else 0.0
+            tqdm.write(f"{os.path.basename(result['shard_csv'])}: {result['lines']} lines "
+                       f"in {result['seconds']:.1f}s ({rate:,.0f} lines/sec)")
+    return results
+
+def extract_listen_events_parallel(input_spec, output_csv, num_workers=None, fields=None, engine="json"):
     """
-    if input_path.endswith('.zst'):
-        # Remove exactly 4 characters (".zst") from the end
-        decompressed_path = input_path[:-4]
-        if not os.path.exists(decompressed_path):
-            print(f"Decompressing {input_path} to {decompressed_path} ...")
-            subprocess.run(["unzstd", input_path], check=True)
-        return decompressed_path
-    return input_path
+    Extracts user_id and recording_msid from every listen dump matching input_spec
+    on a process pool, writes one table per shard and merges them into output_csv.
+    Reports throughput in lines/sec per shard and per worker.
+
+    Parameters:
+        input_spec (str): Directory or glob pattern of listen dumps.
+        output_csv (str): Path of the merged CSV output (or .months store, merged month by month).
+        num_workers (int): Number of worker processes (defaults to the CPU count).
+        fields (list): Extra top-level fields to project, e.g. ['listened_at'].
+        engine (str): Parsing engine, one of json, orjson or scan.
+    """
+    input_files = find_listen_dumps(input_spec)
+    if not input_files:
+        raise FileNotFoundError(f"No listen dumps found for {input_spec}")
+    num_workers = num_workers or os.cpu_count()
+    shards = plan_shards(input_files, num_workers)
+
+    shard_dir = os.path.splitext(output_csv.rstrip("/\\"))[0] + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    suffix = {"parquet": PARQUET_SUFFIX, "npcols": NPCOLS_SUFFIX,
+              "months": MONTHS_SUFFIX}.get(table_format(output_csv), ".csv")
+    shard_csvs = [
+        os.path.join(shard_dir, f"{os.path.basename(input_file)}-{i:04d}{suffix}")
+        for i, (input_file, _, _) in enumerate(shards)
+    ]
+    print(f"Extracting {len(input_files)} files as {len(shards)} shards with {num_workers} workers")
+
+    started = time.perf_counter()
+    results = extract_shards(shards, shard_csvs, num_workers, fields, engine)
+    elapsed = time.perf_counter() - started
+    worker_lines = defaultdict(int)
+    worker_seconds = defaultdict(float)
+    for result in results:
+        worker_lines[result["pid"]] += result["lines"]
+        worker_seconds[result["pid"]] += result["seconds"]
+
+    concat_tables(shard_csvs, output_csv)
+
+    for pid in sorted(worker_lines):
+        rate = worker_lines[pid] / worker_seconds[pid] if worker_seconds[pid] else 0.0
+        print(f"Worker {pid}: {worker_lines[pid]} lines, {rate:,.0f} lines/sec")
+    total_lines = sum(r["lines"] for r in results)
+    extracted_lines = sum(r["extracted"] for r in results)
+    count_rows(total_lines)
+    print(f"\nFinished processing {total_lines} lines in {elapsed:.1f}s ({total_lines / elapsed:,.0f} lines/sec overall).")
+    print(f"Extracted {extracted_lines} valid records to '{output_csv}' (shards in '{shard_dir}').")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python extract_listens.py <input_file> <output_csv>")
-        sys.exit(1)
-    
-    raw_input_file = sys.argv[1]
-    output_csv = sys.argv[2]
-    
-    # Decompress the file if needed
-    input_file = decompress_if_needed(raw_input_file)
-    
-    # Inspect the file structure by printing the first few lines
-    inspect_file(input_file, num_lines=5)
-    
-    # Extract data to CSV with a progress bar
-    extract_listen_events(input_file, output_csv)
+    parser = argparse.ArgumentParser(description="Extract user_id and recording_msid from ListenBrainz listen dumps.")
+    parser.add_argument("input", help="Listen dump file, or a directory / glob pattern of dumps for parallel extraction")
+    parser.add_argument("output_csv", help="Output path (.csv, .parquet, .npcols or a .months listen store)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (parallel mode)")
+    parser.add_argument("--fields", default=",".join(REQUIRED_FIELDS),
+                        help="Comma-separated top-level fields to project (user_id and recording_msid are always included)")
+    parser.add_argument("--engine", choices=ENGINES, default="json", help="JSON parsing engine")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
+    fields = [field.strip() for field in args.fields.split(",") if field.strip()]
+
+    if os.path.isfile(args.input) and args.workers is None:
+        # Inspect the file structure by printing the first few lines
+        inspect_file(args.input, num_lines=5)
+        
+        # Extract data to CSV with a progress bar
+        with measure("extract_listens", args.metrics):
+            extract_listen_events(args.input, args.output_csv, fields, args.engine)
+    else:
+        with measure("extract_listens", args.metrics):
+            extract_listen_events_parallel(args.input, args.output_csv, args.workers, fields, args.engine)
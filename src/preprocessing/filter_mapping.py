@@ -5,19 +5,36 @@ filter_mapping.py
 This script filters the ListenBrainz MSID mapping file by keeping only the rows corresponding
 to the MSIDs present in our 'userid-msid.csv' file and meeting a specified quality criterion.
 It outputs a smaller mapping file that can be loaded into memory for subsequent processing.
+Lines are prefiltered on their raw MSID with a hashed bitmap before CSV parsing, and large
+uncompressed mapping files are filtered in parallel byte ranges.
+Input and output tables may be CSV, Parquet or .npcols (see src/utils/columnar.py).
+
+The unique MSIDs are held as 16-byte binary keys (see src/utils/interning.py) and saved to
+"dictionaries/msids.npy" next to the output so later stages can reuse them.
+
+With --index-dir, the mapping dump is not scanned: the MSIDs are binary-searched in a
+memory-mapped index of the dump (see src/utils/lookup_store.py), built on the first run or by
+build_indexes.py, and rebuilt only when the dump's size or mtime changes. The output keeps the
+recording_msid, recording_mbid and match_type columns, in dump order.
 
 Usage:
     python filter_mapping.py <userid_msid_csv> <msid_mapping_file> <output_filtered_mapping_csv>
+                             [--workers N] [--index-dir DIR] [--metrics REPORT_JSON]
 
 Example:
-    python filter_mapping.py /mnt/j/MusicBrainz/working/userid-msid.csv \
-                              /mnt/j/MusicBrainz/listenbrainz_msid_mapping.csv-003.zst \
+    python filter_mapping.py /mnt/j/MusicBrainz/working/userid-msid.csv \\
+                              /mnt/j/MusicBrainz/listenbrainz_msid_mapping.csv-003.zst \\
                               /mnt/j/MusicBrainz/working/small_msid_mapping.csv
 """
 
+import argparse
 import sys
 import os
 import csv
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 from tqdm import tqdm
 
 # Ensure the project root is in sys.path
@@ -25,79 +42,259 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
-from src.utils.file_utils import decompress_if_needed
+from src.utils.config import CSV_CHUNK_ROWS, DICTIONARY_DIRNAME
+from src.utils.file_utils import csv_column, iter_byte_range_blocks, iter_line_blocks, open_input, plan_shards
+from src.utils.columnar import (NPCOLS_SUFFIX, NULL_KEY, PARQUET_SUFFIX, TableWriter, concat_tables,
+                                iter_table, table_format)
+from src.utils.instrumentation import count_rows, measure
+from src.utils.interning import KeyBitmap, UuidDictionary, uuid_keys, uuid_prefixes
+from src.utils.lookup_store import MAPPING_COLUMNS, MsidMappingIndex, invalidate, is_current, mark_built
 
-def load_unique_msids(userid_msid_csv):
+def load_unique_msids(userid_msid_csv, dictionary_path=None):
     """
     Loads the unique MSIDs from the provided CSV file.
 
     Parameters:
-        userid_msid_csv (str): Path to the CSV file containing columns "user_id" and "recording_msid".
+        userid_msid_csv (str): Path to the table (.csv, .parquet or .npcols) containing columns
+                               "user_id" and "recording_msid".
+        dictionary_path (str): Optional .npy path where the MSID dictionary is persisted. It is
+                               reused instead of re-reading the CSV while the CSV keeps the
+                               same size and mtime.
 
     Returns:
-        A set of unique MSID strings.
-    """
-    unique_msids = set()
-    with open(userid_msid_csv, "r", encoding="utf-8") as fp:
-        reader = csv.DictReader(fp)
-        for row in reader:
-            msid = row["recording_msid"]
-            unique_msids.add(msid)
+        A UuidDictionary of the unique MSIDs.
+    """
+    manifest_prefix = os.path.splitext(dictionary_path)[0] if dictionary_path else None
+    if dictionary_path and is_current(manifest_prefix, userid_msid_csv):
+        unique_msids = UuidDictionary.load(dictionary_path)
+        print(f"Loaded {len(unique_msids)} unique MSIDs from {dictionary_path}")
+        return unique_msids
+    if dictionary_path:
+        invalidate(manifest_prefix)
+
+    key_chunks = []
+    for chunk in iter_table(userid_msid_csv, ["recording_msid"]):
+        keys = chunk["recording_msid"]
+        # Deduplicate per chunk to keep the intermediate arrays small.
+        key_chunks.append(np.unique(keys[keys != NULL_KEY]))
+    unique_msids = UuidDictionary.from_keys(key_chunks)
     print(f"Loaded {len(unique_msids)} unique MSIDs from {userid_msid_csv}")
+    if dictionary_path:
+        unique_msids.save(dictionary_path)
+        mark_built(manifest_prefix, userid_msid_csv, rows=len(unique_msids))
     return unique_msids
 
-def filter_mapping(userid_msid_csv, mapping_file, output_file, acceptable_qualities={"exact_match", "high_quality"}):
+def _candidate_lines(lines, msid_bitmap, unique_msids):
+    """
+    Prefilter on raw mapping lines whose first field is the MSID: returns the indices of the
+    lines worth parsing as CSV. Only the first 16 hex digits of each line are decoded and
+    hashed into the bitmap; the full MSID of the few hits is then checked exactly. A line can
+    only be kept if it starts with "<msid>," or with a quoted field, so quoted lines are
+    always left to the CSV parser and every other line is safely dropped.
+    """
+    raw = np.array(lines, dtype="S37")
+    chars = raw.view(np.uint8).reshape(-1, 37)
+    prefixes, valid = uuid_prefixes(raw)
+    hit = valid & (chars[:, 36] == ord(","))
+    hit[hit] = msid_bitmap.might_contain_prefixes(prefixes[hit])
+    keys, valid = uuid_keys(raw[hit].astype("S36"))
+    hit[hit] = valid & unique_msids.contains_keys(keys)
+    return np.flatnonzero(hit | (chars[:, 0] == ord('"')))
+
+def _filter_rows(rows, unique_msids, msid_col, quality_col, acceptable, num_columns):
+    """
+    Exact filter on parsed rows: returns the rows with a known MSID and an acceptable match
+    quality, padded to num_columns like csv.DictReader/DictWriter would.
+    """
+    keys, valid = uuid_keys(csv_column(rows, msid_col))
+    keep = valid & unique_msids.contains_keys(keys)
+    keep &= np.isin(np.array(csv_column(rows, quality_col), dtype=object), acceptable)
+    return [rows[i] + [""] * (num_columns - len(rows[i])) for i in np.flatnonzero(keep)]
+
+def scan_mapping_lines(line_blocks, header, unique_msids, acceptable_qualities, writer):
+    """
+    Filters blocks of raw mapping lines (bytes, see file_utils.iter_line_blocks) into writer.
+    Only the lines passing the MSID prefilter are decoded and parsed as CSV.
+
+    Returns:
+        tuple: (total_rows, kept_rows)
+    """
+    msid_col = header.index("recording_msid")
+    quality_col = header.index("match_type")
+    acceptable = np.array(sorted(acceptable_qualities), dtype=object)
+    # The raw-line prefilter needs the MSID to be the first field.
+    msid_bitmap = KeyBitmap.from_keys(unique_msids.keys) if msid_col == 0 else None
+
+    total_rows = 0
+    kept_rows = 0
+    for lines in line_blocks:
+        total_rows += len(lines) - lines.count(b"")
+        if msid_bitmap is not None:
+            lines = [lines[i] for i in _candidate_lines(lines, msid_bitmap, unique_msids)]
+        rows = [row for row in csv.reader(line.decode("utf-8", "replace") for line in lines) if row]
+        kept = _filter_rows(rows, unique_msids, msid_col, quality_col, acceptable, len(header))
+        writer.write_rows(kept)
+        kept_rows += len(kept)
+    return total_rows, kept_rows
+
+def _read_header(infile):
+    """Reads and parses the header line of a binary mapping file object."""
+    return next(csv.reader([infile.readline().decode("utf-8", "replace")]))
+
+def filter_shard(shard, dictionary_path, acceptable_qualities, shard_output):
+    """
+    Worker entry point: filters the lines of one byte range of an uncompressed mapping file
+    into its own table.
+
+    Returns:
+        dict: Shard statistics (rows, kept, bytes, seconds).
+    """
+    mapping_file, start, end = shard
+    started = time.perf_counter()
+    unique_msids = UuidDictionary.load(dictionary_path)
+    with open(mapping_file, "rb") as infile:
+        header = _read_header(infile)
+        header_size = infile.tell()
+    with TableWriter(shard_output, header) as writer:
+        blocks = iter_byte_range_blocks(mapping_file, max(start, header_size), end)
+        total_rows, kept_rows = scan_mapping_lines(blocks, header, unique_msids, acceptable_qualities, writer)
+    return {
+        "rows": total_rows,
+        "kept": kept_rows,
+        "bytes": end - start,
+        "seconds": time.perf_counter() - started,
+    }
+
+def filter_mapping(userid_msid_csv, mapping_file, output_file, acceptable_qualities={"exact_match", "high_quality"},
+                   index_dir=None, num_workers=None):
     """
     Filters the ListenBrainz MSID mapping file to include only rows with MSIDs present in our extracted CSV
     and with an acceptable match quality.
     
+    The mapping file is read in large blocks of raw lines. A hashed bitmap of the wanted MSIDs
+    (see interning.KeyBitmap) rejects most lines before any CSV parsing, so only the few
+    matching rows are decoded. Uncompressed mapping files larger than PARALLEL_CHUNK_SIZE are
+    split into byte ranges filtered on a process pool, and the per-range outputs are merged
+    in file order; compressed files are filtered as one stream.
+    
     Parameters:
         userid_msid_csv (str): Path to the CSV with user_id and recording_msid.
         mapping_file (str): Path to the large ListenBrainz MSID mapping file.
-        output_file (str): Path where the filtered mapping CSV will be written.
+        output_file (str): Path where the filtered mapping will be written (.csv, .parquet or .npcols).
         acceptable_qualities (set): Set of acceptable quality levels.
+        index_dir (str): Optional directory of the mapping index; when given, the index is used
+                         (and built if missing or stale) instead of scanning mapping_file.
+        num_workers (int): Number of worker processes for byte-range filtering (defaults to the CPU count).
         
     The mapping file is assumed to have a header with at least these columns:
         recording_msid, recording_mbid, match_type, ...
+    and no line breaks inside fields.
     """
-    # Decompress the mapping file if needed
-    mapping_file = decompress_if_needed(mapping_file)
-    
-    unique_msids = load_unique_msids(userid_msid_csv)
-    
-    total_rows = 0
-    kept_rows = 0
+    dictionary_dir = os.path.join(os.path.dirname(output_file), DICTIONARY_DIRNAME)
+    dictionary_path = os.path.join(dictionary_dir, "msids.npy")
+    unique_msids = load_unique_msids(userid_msid_csv, dictionary_path)
+    count_rows(filter_mapping_msids(unique_msids, dictionary_path, mapping_file, output_file, acceptable_qualities,
+                                    index_dir, num_workers))
+
+def filter_mapping_msids(unique_msids, dictionary_path, mapping_file, output_file,
+                         acceptable_qualities={"exact_match", "high_quality"}, index_dir=None, num_workers=None):
+    """
+    Same as filter_mapping, for a given UuidDictionary of MSIDs saved at dictionary_path
+    (where the parallel workers load it from).
+
+    Returns:
+        int: Number of mapping rows read (scanned, or selected from the index).
+    """
+    if index_dir:
+        return filter_mapping_indexed(unique_msids, mapping_file, output_file, acceptable_qualities, index_dir)
 
     # Ensure the output directory exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    with open(mapping_file, "r", encoding="utf-8", errors="replace") as infile, \
-         open(output_file, "w", newline='', encoding="utf-8") as outfile:
-        
-        reader = csv.DictReader(infile)
-        writer = csv.DictWriter(outfile, fieldnames=reader.fieldnames)
-        writer.writeheader()
-        
-        # Iterate over the mapping file with a progress bar
-        for row in tqdm(reader, desc="Filtering mapping file"):
-            total_rows += 1
-            # Use the correct column names: "recording_msid" and "match_type"
-            msid = row.get("recording_msid")
-            quality = row.get("match_type")
-            if msid in unique_msids and quality in acceptable_qualities:
-                writer.writerow(row)
-                kept_rows += 1
+    started = time.perf_counter()
+    shards = plan_shards([mapping_file], num_workers or os.cpu_count())
+    if len(shards) == 1:
+        # The mapping file (plain or .zst) is decompressed on the fly while reading.
+        with tqdm(total=os.path.getsize(mapping_file), unit="B", unit_scale=True,
+                  desc="Filtering mapping file") as pbar, \
+             open_input(mapping_file, progress=pbar.update, binary_mode=True) as infile:
+            header = _read_header(infile)
+            with TableWriter(output_file, header) as writer:
+                total_rows, kept_rows = scan_mapping_lines(iter_line_blocks(infile), header, unique_msids,
+                                                           acceptable_qualities, writer)
+    else:
+        total_rows, kept_rows = _filter_mapping_parallel(shards, dictionary_path, output_file,
+                                                         acceptable_qualities, num_workers)
+    elapsed = time.perf_counter() - started
 
+    size_mb = os.path.getsize(mapping_file) / 2**20
     print(f"Processed {total_rows} rows from {mapping_file}")
+    print(f"Filtered {size_mb:,.0f} MB in {elapsed:.1f}s ({size_mb / elapsed:,.1f} MB/s, "
+          f"{total_rows / elapsed:,.0f} rows/sec)")
     print(f"Kept {kept_rows} rows in the filtered mapping file: {output_file}")
+    return total_rows
+
+def _filter_mapping_parallel(shards, dictionary_path, output_file, acceptable_qualities, num_workers):
+    """
+    Filters the byte ranges of an uncompressed mapping file on a process pool, then merges
+    the per-range tables into output_file.
+
+    Returns:
+        tuple: (total_rows, kept_rows)
+    """
+    shard_dir = os.path.splitext(output_file.rstrip("/\\"))[0] + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    suffix = {"parquet": PARQUET_SUFFIX, "npcols": NPCOLS_SUFFIX}.get(table_format(output_file), ".csv")
+    shard_outputs = [os.path.join(shard_dir, f"mapping-{i:04d}{suffix}") for i in range(len(shards))]
+    print(f"Filtering {len(shards)} byte ranges with {num_workers or os.cpu_count()} workers")
+
+    total_rows = 0
+    kept_rows = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(filter_shard, shard, dictionary_path, acceptable_qualities, shard_output)
+                   for shard, shard_output in zip(shards, shard_outputs)]
+        for future in tqdm(as_completed(futures), total=len(futures), unit="range", desc="Filtering mapping file"):
+            result = future.result()
+            total_rows += result["rows"]
+            kept_rows += result["kept"]
+            rate = result["bytes"] / 2**20 / result["seconds"] if result["seconds"] else 0.0
+            tqdm.write(f"{result['rows']} rows in {result['seconds']:.1f}s ({rate:,.1f} MB/s)")
+
+    concat_tables(shard_outputs, output_file)
+    shutil.rmtree(shard_dir)
+    return total_rows, kept_rows
+
+def filter_mapping_indexed(unique_msids, mapping_file, output_file, acceptable_qualities, index_dir):
+    """
+    Same as filter_mapping, but reads the rows from the memory-mapped index of mapping_file
+    in index_dir instead of scanning the dump.
+
+    Returns:
+        int: Number of rows selected.
+    """
+    index, built = MsidMappingIndex.open(os.path.join(index_dir, "msid_mapping"), mapping_file)
+    print(f"{'Built' if built else 'Opened'} the mapping index of {mapping_file} ({len(index)} rows)")
+    positions = index.select(unique_msids.keys, acceptable_qualities)
+
+    with TableWriter(output_file, MAPPING_COLUMNS) as writer:
+        for start in tqdm(range(0, len(positions), CSV_CHUNK_ROWS), desc="Writing filtered mapping", unit="chunk"):
+            writer.write_rows(index.rows_at(positions[start:start + CSV_CHUNK_ROWS]))
+
+    print(f"Kept {len(positions)} rows in the filtered mapping file: {output_file}")
+    return len(positions)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python filter_mapping.py <userid_msid_csv> <msid_mapping_file> <output_filtered_mapping_csv>")
-        sys.exit(1)
-    
-    userid_msid_csv = sys.argv[1]
-    mapping_file = sys.argv[2]
-    output_file = sys.argv[3]
+    parser = argparse.ArgumentParser(description="Filter the MSID mapping to the MSIDs present in the listens.")
+    parser.add_argument("userid_msid_csv", help="Path to the userid-msid table")
+    parser.add_argument("mapping_file", help="Path to the ListenBrainz MSID mapping dump")
+    parser.add_argument("output_file", help="Path of the filtered mapping to write")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes for filtering byte ranges of an uncompressed mapping file")
+    parser.add_argument("--index-dir", default=None,
+                        help="Use (and build if needed) a memory-mapped index of the mapping dump in this directory")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
 
-    filter_mapping(userid_msid_csv, mapping_file, output_file)
+    with measure("filter_mapping", args.metrics):
+        filter_mapping(args.userid_msid_csv, args.mapping_file, args.output_file, index_dir=args.index_dir,
+                       num_workers=args.workers)
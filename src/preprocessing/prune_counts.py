@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+prune_counts.py
+---------------
+This script removes the long tail of a userid-artist-counts table before ALS training: the
+artists listened to by too few users and the users with too few artists or plays. They add
+rows and columns to the factor matrices (and training time) without carrying co-listening
+signal.
+
+The minimum supports are applied together and repeatedly until they are stable, since
+dropping an artist can take a user below its minimum and the other way round (see
+min_support_masks in src/utils/matrix_store.py). The counts are streamed into the play matrix
+(distinct pairs, summed over the months of a .months store), the passes stream the matrix in
+blocks, and the rows of the survivors are then copied from the input table to the output,
+chunk by chunk, in the format of its path. A ".months" output keeps the month partitions of a
+".months" input. The matrix built from the output has only the surviving users and artists,
+so its rows and columns are re-indexed densely.
+
+The resulting matrix shape and number of non-zero entries are reported, with the share of
+the factor memory and of the per-iteration ALS work saved (see benchmarks/bench_prune.py for
+measured training times).
+
+Usage:
+    python prune_counts.py <input_user_artist_counts> <output_user_artist_counts>
+                           [--min-artist-users N] [--min-user-artists N] [--min-user-plays N]
+                           [--min-artist-plays N] [--since DATE] [--until DATE]
+                           [--report REPORT_JSON] [--metrics REPORT_JSON]
+
+Example:
+    python prune_counts.py /mnt/j/MusicBrainz/working/userid-artist-counts.csv /mnt/j/MusicBrainz/working/userid-artist-counts-pruned.csv --min-artist-users 5 --min-user-artists 5
+"""
+
+import argparse
+import json
+import sys
+import os
+
+import numpy as np
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.utils.columnar import is_partitioned, iter_table, map_partitions, open_table_writer
+from src.utils.instrumentation import count_rows, measure
+from src.utils.matrix_store import COUNT_COLUMNS, PlayMatrix, min_support_masks
+
+# Default minimum supports: drop the artists heard by a single user and the users of a single artist
+MIN_ARTIST_USERS = 2
+MIN_USER_ARTISTS = 2
+# Factors of the ALS model the savings are estimated for (ALS_PARAMS of listenbrainz_model.py)
+ESTIMATE_FACTORS = 64
+
+def matrix_stats(num_users, num_artists, nnz, factors=ESTIMATE_FACTORS):
+    """
+    Shape and size of a play matrix, with the size of its ALS factors and the cost of an ALS
+    iteration in multiply-adds (nnz * factors^2 to accumulate the normal equations, plus one
+    factors^3 solve per user and artist).
+    """
+    return {"users": int(num_users), "artists": int(num_artists), "nnz": int(nnz),
+            "factor_mb": (num_users + num_artists) * factors * 4 / 2**20,
+            "iteration_flops": float(nnz * factors**2 + (num_users + num_artists) * factors**3)}
+
+def _write_filtered(source, destination, users, artists, since=None, until=None):
+    """Writes the rows of source whose user_id is in users and artist_id in artists (sorted arrays)."""
+    def keep(values, sorted_values):
+        positions = np.minimum(np.searchsorted(sorted_values, values), max(len(sorted_values) - 1, 0))
+        return sorted_values[positions] == values if len(sorted_values) else np.zeros(len(values), dtype=bool)
+
+    with open_table_writer(destination, COUNT_COLUMNS) as writer:
+        for chunk in iter_table(source, COUNT_COLUMNS, since=since, until=until):
+            rows = keep(chunk["user_id"], users) & keep(chunk["artist_id"], artists)
+            writer.write_columns({name: chunk[name][rows] for name in COUNT_COLUMNS})
+
+def prune_counts(input_file, output_file, min_artist_users=MIN_ARTIST_USERS, min_user_artists=MIN_USER_ARTISTS,
+                 min_user_plays=0, min_artist_plays=0, since=None, until=None, report_file=None):
+    """
+    Writes the rows of a counts table whose user and artist meet the minimum supports.
+
+    Parameters:
+        input_file (str): userid-artist-counts table (.csv, .parquet, .npcols or a .months store).
+        output_file (str): Pruned table; a .months output needs a .months input.
+        min_artist_users (int): Minimum number of users of an artist.
+        min_user_artists (int): Minimum number of artists of a user.
+        min_user_plays (int): Minimum total listen count of a user.
+        min_artist_plays (int): Minimum total listen count of an artist.
+        since, until: Optional date range [since, until) of a .months input (whole months).
+        report_file (str): Optional JSON file to save the statistics to.
+
+    Returns:
+        dict: The statistics of the input and pruned matrices.
+    """
+    matrix = PlayMatrix.build(input_file, since=since, until=until)
+    count_rows(matrix.plays.nnz)
+    keep_users, keep_artists, passes = min_support_masks(matrix.plays, min_artist_users, min_user_artists,
+                                                         min_user_plays, min_artist_plays)
+    users = np.sort(matrix.users[keep_users])
+    artists = matrix.artists[keep_artists]
+    plays = matrix.plays
+    kept_entries = int((np.repeat(keep_users, np.diff(plays.indptr)) & keep_artists[plays.indices]).sum())
+
+    if is_partitioned(output_file):
+        map_partitions(input_file, output_file, COUNT_COLUMNS,
+                       lambda path, start, end: _write_filtered(input_file, path, users, artists, start, end),
+                       since, until)
+    else:
+        _write_filtered(input_file, output_file, users, artists, since, until)
+
+    before = matrix_stats(*matrix.plays.shape, matrix.plays.nnz)
+    after = matrix_stats(len(users), len(artists), kept_entries)
+    stats = {"input": os.path.abspath(input_file), "output": os.path.abspath(output_file),
+             "thresholds": {"min_artist_users": min_artist_users, "min_user_artists": min_user_artists,
+                            "min_user_plays": min_user_plays, "min_artist_plays": min_artist_plays},
+             "passes": passes, "before": before, "after": after}
+    print(f"Pruned in {passes} passes: {before['users']:,} x {before['artists']:,} ({before['nnz']:,} entries) "
+          f"-> {after['users']:,} x {after['artists']:,} ({after['nnz']:,} entries)")
+    for key, label in (("users", "users"), ("artists", "artists"), ("nnz", "entries"),
+                       ("factor_mb", "ALS factor memory"), ("iteration_flops", "ALS work per iteration")):
+        saved = 1 - after[key] / before[key] if before[key] else 0.0
+        print(f"  {label:<24} {saved:>6.1%} saved")
+    if report_file:
+        with open(report_file, "w", encoding="utf-8") as fp:
+            json.dump(stats, fp, indent=2)
+        print(f"Report saved to {report_file}")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop the users and artists below minimum supports from a counts table.")
+    parser.add_argument("input_file", help="Path to the userid-artist-counts table")
+    parser.add_argument("output_file", help="Path to the pruned userid-artist-counts table")
+    parser.add_argument("--min-artist-users", type=int, default=MIN_ARTIST_USERS, help="Minimum users per artist")
+    parser.add_argument("--min-user-artists", type=int, default=MIN_USER_ARTISTS, help="Minimum artists per user")
+    parser.add_argument("--min-user-plays", type=int, default=0, help="Minimum total listens per user")
+    parser.add_argument("--min-artist-plays", type=int, default=0, help="Minimum total listens per artist")
+    parser.add_argument("--since", default=None, help="Prune the counts of the months from this date (.months input)")
+    parser.add_argument("--until", default=None, help="Prune the counts of the months before this date")
+    parser.add_argument("--report", default=None, help="JSON file to save the matrix statistics to")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
+
+    with measure("prune_counts", args.metrics):
+        prune_counts(args.input_file, args.output_file, args.min_artist_users, args.min_user_artists,
+                     args.min_user_plays, args.min_artist_plays, args.since, args.until, args.report)
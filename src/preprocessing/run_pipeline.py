@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+run_pipeline.py
+---------------
+Single entry point for the preprocessing pipeline. It knows the dependency graph of the stages
+
+    extract_listens -> filter_mapping -> canonicalize -> aggregate_counts [-> prune_counts]
+    artist_mapping (independent)
+
+runs independent stages concurrently, and skips every stage whose inputs and parameters did
+not change since its last successful run (see src/utils/pipeline.py). Input paths default to
+the ones in src/utils/config.py. Per-stage logs, the cache state and a JSON report with the
+metrics of each stage (wall and CPU time, peak memory, bytes read and written, rows per second;
+see src/utils/instrumentation.py) are written to "<working_dir>/.pipeline/".
+
+With --partitioned the listens, user-artist events and counts are month-partitioned stores
+(userid-msid.months, ..., see src/utils/columnar.py) whose partitions are .npcols tables, so
+load_data_matrix can load any window of months. --since / --until restrict canonicalize (and
+everything after it) to the listens of a date range. Given any of --min-artist-users,
+--min-user-artists or --min-user-plays, prune_counts also writes userid-artist-counts-pruned
+(same format) without the users and artists below those minimum supports.
+
+Usage:
+    python run_pipeline.py [--listens FILE_DIR_OR_GLOB] [--mapping FILE] [--redirect FILE]
+                           [--metadata FILE] [--artists FILE] [--working-dir DIR]
+                           [--format csv|parquet|npcols] [--partitioned] [--since DATE] [--until DATE]
+                           [--fused] [--min-artist-users N] [--min-user-artists N] [--min-user-plays N]
+                           [--jobs N] [--hash] [--force STAGE,...]
+
+Example:
+    python run_pipeline.py --listens "/mnt/j/MusicBrainz/*.listens.zst" --jobs 2
+"""
+
+import argparse
+import sys
+import os
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.preprocessing.extract_listens import find_listen_dumps
+from src.utils.columnar import MONTHS_SUFFIX
+from src.utils.interning import UuidStringTable
+from src.utils.config import (ARTIST_FILE, CANONICAL_METADATA_FILE, CANONICAL_REDIRECT_FILE, LISTENS_FILE,
+                              MSID_MAPPING_FILE, WORKING_DIR)
+from src.utils.pipeline import Stage, run_pipeline
+
+FORMAT_SUFFIXES = {"csv": ".csv", "parquet": ".parquet", "npcols": ".npcols"}
+
+def build_stages(listens, mapping_file, redirect_file, metadata_file, artist_file, working_dir,
+                 table_format="csv", fused=False, partitioned=False, since=None, until=None, prune=None):
+    """
+    Returns the Stage list of the preprocessing pipeline, with intermediate files in
+    working_dir named as in the notebooks (userid-msid.csv, small_msid_mapping.csv, ...).
+    With partitioned=True the listens, events and counts are .months stores; since / until
+    restrict canonicalize and aggregate_counts to a date range. prune is an optional dict of
+    prune_counts minimum supports (e.g. {"min_artist_users": 5}) adding that stage.
+    """
+    suffix = FORMAT_SUFFIXES[table_format]
+    listen_suffix = MONTHS_SUFFIX if partitioned else suffix
+    userid_msid = os.path.join(working_dir, "userid-msid" + listen_suffix)
+    small_mapping = os.path.join(working_dir, "small_msid_mapping" + suffix)
+    user_artist = os.path.join(working_dir, "userid-artist" + listen_suffix)
+    counts = os.path.join(working_dir, "userid-artist-counts" + listen_suffix)
+    date_range = {name: value for name, value in (("since", since), ("until", until)) if value is not None}
+    artist_names = os.path.join(working_dir, "artist_names")
+
+    # A date range on flat tables is selected on the listened_at column, so keep it.
+    extract_kwargs = {"fields": ["listened_at"]} if date_range and not partitioned else {}
+    if os.path.isfile(listens):
+        extract = Stage("extract_listens", "src.preprocessing.extract_listens:extract_listen_events",
+                        [listens, userid_msid], inputs=[listens], outputs=[userid_msid], kwargs=extract_kwargs)
+    else:
+        extract = Stage("extract_listens", "src.preprocessing.extract_listens:extract_listen_events_parallel",
+                        [listens, userid_msid], inputs=find_listen_dumps(listens), outputs=[userid_msid],
+                        kwargs=extract_kwargs)
+    stages = [
+        extract,
+        Stage("filter_mapping", "src.preprocessing.filter_mapping:filter_mapping",
+              [userid_msid, mapping_file, small_mapping], inputs=[userid_msid, mapping_file], outputs=[small_mapping]),
+    ]
+    canonical_inputs = [userid_msid, small_mapping, redirect_file, metadata_file]
+    if fused:
+        stages.append(Stage("canonicalize", "src.preprocessing.canonicalize:process_user_artist_counts",
+                            canonical_inputs + [counts], inputs=canonical_inputs, outputs=[counts], kwargs=date_range))
+    else:
+        stages += [
+            Stage("canonicalize", "src.preprocessing.canonicalize:process_user_artist",
+                  canonical_inputs + [user_artist], inputs=canonical_inputs, outputs=[user_artist],
+                  kwargs=date_range),
+            Stage("aggregate_counts", "src.preprocessing.aggregate_counts:aggregate_listens_vectorized",
+                  [user_artist, counts], inputs=[user_artist], outputs=[counts]),
+        ]
+    if prune:
+        pruned = os.path.join(working_dir, "userid-artist-counts-pruned" + listen_suffix)
+        stages.append(Stage("prune_counts", "src.preprocessing.prune_counts:prune_counts", [counts, pruned],
+                            inputs=[counts], outputs=[pruned], kwargs=prune))
+    stages.append(Stage("artist_mapping", "src.preprocessing.artist_mapping:write_artist_mapping",
+                        [artist_file, artist_names], inputs=[artist_file],
+                        outputs=[artist_names + suffix for suffix in UuidStringTable.SUFFIXES]))
+    return stages
+
+def print_report(summary):
+    """Prints the per-stage report as a table."""
+    print(f"\n{'stage':<18} {'status':<8} {'wall s':>8} {'cpu s':>8} {'peak MB':>8} {'read MB':>9} "
+          f"{'write MB':>9} {'rows/s':>12}")
+    for name, stage in summary["stages"].items():
+        if stage["status"] == "ran":
+            read_mb, write_mb = (f"{value / 2**20:>9,.1f}" if value is not None else f"{'n/a':>9}"
+                                 for value in (stage["bytes_read"], stage["bytes_written"]))
+            print(f"{name:<18} {'ran':<8} {stage['wall_seconds']:>8.1f} {stage['cpu_seconds']:>8.1f} "
+                  f"{stage['peak_rss_mb']:>8.0f} {read_mb} {write_mb} {stage['rows_per_second']:>12,.0f}")
+        else:
+            print(f"{name:<18} {stage['status']:<8}")
+    print(f"Total wall time: {summary['wall_seconds']:.1f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the preprocessing pipeline, skipping up-to-date stages.")
+    parser.add_argument("--listens", default=LISTENS_FILE, help="Listen dump, or a directory / glob pattern of dumps")
+    parser.add_argument("--mapping", default=MSID_MAPPING_FILE, help="ListenBrainz MSID mapping dump")
+    parser.add_argument("--redirect", default=CANONICAL_REDIRECT_FILE, help="Canonical recording redirect file")
+    parser.add_argument("--metadata", default=CANONICAL_METADATA_FILE, help="Canonical MusicBrainz data file")
+    parser.add_argument("--artists", default=ARTIST_FILE, help="MusicBrainz artist CSV")
+    parser.add_argument("--working-dir", default=WORKING_DIR, help="Directory of the intermediate and output files")
+    parser.add_argument("--format", choices=sorted(FORMAT_SUFFIXES), default="csv", help="Format of the intermediate tables")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="Keep the listens, events and counts in month-partitioned .months stores")
+    parser.add_argument("--since", default=None, help="Process the listens from this date or time (ISO 8601, UTC)")
+    parser.add_argument("--until", default=None, help="Process the listens before this date or time")
+    parser.add_argument("--fused", action="store_true", help="Canonicalize and aggregate in one stage (canonicalize --counts)")
+    parser.add_argument("--min-artist-users", type=int, default=None, help="Prune the artists with fewer users")
+    parser.add_argument("--min-user-artists", type=int, default=None, help="Prune the users with fewer artists")
+    parser.add_argument("--min-user-plays", type=int, default=None, help="Prune the users with fewer listens")
+    parser.add_argument("--jobs", type=int, default=None, help="Maximum number of stages running at once")
+    parser.add_argument("--hash", action="store_true", help="Detect changed files by content hash instead of size + mtime")
+    parser.add_argument("--force", default="", help="Comma-separated stages to rerun even if up to date")
+    args = parser.parse_args()
+
+    prune = {name: getattr(args, name) for name in ("min_artist_users", "min_user_artists", "min_user_plays")
+             if getattr(args, name) is not None}
+    stages = build_stages(args.listens, args.mapping, args.redirect, args.metadata, args.artists,
+                          args.working_dir, args.format, args.fused, args.partitioned, args.since, args.until, prune)
+    force = [name.strip() for name in args.force.split(",") if name.strip()]
+    summary = run_pipeline(stages, os.path.join(args.working_dir, ".pipeline"), args.jobs, args.hash, force)
+    print_report(summary)
+    if any(stage["status"] == "failed" for stage in summary["stages"].values()):
+        sys.exit(1)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+update_counts.py
+----------------
+Incremental version of the preprocessing pipeline (extract_listens -> filter_mapping ->
+canonicalize -> aggregate_counts) for a growing directory of listen dumps. Only the dumps that
+were not processed before are extracted and canonicalized, only the MSIDs that were not seen
+before are looked up in the mapping dump, and the new partial counts are added into the
+existing user-artist counts, so a monthly refresh does not rebuild everything.
+
+The state of the previous runs is kept in <state_dir> (default: "incremental" next to the output):
+    manifest.json                 processed dumps (size, mtime, SHA-256), fingerprints of the
+                                  reference dumps and of the counts output
+    parts/<dump>.msids.npcols     user_id, recording_msid extracted from each dump
+    parts/<dump>.counts.npcols    user-artist counts of each dump
+    msids.npy                     every MSID seen so far
+    msid_mapping.npcols           filtered mapping rows of every MSID seen so far
+
+A dump whose size or mtime changed is checksummed again and reprocessed only if its content
+changed. When a processed dump changed or disappeared (or the output was modified), the counts
+are re-summed from the per-dump counts. When the mapping, redirect or metadata dump changed,
+every stored part is canonicalized again (after re-filtering the mapping if it is the one that
+changed); the listens are never extracted twice.
+
+With the dumps processed in sorted order, the output is the same file that the full pipeline
+(extract_listens on all dumps, filter_mapping, canonicalize --counts) writes.
+
+Usage:
+    python update_counts.py <listen_dumps_dir_or_glob> <msid_mapping_file> <canonical_redirect_file>
+                            <canonical_metadata_file> <output_user_artist_counts>
+                            [--state-dir DIR] [--index-dir DIR] [--workers N] [--metrics REPORT_JSON]
+
+Example:
+    python update_counts.py /mnt/j/MusicBrainz/listens/ \\
+                            /mnt/j/MusicBrainz/listenbrainz_msid_mapping.csv-003.zst \\
+                            /mnt/j/MusicBrainz/canonical_recording_redirect.csv.zst \\
+                            /mnt/j/MusicBrainz/canonical_musicbrainz_data.csv.zst \\
+                            /mnt/j/MusicBrainz/working/userid-artist-counts.csv
+"""
+
+import argparse
+import json
+import shutil
+import sys
+import os
+import time
+
+import numpy as np
+
+# Ensure the project root is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.preprocessing.aggregate_counts import merge_counts
+from src.preprocessing.canonicalize import (load_canonical_metadata, load_canonical_redirect, load_filtered_mapping,
+                                            resolve_msid_artists, write_user_artist_counts)
+from src.preprocessing.extract_listens import extract_shards, find_listen_dumps
+from src.preprocessing.filter_mapping import filter_mapping_msids
+from src.utils.columnar import NULL_KEY, TableWriter, concat_tables, iter_table
+from src.utils.config import DICTIONARY_DIRNAME
+from src.utils.file_utils import file_checksum, plan_shards
+from src.utils.instrumentation import count_rows, measure
+from src.utils.interning import UuidDictionary
+from src.utils.lookup_store import MAPPING_COLUMNS, source_fingerprint
+
+MANIFEST_VERSION = 1
+REFERENCE_NAMES = ("mapping", "redirect", "metadata")
+
+def load_manifest(state_dir):
+    """Returns the manifest of the previous runs (an empty one on the first run)."""
+    path = os.path.join(state_dir, "manifest.json")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as fp:
+            manifest = json.load(fp)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    return {"version": MANIFEST_VERSION, "dumps": {}, "references": {}, "output": None}
+
+def save_manifest(state_dir, manifest):
+    path = os.path.join(state_dir, "manifest.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(path + ".tmp", path)
+
+def classify_dumps(dump_files, manifest):
+    """
+    Compares the dumps on disk with the manifest. Dumps whose size and mtime are unchanged are
+    trusted without reading them; the others are checksummed.
+
+    Returns:
+        tuple: (entries, changed, removed) where entries maps each dump name to its manifest
+               entry, changed lists the names of new or modified dumps and removed the names
+               of processed dumps that are gone.
+    """
+    entries = {}
+    changed = []
+    for dump_file in dump_files:
+        name = os.path.basename(dump_file)
+        fingerprint = source_fingerprint(dump_file)
+        previous = manifest["dumps"].get(name)
+        if previous and all(previous[key] == fingerprint[key] for key in ("path", "size", "mtime_ns")):
+            entries[name] = previous
+            continue
+        entry = dict(fingerprint, sha256=file_checksum(dump_file))
+        entries[name] = entry
+        if not previous or previous["sha256"] != entry["sha256"]:
+            changed.append(name)
+    removed = sorted(set(manifest["dumps"]) - set(entries))
+    return entries, changed, removed
+
+def part_path(state_dir, name, kind):
+    return os.path.join(state_dir, "parts", f"{name}.{kind}.npcols")
+
+def extract_parts(dump_files, state_dir, num_workers):
+    """
+    Extracts user_id and recording_msid from the given dumps in parallel, one table per dump.
+
+    Returns:
+        int: Number of listen lines read.
+    """
+    shards = plan_shards(dump_files, num_workers)
+    shard_dir = os.path.join(state_dir, "parts", "shards")
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_paths = [os.path.join(shard_dir, f"{os.path.basename(dump_file)}-{i:04d}.npcols")
+                   for i, (dump_file, _, _) in enumerate(shards)]
+    results = extract_shards(shards, shard_paths, num_workers)
+    for dump_file in dump_files:
+        sources = [path for (shard_file, _, _), path in zip(shards, shard_paths) if shard_file == dump_file]
+        concat_tables(sources, part_path(state_dir, os.path.basename(dump_file), "msids"))
+    shutil.rmtree(shard_dir)
+    return sum(result["lines"] for result in results)
+
+def part_msids(names, state_dir):
+    """Returns a UuidDictionary of the MSIDs of the given extracted parts."""
+    key_chunks = []
+    for name in names:
+        for chunk in iter_table(part_path(state_dir, name, "msids"), ["recording_msid"]):
+            keys = chunk["recording_msid"]
+            key_chunks.append(np.unique(keys[keys != NULL_KEY]))
+    return UuidDictionary.from_keys(key_chunks)
+
+def replace_table(source, destination):
+    """Moves a .npcols table over another one."""
+    if os.path.exists(destination):
+        shutil.rmtree(destination)
+    os.rename(source, destination)
+
+def update_filtered_mapping(msids, mapping_file, state_dir, index_dir, num_workers, append):
+    """
+    Filters the mapping dump for the given MSIDs and appends the rows to the filtered mapping
+    of the state (or replaces it when append is False). Only the MAPPING_COLUMNS are appended:
+    a scan of the mapping dump keeps all of its columns but an indexed lookup (index_dir) does
+    not, and the two can alternate between runs.
+    """
+    mapping_path = os.path.join(state_dir, "msid_mapping.npcols")
+    new_path = os.path.join(state_dir, "msid_mapping.new.npcols")
+    msids_path = os.path.join(state_dir, "new_msids.npy")
+    msids.save(msids_path)
+    filter_mapping_msids(UuidDictionary.load(msids_path), msids_path, mapping_file, new_path,
+                         index_dir=index_dir, num_workers=num_workers)
+    os.remove(msids_path)
+    if append and os.path.exists(mapping_path):
+        merged_path = os.path.join(state_dir, "msid_mapping.merged.npcols")
+        with TableWriter(merged_path, MAPPING_COLUMNS) as writer:
+            for source in (mapping_path, new_path):
+                for chunk in iter_table(source, MAPPING_COLUMNS):
+                    writer.write_columns(chunk)
+        shutil.rmtree(new_path)
+        new_path = merged_path
+    replace_table(new_path, mapping_path)
+    return mapping_path
+
+def update_counts(input_spec, mapping_file, redirect_file, metadata_file, output_counts, state_dir=None,
+                  index_dir=None, num_workers=None):
+    """
+    Brings output_counts up to date with the listen dumps matching input_spec, processing only
+    what changed since the previous run (see the module docstring).
+    """
+    started = time.perf_counter()
+    state_dir = state_dir or os.path.join(os.path.dirname(output_counts), "incremental")
+    os.makedirs(os.path.join(state_dir, "parts"), exist_ok=True)
+    num_workers = num_workers or os.cpu_count()
+    manifest = load_manifest(state_dir)
+
+    dump_files = find_listen_dumps(input_spec)
+    if not dump_files:
+        raise FileNotFoundError(f"No listen dumps found for {input_spec}")
+    entries, changed, removed = classify_dumps(dump_files, manifest)
+    references = {name: source_fingerprint(path)
+                  for name, path in zip(REFERENCE_NAMES, (mapping_file, redirect_file, metadata_file))}
+    changed_references = [name for name in REFERENCE_NAMES if manifest["references"].get(name) != references[name]]
+    print(f"{len(dump_files)} dumps: {len(changed)} new or changed, {len(removed)} removed; "
+          f"changed reference dumps: {', '.join(changed_references) or 'none'}")
+
+    # 1. Extract the new dumps.
+    if changed:
+        count_rows(extract_parts([path for path in dump_files if os.path.basename(path) in changed],
+                                 state_dir, num_workers))
+    for name in removed:
+        for kind in ("msids", "counts"):
+            if os.path.exists(part_path(state_dir, name, kind)):
+                shutil.rmtree(part_path(state_dir, name, kind))
+
+    # 2. Look up the newly seen MSIDs (or all of them if the mapping dump changed).
+    msids_path = os.path.join(state_dir, "msids.npy")
+    known = UuidDictionary.load(msids_path) if os.path.exists(msids_path) else UuidDictionary.from_keys([])
+    seen = part_msids(changed, state_dir)
+    new_msids = UuidDictionary(seen.keys[~known.contains_keys(seen.keys)])
+    known = UuidDictionary.from_keys([np.asarray(known.keys), new_msids.keys])
+    mapping_path = os.path.join(state_dir, "msid_mapping.npcols")
+    if "mapping" in changed_references:
+        print(f"Mapping dump changed: filtering it for all {len(known)} known MSIDs")
+        update_filtered_mapping(known, mapping_file, state_dir, index_dir, num_workers, append=False)
+    elif len(new_msids) or not os.path.exists(mapping_path):
+        print(f"Filtering the mapping for {len(new_msids)} newly seen MSIDs ({len(known)} known)")
+        update_filtered_mapping(new_msids, mapping_file, state_dir, index_dir, num_workers, append=True)
+    known.save(msids_path)
+
+    # 3. Canonicalize the new parts (or all of them if a reference dump changed).
+    names = sorted(entries, key=lambda name: entries[name]["path"])
+    to_count = names if changed_references else [name for name in names if name in changed]
+    if to_count:
+        cache_dir = index_dir or os.path.join(state_dir, DICTIONARY_DIRNAME)
+        msid_to_artist = resolve_msid_artists(
+            load_filtered_mapping(mapping_path),
+            load_canonical_redirect(redirect_file, os.path.join(cache_dir, "canonical_redirect")),
+            load_canonical_metadata(metadata_file, os.path.join(cache_dir, "canonical_artist")))
+        for name in to_count:
+            write_user_artist_counts(part_path(state_dir, name, "msids"), msid_to_artist,
+                                     part_path(state_dir, name, "counts"))
+
+    # 4. Add the new partial counts into the output, or re-sum all parts if counts already in
+    #    the output changed or a new dump sorts before a processed one (e.g. a back-filled
+    #    month), so the rows keep the order of the full pipeline.
+    output_unchanged = (manifest["output"] is not None and os.path.exists(output_counts)
+                        and manifest["output"] == source_fingerprint(output_counts))
+    modified = [name for name in changed if name in manifest["dumps"]]
+    processed = [entries[name]["path"] for name in names if name not in changed]
+    appended = all(entries[name]["path"] > max(processed, default="") for name in changed)
+    if output_unchanged and appended and not removed and not modified and not changed_references:
+        if to_count:
+            merge_counts([output_counts] + [part_path(state_dir, name, "counts") for name in to_count], output_counts)
+    else:
+        merge_counts([part_path(state_dir, name, "counts") for name in names], output_counts)
+
+    manifest.update(dumps=entries, references=references, output=source_fingerprint(output_counts))
+    save_manifest(state_dir, manifest)
+    print(f"Updated {output_counts} in {time.perf_counter() - started:.1f}s "
+          f"({len(to_count)} of {len(names)} dumps processed)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally update the user-artist counts with new listen dumps.")
+    parser.add_argument("input", help="Directory or glob pattern of listen dumps")
+    parser.add_argument("mapping_file", help="ListenBrainz MSID mapping dump")
+    parser.add_argument("redirect_file", help="Canonical recording redirect file")
+    parser.add_argument("metadata_file", help="Canonical MusicBrainz data file")
+    parser.add_argument("output_counts", help="User-artist counts table to create or update (.csv, .parquet or .npcols)")
+    parser.add_argument("--state-dir", default=None, help="Directory of the incremental state (default: 'incremental' next to the output)")
+    parser.add_argument("--index-dir", default=None, help="Directory of the reference dump indexes (see build_indexes.py)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
+
+    with measure("update_counts", args.metrics):
+        update_counts(args.input, args.mapping_file, args.redirect_file, args.metadata_file, args.output_counts,
+                      args.state_dir, args.index_dir, args.workers)
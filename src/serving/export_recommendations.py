@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+export_recommendations.py
+-------------------------
+This script exports, for a model saved by listenbrainz_model.save_model, the top-N artist
+recommendations of every user and the top-N most similar artists of every artist, e.g. for a
+nightly job feeding a serving database.
+
+Users and artists are split into shards that worker processes (--jobs, each using --threads
+BLAS threads) score in vectorized blocks, over the memory-mapped factors of the model (see
+src/utils/batch_export.py). Each shard is written as its own table,
+
+    <output_dir>/recommendations/part-00000.csv   user_id, rank, artist_id, score
+    <output_dir>/neighbours/part-00000.csv        artist_id, rank, similar_artist_id, score
+
+(or .parquet / .npcols with --format), with an _export.json manifest per directory listing
+the shards, row counts and throughput. Progress (shards done, users or artists per second,
+ETA) is printed as the shards complete.
+
+Recommendations leave out the artists the user already listened to, in the counts the model
+was trained on (recorded in its model.json) or in --counts; --keep-listened keeps them.
+
+Usage:
+    python export_recommendations.py <model_dir> <output_dir> [--n 20] [--only recommendations|neighbours]
+                                     [--counts COUNTS] [--keep-listened] [--format csv|parquet|npcols]
+                                     [--shard-rows N] [--jobs N] [--threads N] [--metrics REPORT_JSON]
+
+Example:
+    python export_recommendations.py /mnt/j/MusicBrainz/working/models/2024-01 /mnt/j/MusicBrainz/working/exports/2024-01 --n 50 --jobs 4
+"""
+
+import argparse
+import sys
+import os
+
+# Ensure the project root (and the notebooks directory, for listenbrainz_model) is in sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+for path in (project_root, os.path.join(project_root, "notebooks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import listenbrainz_model as lb
+from src.utils.batch_export import SHARD_ROWS
+from src.utils.instrumentation import count_rows, measure
+
+FORMAT_SUFFIXES = {"csv": ".csv", "parquet": ".parquet", "npcols": ".npcols"}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export top-N recommendations and similar artists of a saved model.")
+    parser.add_argument("model_dir", help="Directory of a model saved by listenbrainz_model.save_model")
+    parser.add_argument("output_dir", help="Directory to write the recommendations/ and neighbours/ shards to")
+    parser.add_argument("--n", type=int, default=20, help="Artists per user and per artist")
+    parser.add_argument("--only", choices=lb.EXPORT_KINDS, default=None, help="Export only one of the two")
+    parser.add_argument("--counts", default=None,
+                        help="Counts whose listened artists are left out (default: the counts the model was trained on)")
+    parser.add_argument("--keep-listened", action="store_true", help="Recommend artists the user already listened to")
+    parser.add_argument("--format", choices=sorted(FORMAT_SUFFIXES), default="csv", help="Format of the shards")
+    parser.add_argument("--shard-rows", type=int, default=SHARD_ROWS, help="Users or artists per shard")
+    parser.add_argument("--jobs", type=int, default=None, help="Worker processes (default: CPU count / threads)")
+    parser.add_argument("--threads", type=int, default=1, help="BLAS threads per worker")
+    parser.add_argument("--metrics", default=None, help="JSON report to save the run's performance metrics to")
+    args = parser.parse_args()
+
+    kinds = (args.only,) if args.only else lb.EXPORT_KINDS
+    with measure("export_recommendations", args.metrics):
+        manifests = lb.export_batch(args.model_dir, args.output_dir, args.n, "" if args.keep_listened else args.counts,
+                                    kinds, FORMAT_SUFFIXES[args.format], args.shard_rows, args.jobs, args.threads)
+        for kind, manifest in manifests.items():
+            count_rows(manifest["rows"])
+            print(f"Exported {manifest['rows']:,} {kind} of {manifest['items']:,} "
+                  f"{'users' if kind == 'recommendations' else 'artists'} in {manifest['seconds']:.1f}s "
+                  f"({manifest['items_per_second']:,.0f}/s) to {os.path.join(args.output_dir, kind)}")
@@ -0,0 +1,239 @@
+"""
+ann.py
+------
+Approximate nearest-neighbour indexes over the item factors of a saved model, for similar-artist
+queries on catalogs too large for the exact scan of src/utils/similarity.py (whose cost grows
+with the number of artists).
+
+Two backends, same interface (build / query / query_batch / save / load):
+
+    - IvfIndex ("ivf"): inverted file over int8-quantized factors, in NumPy only. Spherical
+      k-means splits the normalized factors into num_lists clusters; a query scores the
+      centroids, scans the items of the nprobe closest clusters with their int8 codes, and
+      re-scores the best candidates with the float factors. Saved as .npy arrays, loaded
+      memory-mapped.
+    - HnswIndex ("hnsw"): hnswlib's HNSW graph, if hnswlib is installed (pip install hnswlib).
+
+Both score by cosine similarity, like implicit's similar_items. The recall of a setting (nprobe
+or ef) against the exact results is measured by benchmarks/bench_ann.py.
+
+open_ann_index keeps an index in the directory of the model it was built from, with a
+manifest tying it to that model's model.json (see src/utils/lookup_store.py).
+"""
+
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+from src.utils.interning import save_array
+from src.utils.lookup_store import invalidate, is_current, mark_built, read_manifest
+from src.utils.model_store import MODEL_FILE
+from src.utils.similarity import SCORE_BLOCK_ELEMENTS, normalized_factors
+
+# k-means iterations of an IvfIndex, and training points per cluster
+KMEANS_ITERATIONS = 10
+KMEANS_POINTS_PER_LIST = 64
+# Candidates re-scored with the float factors, per requested neighbour
+RERANK_FACTOR = 4
+
+def _assign(normalized, centroids):
+    """Closest centroid (highest dot product) of every row, in bounded blocks."""
+    labels = np.empty(len(normalized), dtype=np.int32)
+    block_rows = max(1, SCORE_BLOCK_ELEMENTS // max(len(centroids), 1))
+    for start in range(0, len(normalized), block_rows):
+        labels[start:start + block_rows] = np.argmax(normalized[start:start + block_rows] @ centroids.T, axis=1)
+    return labels
+
+def spherical_kmeans(normalized, num_clusters, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Unit-norm centroids of num_clusters clusters of unit-norm rows (k-means on the sphere),
+    trained on at most KMEANS_POINTS_PER_LIST rows per cluster.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(normalized), num_clusters * KMEANS_POINTS_PER_LIST)
+    sample = np.asarray(normalized[np.sort(rng.choice(len(normalized), sample_size, replace=False))])
+    centroids = sample[rng.choice(len(sample), num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(sample, centroids)
+        members = csr_matrix((np.ones(len(sample), dtype=np.float32), (labels, np.arange(len(sample)))),
+                             shape=(num_clusters, len(sample)))
+        sums = np.asarray(members @ sample)
+        empty = np.bincount(labels, minlength=num_clusters) == 0
+        # Restart empty clusters from random points.
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalized_factors(sums)
+    return centroids
+
+class IvfIndex:
+    """
+    Inverted file index (see the module docstring):
+
+        centroids:    float32, num_lists x factors, unit norm
+        list_offsets: int64, num_lists + 1; the items of list i are list_items[offsets[i]:offsets[i + 1]]
+        list_items:   int32 item rows, grouped by list
+        codes:        int8 quantized normalized factors, aligned with list_items
+        scales:       float32 per-factor quantization scales (value = code * scale)
+
+    Re-scoring needs the float item factors; without them (factors=None) the int8 scores are
+    returned.
+    """
+
+    backend = "ivf"
+
+    def __init__(self, centroids, list_offsets, list_items, codes, scales, factors=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_items = list_items
+        self.codes = codes
+        self.scales = scales
+        self.factors = factors
+
+    def __len__(self):
+        return len(self.list_items)
+
+    @classmethod
+    def build(cls, item_factors, num_lists=None, seed=0):
+        """
+        Builds the index of item_factors (default num_lists: 4 * sqrt(items), a few hundred
+        items per list).
+        """
+        normalized = normalized_factors(item_factors)
+        if num_lists is None:
+            num_lists = int(4 * np.sqrt(len(normalized)))
+        num_lists = max(1, min(num_lists, len(normalized)))
+        centroids = spherical_kmeans(normalized, num_lists, seed=seed)
+        labels = _assign(normalized, centroids)
+        list_items = np.argsort(labels, kind="stable").astype(np.int32)
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=num_lists), out=list_offsets[1:])
+        scales = np.abs(normalized).max(axis=0) / 127
+        scales[scales == 0] = 1
+        codes = np.round(normalized[list_items] / scales).astype(np.int8)
+        return cls(centroids, list_offsets, list_items, codes, scales.astype(np.float32), item_factors)
+
+    def query(self, vector, k=20, nprobe=16):
+        """
+        The (approximately) k most similar items of a factor vector.
+
+        Returns:
+            tuple: (items, scores) as int32 / float32 arrays, most similar first.
+        """
+        query = normalized_factors(np.asarray(vector, dtype=np.float32)[None, :])[0]
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        # Positions of the items of the probed lists, i.e. the concatenated ranges start:end.
+        starts, lengths = self.list_offsets[lists], self.list_offsets[lists + 1] - self.list_offsets[lists]
+        positions = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        if not len(positions):
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        scores = self.codes[positions] @ (query * self.scales)
+        candidates = k * RERANK_FACTOR if self.factors is not None else k
+        if candidates < len(positions):
+            best = np.argpartition(-scores, candidates - 1)[:candidates]
+            positions, scores = positions[best], scores[best]
+        items = self.list_items[positions]
+        if self.factors is not None:
+            items = np.sort(items)
+            scores = normalized_factors(self.factors[items]) @ query
+        top = np.argsort(-scores, kind="stable")[:k]
+        return items[top].astype(np.int32), scores[top].astype(np.float32)
+
+    def query_batch(self, vectors, k=20, nprobe=16):
+        """query() for each row of vectors; returns (items, scores) arrays of shape (len(vectors), k)."""
+        items = np.full((len(vectors), k), -1, dtype=np.int32)
+        scores = np.full((len(vectors), k), -np.inf, dtype=np.float32)
+        for i, vector in enumerate(vectors):
+            found, found_scores = self.query(vector, k, nprobe)
+            items[i, :len(found)], scores[i, :len(found)] = found, found_scores
+        return items, scores
+
+    def save(self, prefix):
+        save_array(prefix + ".centroids.npy", self.centroids)
+        save_array(prefix + ".list_offsets.npy", self.list_offsets)
+        save_array(prefix + ".list_items.npy", self.list_items)
+        save_array(prefix + ".codes.npy", self.codes)
+        save_array(prefix + ".scales.npy", self.scales)
+
+    @classmethod
+    def load(cls, prefix, factors=None, mmap_mode="r"):
+        return cls(*(np.load(prefix + suffix, mmap_mode=mmap_mode)
+                     for suffix in (".centroids.npy", ".list_offsets.npy", ".list_items.npy", ".codes.npy",
+                                    ".scales.npy")), factors)
+
+class HnswIndex:
+    """HNSW graph of the normalized item factors, built and searched by hnswlib."""
+
+    backend = "hnsw"
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.get_current_count()
+
+    @staticmethod
+    def _require_hnswlib():
+        if hnswlib is None:
+            raise ImportError("The hnsw backend needs hnswlib (pip install hnswlib)")
+
+    @classmethod
+    def build(cls, item_factors, m=16, ef_construction=200, seed=0):
+        cls._require_hnswlib()
+        normalized = normalized_factors(item_factors)
+        index = hnswlib.Index(space="ip", dim=normalized.shape[1])
+        index.init_index(max_elements=max(len(normalized), 1), M=m, ef_construction=ef_construction,
+                         random_seed=seed)
+        index.add_items(normalized, np.arange(len(normalized)))
+        return cls(index)
+
+    def query(self, vector, k=20, ef=64):
+        items, scores = self.query_batch(np.asarray(vector, dtype=np.float32)[None, :], k, ef)
+        return items[0], scores[0]
+
+    def query_batch(self, vectors, k=20, ef=64):
+        """Returns (items, scores) arrays of shape (len(vectors), k), most similar first."""
+        self.index.set_ef(max(ef, k))
+        labels, distances = self.index.knn_query(normalized_factors(vectors), k=min(k, len(self)))
+        # hnswlib's inner-product distance is 1 - dot.
+        return labels.astype(np.int32), (1 - distances).astype(np.float32)
+
+    def save(self, prefix):
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        self.index.save_index(prefix + ".hnsw.tmp")
+        os.replace(prefix + ".hnsw.tmp", prefix + ".hnsw")
+
+    @classmethod
+    def load(cls, prefix, factors, mmap_mode=None):
+        """Loads an index saved under prefix; the item factors it was built from give its size."""
+        cls._require_hnswlib()
+        index = hnswlib.Index(space="ip", dim=int(factors.shape[1]))
+        index.load_index(prefix + ".hnsw", max_elements=len(factors))
+        return cls(index)
+
+ANN_BACKENDS = {"ivf": IvfIndex, "hnsw": HnswIndex}
+
+def open_ann_index(model_dir, item_factors, backend="ivf", **params):
+    """
+    Loads the ANN index of a backend saved in a model directory, building it first if it is
+    missing, was built with other params or for an earlier model saved there. params are
+    passed to the backend's build (e.g. num_lists for "ivf", m and ef_construction for "hnsw").
+
+    Returns:
+        tuple: (index, built) where built tells whether the index was (re)built.
+    """
+    index_class = ANN_BACKENDS[backend]
+    prefix = os.path.join(model_dir, "ann_" + backend)
+    model_file = os.path.join(model_dir, MODEL_FILE)
+    if is_current(prefix, model_file) and read_manifest(prefix).get("params") == params:
+        return index_class.load(prefix, item_factors), False
+    invalidate(prefix)
+    index = index_class.build(item_factors, **params)
+    index.save(prefix)
+    mark_built(prefix, model_file, backend=backend, params=params)
+    return index, True
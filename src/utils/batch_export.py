@@ -0,0 +1,218 @@
+"""
+batch_export.py
+---------------
+Bulk exports of a saved model (see src/utils/model_store.py), for nightly jobs that would
+otherwise make one recommend / similar_items call per user or artist:
+
+    recommendations  the top-N artists of every user, by the dot product of the user and item
+                     factors (as implicit's recommend), leaving out the artists the user
+                     already listened to when given the play matrix the model was trained on
+    neighbours       the top-N most similar artists of every artist, by cosine similarity (as
+                     similar_items), the artist itself left out
+
+The rows (users or artists) are split into shards of shard_rows rows, exported in parallel by
+worker processes into one table per shard ("part-00000.csv", ..., in the format of the
+suffix, see src/utils/columnar.py), one row per (user or artist, rank). The workers
+memory-map the model's factors, the play matrix and the normalized item factors (saved once
+in the model directory), so every worker shares the same pages instead of holding a copy.
+A worker scores its shard in blocks of rows: one matrix product per block, followed by the
+partial sort of similarity.py, written out before the next block, so its memory is bounded by
+the block size whatever the size of the catalog.
+
+A shard is written under a temporary name and renamed when complete, and a "_export.json"
+manifest listing the shards is written last, so a crashed export never looks complete.
+"""
+
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+from src.utils.columnar import TableWriter
+from src.utils.interning import save_array
+from src.utils.lookup_store import invalidate, is_current, mark_built
+from src.utils.matrix_store import PlayMatrix
+from src.utils.model_store import MODEL_FILE, SavedModel, read_model_params
+from src.utils.similarity import SCORE_BLOCK_ELEMENTS, normalized_factors, top_k_rows, top_k_similar
+
+EXPORT_COLUMNS = {
+    "recommendations": ["user_id", "rank", "artist_id", "score"],
+    "neighbours": ["artist_id", "rank", "similar_artist_id", "score"],
+}
+EXPORT_MANIFEST = "_export.json"
+
+# Users or artists per output shard (the unit of work of a worker process)
+SHARD_ROWS = 100_000
+
+def open_normalized_factors(model_dir, item_factors):
+    """
+    The unit-norm item factors of a saved model (see similarity.normalized_factors), saved in
+    its directory the first time and memory-mapped from there.
+    """
+    path = os.path.join(model_dir, "normalized_item_factors.npy")
+    prefix = path[:-len(".npy")]
+    model_file = os.path.join(model_dir, MODEL_FILE)
+    if not (is_current(prefix, model_file) and os.path.exists(path)):
+        invalidate(prefix)
+        save_array(path, normalized_factors(item_factors))
+        mark_built(prefix, model_file)
+    return np.load(path, mmap_mode="r")
+
+def recommend_block(user_factors, item_factors, rows, n, listened=None):
+    """
+    The n best scoring artists of the users in rows, excluding the entries of `listened` (a
+    users x artists CSR matrix aligned with the factors) if given.
+
+    Returns:
+        tuple: (artists, scores), int32 / float32 arrays of shape (len(rows), n); a user with
+               fewer than n artists left gets -inf scores in the remaining columns.
+    """
+    scores = np.asarray(user_factors[rows], dtype=np.float32) @ np.asarray(item_factors, dtype=np.float32).T
+    if listened is not None:
+        block = listened[rows]
+        scores[np.repeat(np.arange(len(rows)), np.diff(block.indptr)), block.indices] = -np.inf
+    return top_k_rows(scores, n)
+
+def neighbours_block(normalized, rows, n):
+    """
+    The n artists most similar to the artists in rows, without the artist itself.
+
+    Returns:
+        tuple: (artists, scores), int32 / float32 arrays of shape (len(rows), n).
+    """
+    neighbours, scores = top_k_similar(normalized, n + 1, rows=rows)
+    # Move the artist itself (normally the first column) to the end, then drop the last column.
+    order = np.argsort(neighbours == np.asarray(rows)[:, None], axis=1, kind="stable")[:, :n]
+    return np.take_along_axis(neighbours, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+def shard_path(output_dir, shard, suffix):
+    return os.path.join(output_dir, f"part-{shard:05d}{suffix}")
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def export_shard(kind, model_dir, path, start, end, n, matrix_prefix=None, threads=1,
+                 block_elements=SCORE_BLOCK_ELEMENTS):
+    """
+    Worker: writes the export rows of users (or artists) start:end of a saved model to the
+    table at path.
+
+    Returns:
+        dict: The shard's path, rows written and wall seconds.
+    """
+    started = time.perf_counter()
+    model = SavedModel.load(model_dir)
+    keys = np.asarray(model.artist_index.keys)
+    if kind == "recommendations":
+        ids = model.users
+        listened = PlayMatrix.load(matrix_prefix, mmap_mode="r").plays if matrix_prefix else None
+        def score(rows):
+            return recommend_block(model.user_factors, model.item_factors, rows, n, listened)
+    else:
+        ids = keys
+        normalized = open_normalized_factors(model_dir, model.item_factors)
+        def score(rows):
+            return neighbours_block(normalized, rows, n)
+
+    name, ext = os.path.splitext(path.rstrip("/\\"))
+    tmp_path = name + ".tmp" + ext
+    _remove(tmp_path)
+    written = 0
+    block_rows = max(1, block_elements // max(len(model.item_factors), 1))
+    with threadpool_limits(threads), TableWriter(tmp_path, EXPORT_COLUMNS[kind]) as writer:
+        for block_start in range(start, end, block_rows):
+            rows = np.arange(block_start, min(block_start + block_rows, end))
+            artists, scores = score(rows)
+            found = np.isfinite(scores).reshape(-1)
+            columns = [np.repeat(np.asarray(ids[rows]), artists.shape[1]),
+                       np.tile(np.arange(1, artists.shape[1] + 1), len(rows)),
+                       keys[artists.reshape(-1)], scores.reshape(-1)]
+            writer.write_columns({column: values[found] for column, values in zip(EXPORT_COLUMNS[kind], columns)})
+            written += int(found.sum())
+    _remove(path)
+    os.replace(tmp_path, path)
+    return {"path": os.path.basename(path), "start": int(start), "end": int(end), "rows": written,
+            "seconds": time.perf_counter() - started}
+
+def export_model(model_dir, output_dir, kind, n=20, matrix_prefix=None, suffix=".csv", shard_rows=SHARD_ROWS,
+                 jobs=None, threads=1, progress=print):
+    """
+    Exports the recommendations or neighbours ("kind") of every user or artist of a saved model
+    to output_dir, one table per shard, in parallel (see the module docstring).
+
+    Parameters:
+        model_dir (str): Directory of a model saved by listenbrainz_model.save_model.
+        output_dir (str): Directory of the shards and their _export.json manifest.
+        kind (str): "recommendations" or "neighbours".
+        n (int): Artists per user or artist.
+        matrix_prefix (str): Saved PlayMatrix the model was trained on (same rows and columns),
+                             whose entries are left out of the recommendations.
+        suffix (str): Table format of the shards (".csv", ".parquet" or ".npcols").
+        shard_rows (int): Users or artists per shard.
+        jobs (int): Worker processes (default: CPU count / threads).
+        threads (int): BLAS threads per worker.
+        progress (callable): Receives a progress line after each shard (None for silence).
+
+    Returns:
+        dict: The export manifest (shards, rows, seconds, throughput).
+    """
+    model = SavedModel.load(model_dir)
+    if kind not in EXPORT_COLUMNS:
+        raise ValueError(f"Unknown export {kind!r}, expected one of {sorted(EXPORT_COLUMNS)}")
+    total = len(model.users) if kind == "recommendations" else len(model.item_factors)
+    n = min(n, len(model.item_factors) - (kind == "neighbours"))
+    if kind == "recommendations" and matrix_prefix:
+        matrix = PlayMatrix.load(matrix_prefix, mmap_mode="r")
+        if not (np.array_equal(matrix.users, model.users) and np.array_equal(matrix.artists, model.artist_index.keys)):
+            raise ValueError(f"The play matrix {matrix_prefix} does not have the users and artists of the model "
+                             f"in {model_dir}; pass the counts it was trained on")
+    if kind == "neighbours":
+        open_normalized_factors(model_dir, model.item_factors)
+
+    os.makedirs(output_dir, exist_ok=True)
+    # The manifest and shards of an earlier export (which may have had more shards) go first.
+    _remove(os.path.join(output_dir, EXPORT_MANIFEST))
+    for name in os.listdir(output_dir):
+        if name.startswith("part-"):
+            _remove(os.path.join(output_dir, name))
+    starts = list(range(0, total, shard_rows))
+    jobs = jobs or max(1, (os.cpu_count() or 1) // threads)
+    started = time.perf_counter()
+    shards, rows_done, items_done = [], 0, 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(export_shard, kind, model_dir, shard_path(output_dir, shard, suffix), start,
+                               min(start + shard_rows, total), n, matrix_prefix, threads): start
+                   for shard, start in enumerate(starts)}
+        for future in as_completed(futures):
+            shard = future.result()
+            shards.append(shard)
+            rows_done += shard["rows"]
+            items_done += shard["end"] - shard["start"]
+            elapsed = time.perf_counter() - started
+            if progress:
+                rate = items_done / elapsed if elapsed else 0.0
+                eta = (total - items_done) / rate if rate else 0.0
+                progress(f"{kind}: {len(shards)}/{len(starts)} shards, {items_done:,}/{total:,} "
+                         f"{'users' if kind == 'recommendations' else 'artists'} ({rate:,.0f}/s, "
+                         f"{rows_done / elapsed if elapsed else 0:,.0f} rows/s), ETA {eta:.0f}s")
+    seconds = time.perf_counter() - started
+    shards.sort(key=lambda shard: shard["start"])
+    manifest = {"kind": kind, "model": os.path.abspath(model_dir),
+                "model_created_at": read_model_params(model_dir).get("created_at"), "n": n,
+                "excludes_listened": bool(matrix_prefix) and kind == "recommendations",
+                "columns": EXPORT_COLUMNS[kind], "items": total, "rows": rows_done, "seconds": seconds,
+                "items_per_second": total / seconds if seconds else 0.0, "jobs": jobs, "threads": threads,
+                "exported_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "shards": shards}
+    tmp_path = os.path.join(output_dir, EXPORT_MANIFEST + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(tmp_path, os.path.join(output_dir, EXPORT_MANIFEST))
+    return manifest
@@ -0,0 +1,616 @@
+"""
+columnar.py
+-----------
+Typed tables for the intermediate files handed from one preprocessing stage to the next
+(userid-msid, small_msid_mapping, userid-artist, userid-artist-counts).
+
+The format is chosen from the path:
+    - "*.csv" (or "*.csv.zst" for reading): text CSV with a header, as before.
+    - "*.parquet": Apache Parquet, written and read with pyarrow (optional dependency).
+    - "*.npcols": a directory with one .npy file per column, loaded memory-mapped.
+    - "*.months": a month-partitioned store, a directory with one table (by default .npcols)
+      per calendar month (UTC) and a "_partitions.json" manifest listing them.
+
+Columns are typed by name (see COLUMN_KINDS): user IDs and counts are int64, scores float32,
+MSIDs/MBIDs are 16-byte binary UUID keys ("S16", see interning.py; malformed UUIDs become the
+all-zero key), and anything else is text. In .npcols tables, text columns are stored dictionary-encoded as
+int32 codes plus a "<name>.categories.npy" array.
+
+Writing a CSV through TableWriter produces exactly the text the stages wrote before, so CSV
+stays available as an export format.
+
+Month-partitioned stores let a stage work on a time window at a cost proportional to the
+window. A listen store is written by PartitionedWriter, which routes each row to the partition
+of the month of its listened_at; derived stores (user-artist events, counts) are written by
+map_partitions, one partition per partition of their input. iter_table (and the stages on top
+of it) take a [since, until) date range and read only the partitions of the months it overlaps;
+rows of a partly covered month are filtered on listened_at, or kept whole by stores without it.
+"""
+
+import csv
+import json
+import os
+import shutil
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from src.utils.config import CSV_CHUNK_ROWS, READ_CHUNK_SIZE
+from src.utils.file_utils import csv_column, iter_chunks, open_input
+from src.utils.interning import KEY_DTYPE, key_uuids, uuid_keys
+
+NPCOLS_SUFFIX = ".npcols"
+PARQUET_SUFFIX = ".parquet"
+MONTHS_SUFFIX = ".months"
+
+# Manifest of a month-partitioned store, and the format of its partitions
+PARTITIONS_FILE = "_partitions.json"
+PARTITION_FORMAT = "npcols"
+# Column whose month (UTC) selects the partition of a listen
+TIME_COLUMN = "listened_at"
+
+# Column types by name; columns not listed are text.
+COLUMN_KINDS = {
+    "user_id": "int",
+    "listen_count": "int",
+    "listened_at": "int",
+    "recording_msid": "uuid",
+    "recording_mbid": "uuid",
+    "canonical_recording_mbid": "uuid",
+    "artist_id": "uuid",
+    # Exports of a trained model (see src/utils/batch_export.py)
+    "rank": "int",
+    "score": "float",
+    "similar_artist_id": "uuid",
+}
+
+_NUMPY_DTYPES = {"int": np.dtype(np.int64), "float": np.dtype(np.float32), "uuid": KEY_DTYPE,
+                 "str": np.dtype(np.int32)}
+
+NULL_KEY = np.zeros(1, dtype=KEY_DTYPE)[0]
+
+def column_kind(name):
+    """Returns the kind ("int", "float", "uuid" or "str") of a column."""
+    return COLUMN_KINDS.get(name, "str")
+
+def table_format(path):
+    """Returns the format ("csv", "parquet", "npcols" or "months") of a table path."""
+    path = path.rstrip("/\\")
+    if path.endswith(PARQUET_SUFFIX):
+        return "parquet"
+    if path.endswith(NPCOLS_SUFFIX):
+        return "npcols"
+    if path.endswith(MONTHS_SUFFIX):
+        return "months"
+    return "csv"
+
+def is_partitioned(path):
+    """Returns True if path is a month-partitioned store ("*.months")."""
+    return table_format(path) == "months"
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet tables require the pyarrow package")
+
+def to_array(name, values):
+    """Converts a sequence of Python values (e.g. CSV text) to the typed array of a column."""
+    kind = column_kind(name)
+    if kind == "int":
+        return np.asarray(values).astype(np.int64)
+    if kind == "float":
+        return np.asarray(values).astype(np.float32)
+    if kind == "uuid":
+        if isinstance(values, np.ndarray) and values.dtype == KEY_DTYPE:
+            return values
+        return uuid_keys(values)[0]
+    return np.asarray(values, dtype=object)
+
+def to_text(name, values):
+    """Converts a typed column array to a list of values that csv.writer renders as before."""
+    values = np.asarray(values)
+    if column_kind(name) == "uuid" and values.dtype == KEY_DTYPE:
+        return key_uuids(values)
+    if column_kind(name) == "float":
+        # The shortest text that reads back as the same float32 (tolist() would print float64 digits).
+        return values.astype(np.float32).astype(str).tolist()
+    return values.tolist()
+
+def table_columns(path):
+    """Returns the column names of a table."""
+    fmt = table_format(path)
+    if fmt == "parquet":
+        _require_pyarrow()
+        return pq.ParquetFile(path).schema_arrow.names
+    if fmt == "months":
+        return read_partitions(path)["columns"]
+    if fmt == "npcols":
+        with open(os.path.join(path, "_meta.json"), encoding="utf-8") as fp:
+            return json.load(fp)["columns"]
+    with open_input(path, errors="replace") as fp:
+        return next(csv.reader(fp))
+
+def table_size(path, since=None, until=None):
+    """
+    Returns the size of a table on disk in bytes (for progress bars); for a month-partitioned
+    store, the size of the partitions overlapping [since, until).
+    """
+    if is_partitioned(path):
+        return sum(table_size(partition_path(path, month)) for month in select_partitions(path, since, until))
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+class TableWriter:
+    """
+    Writes a table chunk by chunk, in the format given by the path.
+
+    Use write_rows() with rows of Python values (as for csv.writer) or write_columns() with a
+    dict of column arrays; both can be mixed. Use as a context manager, or call close().
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.format = table_format(path)
+        self.num_rows = 0
+        if self.format == "months":
+            raise ValueError(f"{path} is a month-partitioned store; write it with PartitionedWriter "
+                             f"(see open_table_writer) or map_partitions")
+        parent = os.path.dirname(os.path.abspath(path.rstrip("/\\")))
+        os.makedirs(parent, exist_ok=True)
+        if self.format == "csv":
+            self._fp = open(path, "w", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._fp)
+            self._writer.writerow(self.columns)
+        elif self.format == "parquet":
+            _require_pyarrow()
+            self._schema = pa.schema([(name, _arrow_type(name)) for name in self.columns])
+            self._writer = pq.ParquetWriter(path, self._schema)
+        else:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+            self._raw = {name: open(os.path.join(path, name + ".raw"), "wb") for name in self.columns}
+            self._categories = {name: {} for name in self.columns if column_kind(name) == "str"}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write_rows(self, rows):
+        """Writes a list of rows (sequences of Python values in column order)."""
+        if not rows:
+            return
+        if self.format == "csv":
+            self._writer.writerows(rows)
+            self.num_rows += len(rows)
+            return
+        columns = {name: to_array(name, csv_column(rows, i)) for i, name in enumerate(self.columns)}
+        self.write_columns(columns)
+
+    def write_columns(self, data):
+        """Writes a chunk given as a dict of equally long column arrays (typed or Python values)."""
+        arrays = [data[name] for name in self.columns]
+        num_rows = len(arrays[0])
+        if num_rows == 0:
+            return
+        if self.format == "csv":
+            self._writer.writerows(zip(*(to_text(name, array) for name, array in zip(self.columns, arrays))))
+        elif self.format == "parquet":
+            batch = pa.record_batch([_to_arrow(name, array) for name, array in zip(self.columns, arrays)],
+                                    schema=self._schema)
+            self._writer.write_batch(batch)
+        else:
+            for name, array in zip(self.columns, arrays):
+                if column_kind(name) == "str":
+                    categories = self._categories[name]
+                    codes = [categories.setdefault(value, len(categories)) for value in np.asarray(array).tolist()]
+                    array = np.array(codes, dtype=np.int32)
+                else:
+                    array = to_array(name, array)
+                self._raw[name].write(np.ascontiguousarray(array, dtype=_NUMPY_DTYPES[column_kind(name)]).tobytes())
+        self.num_rows += num_rows
+
+    def close(self):
+        if self.format == "csv":
+            self._fp.close()
+        elif self.format == "parquet":
+            self._writer.close()
+        else:
+            for name, raw in self._raw.items():
+                raw.close()
+                _raw_to_npy(os.path.join(self.path, name), _NUMPY_DTYPES[column_kind(name)], self.num_rows)
+            for name, categories in self._categories.items():
+                np.save(os.path.join(self.path, name + ".categories.npy"), np.array(list(categories), dtype=str))
+            with open(os.path.join(self.path, "_meta.json"), "w", encoding="utf-8") as fp:
+                json.dump({"columns": self.columns, "num_rows": self.num_rows}, fp)
+
+def _raw_to_npy(prefix, dtype, num_rows):
+    """Turns a file of raw array bytes into a .npy file (header + data), then removes it."""
+    array = np.lib.format.open_memmap(prefix + ".npy", mode="w+", dtype=dtype, shape=(num_rows,))
+    flat = array.view(np.uint8).reshape(-1) if num_rows else None
+    with open(prefix + ".raw", "rb") as fp:
+        offset = 0
+        while True:
+            block = fp.read(READ_CHUNK_SIZE)
+            if not block:
+                break
+            flat[offset:offset + len(block)] = np.frombuffer(block, dtype=np.uint8)
+            offset += len(block)
+    array.flush()
+    del array
+    os.remove(prefix + ".raw")
+
+def time_bound(value):
+    """
+    Converts a bound of a date range to Unix seconds. Accepts None (unbounded), a Unix
+    timestamp (int or digit string) or an ISO 8601 date or time in UTC, e.g. "2024-03",
+    "2024-03-15" or "2024-03-15T12:00".
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    value = str(value).strip()
+    if value.lstrip("-").isdigit():
+        return int(value)
+    return int(np.datetime64(value, "s").astype(np.int64))
+
+def month_names(timestamps):
+    """The "YYYY-MM" partition name (UTC month) of each Unix timestamp, as an array of str."""
+    months = np.asarray(timestamps, dtype=np.int64).astype("datetime64[s]").astype("datetime64[M]")
+    return np.datetime_as_string(months, unit="M")
+
+def month_bounds(month):
+    """The [start, end) Unix seconds of a "YYYY-MM" month."""
+    start = np.datetime64(month, "M")
+    return int(start.astype("datetime64[s]").astype(np.int64)), int((start + 1).astype("datetime64[s]").astype(np.int64))
+
+def read_partitions(path):
+    """Returns the manifest of a month-partitioned store (columns, format, months)."""
+    with open(os.path.join(path, PARTITIONS_FILE), encoding="utf-8") as fp:
+        return json.load(fp)
+
+def write_partitions(path, columns, months, partition_format=PARTITION_FORMAT, **info):
+    """
+    Writes the manifest of a month-partitioned store. Call it after the partitions are
+    written; it replaces the previous manifest atomically.
+    """
+    manifest = {"columns": list(columns), "format": partition_format, "months": sorted(months), **info}
+    tmp_path = os.path.join(path, PARTITIONS_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_path, os.path.join(path, PARTITIONS_FILE))
+
+def partition_path(path, month, partition_format=None):
+    """Path of the partition of a month in a store (of the format in its manifest by default)."""
+    partition_format = partition_format or read_partitions(path)["format"]
+    suffix = {"parquet": PARQUET_SUFFIX, "npcols": NPCOLS_SUFFIX}.get(partition_format, ".csv")
+    return os.path.join(path, month + suffix)
+
+def select_partitions(path, since=None, until=None):
+    """The months of a store overlapping the date range [since, until), in order."""
+    since, until = time_bound(since), time_bound(until)
+    selected = []
+    for month in read_partitions(path)["months"]:
+        start, end = month_bounds(month)
+        if (since is None or end > since) and (until is None or start < until):
+            selected.append(month)
+    return selected
+
+def _check_whole_months(path, since, until):
+    """
+    Raises ValueError if [since, until) cuts into a month of a store without listened_at,
+    whose partitions can only be read whole. A bound inside a month is accepted where the
+    store itself was written from that bound on (its manifest's since / until), as
+    map_partitions does for a range that is not month-aligned.
+    """
+    manifest = read_partitions(path)
+    for bound, name in ((since, "since"), (until, "until")):
+        if bound is None or bound == month_bounds(month_names([bound])[0])[0]:
+            continue
+        stored = manifest.get(name)
+        if stored is not None and (bound <= stored if name == "since" else bound >= stored):
+            continue
+        raise ValueError(f"{path} has no {TIME_COLUMN} column, so it is read by whole months; "
+                         f"{name}={bound} is not the start of a month")
+
+def _create_store(path):
+    path = path.rstrip("/\\")
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+class PartitionedWriter:
+    """
+    Writes a month-partitioned store: every row goes to the partition of the month (UTC) of
+    its listened_at, one TableWriter per month. Same interface as TableWriter; the manifest is
+    written on close(), and leaving a with-block on an exception calls abort() instead, which
+    deletes the store, so an interrupted write leaves no readable store.
+    """
+
+    def __init__(self, path, columns, partition_format=PARTITION_FORMAT):
+        if TIME_COLUMN not in columns:
+            raise ValueError(f"A month-partitioned store needs a {TIME_COLUMN} column")
+        self.path = path.rstrip("/\\")
+        self.columns = list(columns)
+        self.partition_format = partition_format
+        self.num_rows = 0
+        self._writers = {}
+        _create_store(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def write_rows(self, rows):
+        """Writes a list of rows (sequences of Python values in column order)."""
+        if rows:
+            self.write_columns({name: to_array(name, csv_column(rows, i)) for i, name in enumerate(self.columns)})
+
+    def write_columns(self, data):
+        """Writes a chunk given as a dict of equally long column arrays, split by month."""
+        arrays = {name: to_array(name, data[name]) for name in self.columns}
+        if not len(arrays[TIME_COLUMN]):
+            return
+        months, inverse = np.unique(month_names(arrays[TIME_COLUMN]), return_inverse=True)
+        # Row positions grouped by month, each group in chunk order.
+        groups = np.split(np.argsort(inverse.reshape(-1), kind="stable"), np.cumsum(np.bincount(inverse.reshape(-1)))[:-1])
+        for month, rows in zip(months.tolist(), groups):
+            writer = self._writers.get(month)
+            if writer is None:
+                writer = TableWriter(partition_path(self.path, month, self.partition_format), self.columns)
+                self._writers[month] = writer
+            writer.write_columns({name: array[rows] for name, array in arrays.items()})
+        self.num_rows += len(arrays[TIME_COLUMN])
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        write_partitions(self.path, self.columns, self._writers, self.partition_format)
+
+    def abort(self):
+        """Closes the partition writers and deletes the store, without writing its manifest."""
+        for writer in self._writers.values():
+            try:
+                writer.close()
+            except Exception:
+                pass  # the store is deleted anyway
+        self._writers = {}
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def open_table_writer(path, columns):
+    """A PartitionedWriter for a "*.months" path, else a TableWriter."""
+    return PartitionedWriter(path, columns) if is_partitioned(path) else TableWriter(path, columns)
+
+def map_partitions(source, destination, columns, write_partition, since=None, until=None):
+    """
+    Writes the store `destination` one partition per month of the store `source` overlapping
+    [since, until): write_partition(path, start, end) writes the table at path, with the
+    given columns, from the rows of source in [start, end) (the month, clipped to the range).
+    The partitions have the format of those of source.
+
+    Returns:
+        list: The months written.
+    """
+    if not is_partitioned(source):
+        raise ValueError(f"{destination} is month-partitioned, so its input {source} must be a "
+                         f"month-partitioned store ({MONTHS_SUFFIX}) too")
+    since, until = time_bound(since), time_bound(until)
+    partition_format = read_partitions(source)["format"]
+    months = select_partitions(source, since, until)
+    _create_store(destination)
+    for month in months:
+        start, end = month_bounds(month)
+        write_partition(partition_path(destination, month, partition_format),
+                        start if since is None else max(start, since), end if until is None else min(end, until))
+    write_partitions(destination, columns, months, partition_format, since=since, until=until)
+    return months
+
+def _arrow_type(name):
+    kind = column_kind(name)
+    if kind == "int":
+        return pa.int64()
+    if kind == "float":
+        return pa.float32()
+    if kind == "uuid":
+        return pa.binary(16)
+    return pa.string()
+
+def _to_arrow(name, array):
+    kind = column_kind(name)
+    array = to_array(name, array)
+    if kind == "uuid":
+        keys = np.ascontiguousarray(array, dtype=KEY_DTYPE)
+        return pa.FixedSizeBinaryArray.from_buffers(pa.binary(16), len(keys), [None, pa.py_buffer(keys.tobytes())])
+    if kind == "int":
+        return pa.array(array, type=pa.int64())
+    if kind == "float":
+        return pa.array(array, type=pa.float32())
+    return pa.array(array.tolist(), type=pa.string())
+
+def _from_arrow(name, array):
+    kind = column_kind(name)
+    if kind == "uuid":
+        if array.null_count:
+            array = array.fill_null(bytes(16))
+        data = np.frombuffer(array.buffers()[1], dtype=KEY_DTYPE)
+        return data[array.offset:array.offset + len(array)]
+    if kind == "int":
+        return array.to_numpy(zero_copy_only=False).astype(np.int64, copy=False)
+    if kind == "float":
+        return array.to_numpy(zero_copy_only=False).astype(np.float32, copy=False)
+    return np.asarray(array.to_pylist(), dtype=object)
+
+def iter_table(path, columns=None, chunk_rows=CSV_CHUNK_ROWS, progress=None, errors="strict", since=None, until=None):
+    """
+    Reads a table chunk by chunk.
+
+    Parameters:
+        path (str): Table path (.csv / .csv.zst, .parquet, .npcols or a .months store).
+        columns (list): Columns to read (default: all).
+        chunk_rows (int): Rows per chunk.
+        progress (callable): Optional callback receiving the number of bytes (CSV) or the
+                             approximate share of the on-disk size (other formats) read.
+        errors (str): Text decoding error handling for CSV input.
+        since, until: Optional date range [since, until) (see time_bound). A store only reads
+                      the partitions of the months it overlaps; other tables are filtered on
+                      their listened_at column. A store without listened_at (e.g. counts)
+                      is read by whole months, so its bounds must be month starts, or the
+                      bounds it was written for (ValueError otherwise).
+
+    Yields:
+        dict: column name -> typed NumPy array, for each chunk.
+    """
+    since, until = time_bound(since), time_bound(until)
+    if is_partitioned(path):
+        store_columns = read_partitions(path)["columns"]
+        columns = columns or store_columns
+        if TIME_COLUMN not in store_columns:
+            _check_whole_months(path, since, until)
+        for month in select_partitions(path, since, until):
+            start, end = month_bounds(month)
+            partition = partition_path(path, month)
+            if TIME_COLUMN not in store_columns or ((since is None or since <= start) and (until is None or end <= until)):
+                # Whole month (stores without listened_at are selected by whole months).
+                yield from _iter_table(partition, columns, chunk_rows, progress, errors)
+            else:
+                yield from _iter_time_range(partition, columns, chunk_rows, progress, errors, since, until)
+    elif since is None and until is None:
+        yield from _iter_table(path, columns, chunk_rows, progress, errors)
+    else:
+        if TIME_COLUMN not in table_columns(path):
+            raise ValueError(f"{path} has no {TIME_COLUMN} column to select a date range on")
+        yield from _iter_time_range(path, columns, chunk_rows, progress, errors, since, until)
+
+def _iter_time_range(path, columns, chunk_rows, progress, errors, since, until):
+    """The chunks of a (non-partitioned) table, keeping the rows whose listened_at is in [since, until)."""
+    columns = columns or table_columns(path)
+    read_columns = columns if TIME_COLUMN in columns else columns + [TIME_COLUMN]
+    for chunk in _iter_table(path, read_columns, chunk_rows, progress, errors):
+        times = chunk[TIME_COLUMN]
+        keep = np.ones(len(times), dtype=bool)
+        if since is not None:
+            keep &= times >= since
+        if until is not None:
+            keep &= times < until
+        if keep.any():
+            yield {name: chunk[name][keep] for name in columns}
+
+def _iter_table(path, columns, chunk_rows, progress, errors):
+    fmt = table_format(path)
+    if fmt == "csv":
+        with open_input(path, progress=progress, errors=errors) as fp:
+            reader = csv.reader(fp)
+            header = next(reader)
+            columns = columns or header
+            indices = [header.index(name) for name in columns]
+            for rows in iter_chunks(reader, chunk_rows):
+                yield {name: to_array(name, csv_column(rows, i)) for name, i in zip(columns, indices)}
+        return
+
+    size = table_size(path)
+    if fmt == "parquet":
+        _require_pyarrow()
+        parquet = pq.ParquetFile(path)
+        columns = columns or parquet.schema_arrow.names
+        total_rows = max(parquet.metadata.num_rows, 1)
+        for batch in parquet.iter_batches(batch_size=chunk_rows, columns=columns):
+            if progress:
+                progress(size * batch.num_rows // total_rows)
+            yield {name: _from_arrow(name, batch.column(name)) for name in columns}
+        return
+
+    columns = columns or table_columns(path)
+    arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in columns}
+    categories = {
+        name: np.load(os.path.join(path, name + ".categories.npy"))
+        for name in columns if column_kind(name) == "str"
+    }
+    total_rows = len(arrays[columns[0]]) if columns else 0
+    for start in range(0, total_rows, chunk_rows):
+        stop = min(start + chunk_rows, total_rows)
+        chunk = {}
+        for name in columns:
+            values = np.asarray(arrays[name][start:stop])
+            chunk[name] = categories[name][values].astype(object) if name in categories else values
+        if progress:
+            progress(size * (stop - start) // max(total_rows, 1))
+        yield chunk
+
+def read_table(path, columns=None, since=None, until=None):
+    """
+    Reads a whole table, or its rows in the date range [since, until) (see iter_table). For
+    .npcols tables read whole, numeric and UUID columns are returned memory-mapped (no copy,
+    no parsing).
+
+    Returns:
+        dict: column name -> typed NumPy array.
+    """
+    if table_format(path) == "npcols" and since is None and until is None:
+        columns = columns or table_columns(path)
+        table = {}
+        for name in columns:
+            values = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            if column_kind(name) == "str":
+                values = np.load(os.path.join(path, name + ".categories.npy"))[values].astype(object)
+            table[name] = values
+        return table
+    chunks = list(iter_table(path, columns, chunk_rows=10 * CSV_CHUNK_ROWS, since=since, until=until))
+    if not chunks:
+        columns = columns or table_columns(path)
+        return {name: np.empty(0, dtype=_NUMPY_DTYPES[column_kind(name)] if column_kind(name) != "str" else object)
+                for name in columns}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+def copy_table(source, destination, columns=None):
+    """
+    Converts a table to another format (e.g. .npcols -> .csv for export, or a listens table
+    with listened_at -> a .months store).
+    """
+    columns = columns or table_columns(source)
+    with open_table_writer(destination, columns) as writer:
+        for chunk in iter_table(source, columns):
+            writer.write_columns(chunk)
+
+def concat_tables(sources, destination):
+    """
+    Concatenates tables with the same columns (in the given order) into destination, e.g. the
+    shards written by parallel workers. CSV tables are concatenated byte-wise, keeping a single
+    header. Month-partitioned stores are concatenated month by month.
+    """
+    if is_partitioned(destination):
+        partition_format = read_partitions(sources[0])["format"]
+        source_months = [set(read_partitions(source)["months"]) for source in sources]
+        months = sorted(set().union(*source_months))
+        _create_store(destination)
+        for month in months:
+            concat_tables([partition_path(source, month) for source, owned in zip(sources, source_months)
+                           if month in owned], partition_path(destination, month, partition_format))
+        write_partitions(destination, table_columns(sources[0]), months, partition_format)
+        return
+    if table_format(destination) != "csv":
+        with TableWriter(destination, table_columns(sources[0])) as writer:
+            for source in sources:
+                for chunk in iter_table(source):
+                    writer.write_columns(chunk)
+        return
+    with open(destination, 'wb') as outfile:
+        for i, source in enumerate(sources):
+            with open(source, 'rb') as infile:
+                header = infile.readline()
+                if i == 0:
+                    outfile.write(header)
+                shutil.copyfileobj(infile, outfile, READ_CHUNK_SIZE)
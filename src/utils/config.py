@@ -10,8 +10,27 @@ RAW_DATA_PATH = EXTERNAL_DRIVE_PATH
 # Directory for processed (working) files
 WORKING_DIR = os.path.join(EXTERNAL_DRIVE_PATH, "working")
 
+# Raw input files used by src/preprocessing/run_pipeline.py (each can be overridden on the command line)
+LISTENS_FILE = os.path.join(RAW_DATA_PATH, "1.listens.zst")
+MSID_MAPPING_FILE = os.path.join(RAW_DATA_PATH, "listenbrainz_msid_mapping.csv-003.zst")
+CANONICAL_REDIRECT_FILE = os.path.join(RAW_DATA_PATH, "canonical_recording_redirect.csv.zst")
+CANONICAL_METADATA_FILE = os.path.join(RAW_DATA_PATH, "canonical_musicbrainz_data.csv.zst")
+ARTIST_FILE = os.path.join(RAW_DATA_PATH, "musicbrainz_artist.csv")
+
 # Number of lines to inspect from a raw JSON Lines file
 NUM_INSPECT_LINES = 5
 
 # Extension for compressed files
 COMPRESSED_EXTENSION = ".zst"
+
+# Size of the chunks read from disk (and fed to the zstd decompressor) when streaming inputs
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Minimum size of the byte ranges an uncompressed listens file is split into for parallel extraction
+PARALLEL_CHUNK_SIZE = 256 * 1024 * 1024
+
+# Number of CSV rows converted to NumPy arrays at a time by the chunked loaders
+CSV_CHUNK_ROWS = 100_000
+
+# Subdirectory (next to a stage's output) where interned UUID dictionaries are persisted
+DICTIONARY_DIRNAME = "dictionaries"
@@ -1,16 +1,195 @@
+import hashlib
+import io
 import os
 import subprocess
+from itertools import islice
+
+import zstandard
+
+from src.utils.config import COMPRESSED_EXTENSION, PARALLEL_CHUNK_SIZE, READ_CHUNK_SIZE
 
 def decompress_if_needed(input_path):
     """
     Checks if the input file is compressed (.zst) and decompresses it if needed.
     Returns the path to the decompressed file.
+
+    Note: the preprocessing scripts now stream compressed inputs with open_input()
+    instead; this is kept for ad-hoc use (e.g. inspecting a dump with head).
     """
-    if input_path.endswith('.zst'):
+    if input_path.endswith(COMPRESSED_EXTENSION):
         # Remove exactly 4 characters (".zst") from the end
-        decompressed_path = input_path[:-4]
+        decompressed_path = input_path[:-len(COMPRESSED_EXTENSION)]
         if not os.path.exists(decompressed_path):
             print(f"Decompressing {input_path} to {decompressed_path} ...")
             subprocess.run(["unzstd", input_path], check=True)
         return decompressed_path
     return input_path
+
+class _ProgressReader(io.RawIOBase):
+    """
+    Raw binary reader that reports the number of bytes read from the underlying
+    file to a callback. Used to drive progress bars in on-disk (compressed) bytes.
+    """
+
+    def __init__(self, fp, callback):
+        self._fp = fp
+        self._callback = callback
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self._fp.readinto(buffer)
+        if n:
+            self._callback(n)
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._fp.close()
+        super().close()
+
+def open_input(input_path, progress=None, encoding="utf-8", errors="strict", binary_mode=False):
+    """
+    Opens an input file for reading as text. Files ending in .zst are decompressed
+    on the fly as a stream, so no decompressed copy is ever written to disk.
+
+    Parameters:
+        input_path (str): Path to a plain or zstd-compressed text file.
+        progress (callable): Optional callback called with the number of bytes read
+                             from disk (i.e. compressed bytes for .zst inputs).
+        encoding (str): Text encoding of the (decompressed) data.
+        errors (str): Error handling scheme passed to the text decoder.
+        binary_mode (bool): Return a buffered binary reader (yielding bytes lines) instead of text.
+
+    Returns:
+        A file object; close it (or use it in a with-statement) when done.
+    """
+    fp = open(input_path, "rb", buffering=0)
+    raw = _ProgressReader(fp, progress) if progress else fp
+
+    if input_path.endswith(COMPRESSED_EXTENSION):
+        dctx = zstandard.ZstdDecompressor()
+        # ListenBrainz dumps may consist of several zstd frames, keep reading across them.
+        binary = dctx.stream_reader(raw, read_size=READ_CHUNK_SIZE, read_across_frames=True)
+        binary = io.BufferedReader(binary, buffer_size=READ_CHUNK_SIZE)
+    else:
+        binary = io.BufferedReader(raw, buffer_size=READ_CHUNK_SIZE)
+
+    if binary_mode:
+        return binary
+    return io.TextIOWrapper(binary, encoding=encoding, errors=errors)
+
+def iter_chunks(iterable, size):
+    """
+    Yields lists of up to size consecutive items from iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def csv_column(rows, index):
+    """
+    Extracts one column from a list of csv.reader rows, using "" for rows that are too short
+    (as csv.DictReader does with None).
+    """
+    try:
+        return [row[index] for row in rows]
+    except IndexError:
+        return [row[index] if len(row) > index else "" for row in rows]
+
+def plan_shards(input_files, num_workers, chunk_size=PARALLEL_CHUNK_SIZE):
+    """
+    Splits the input files into shards of work. Compressed files cannot be split and form
+    one shard each; uncompressed files larger than chunk_size are split into byte ranges.
+
+    Returns:
+        list: (input_file, start, end) tuples; start/end are None for whole-file shards.
+    """
+    shards = []
+    for input_file in input_files:
+        size = os.path.getsize(input_file)
+        if input_file.endswith(COMPRESSED_EXTENSION) or size <= chunk_size:
+            shards.append((input_file, None, None))
+            continue
+        num_ranges = min(num_workers, -(-size // chunk_size))
+        bounds = [size * i // num_ranges for i in range(num_ranges + 1)]
+        shards.extend((input_file, start, end) for start, end in zip(bounds, bounds[1:]))
+    return shards
+
+def iter_byte_range(input_file, start, end):
+    """
+    Yields the lines of an uncompressed file that start within the byte range [start, end).
+    A line crossing the end boundary is read in full; the shard after it skips it.
+    """
+    with open(input_file, 'rb', buffering=READ_CHUNK_SIZE) as infile:
+        position = start
+        if start > 0:
+            # Skip the rest of the line that started in the previous range.
+            infile.seek(start - 1)
+            position = start - 1 + len(infile.readline())
+        while position < end:
+            line = infile.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+def iter_line_blocks(fp, block_size=READ_CHUNK_SIZE, limit=None):
+    """
+    Reads a binary stream in large blocks and yields lists of its lines (bytes, without the
+    trailing newline). Much cheaper than iterating line by line when most lines are only
+    inspected with vectorized code.
+
+    Parameters:
+        fp: Binary file object.
+        block_size (int): Number of bytes read at a time.
+        limit (int): Optional number of bytes; only the lines starting within the first limit
+                     bytes are yielded (the last one is read in full).
+    """
+    position = 0
+    carry = b""
+    while limit is None or position < limit:
+        size = block_size if limit is None else min(block_size, limit - position)
+        block = fp.read(size)
+        if not block:
+            break
+        position += len(block)
+        lines = (carry + block).split(b"\n")
+        carry = lines.pop()
+        if lines:
+            yield lines
+    if carry:
+        # The last line started within the limit (or the stream has no final newline).
+        carry += fp.readline().rstrip(b"\n")
+        yield [carry]
+
+def iter_byte_range_blocks(input_file, start, end, block_size=READ_CHUNK_SIZE):
+    """
+    Same lines as iter_byte_range (those starting within [start, end) of an uncompressed
+    file), yielded in blocks like iter_line_blocks.
+    """
+    with open(input_file, 'rb') as infile:
+        position = start
+        if start > 0:
+            # Skip the rest of the line that started in the previous range.
+            infile.seek(start - 1)
+            position = start - 1 + len(infile.readline())
+        if position < end:
+            yield from iter_line_blocks(infile, block_size, limit=end - position)
+
+def file_checksum(input_path, block_size=READ_CHUNK_SIZE):
+    """
+    Returns the SHA-256 hex digest of a file's (on-disk) bytes, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(input_path, "rb") as fp:
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
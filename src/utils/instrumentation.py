@@ -0,0 +1,206 @@
+"""
+instrumentation.py
+------------------
+Performance measurements shared by the preprocessing stages.
+
+measure() wraps one run of a stage and records:
+
+    wall_seconds      elapsed time
+    cpu_seconds       user + system time of the process and of the child processes it waited
+                      for (e.g. the workers of a process pool)
+    peak_rss_mb       peak resident memory of the process or of its largest child; this is the
+                      peak since the process started, so run one stage per process (as the
+                      scripts and src/utils/pipeline.py do) to get the stage's own peak
+    bytes_read        bytes read and written through system calls by the process and its
+    bytes_written     finished children (/proc/self/io; None on systems without it). For a
+                      compressed input, the compressed bytes are counted.
+    rows              rows the stage reported with count_rows()
+    rows_per_second   rows / wall_seconds
+
+The stage functions call count_rows() with the number of input rows (listen lines, mapping
+rows, user events, ...) they processed; outside of measure() it does nothing. The metrics are
+printed to stderr and, if a report path is given, saved in a JSON report holding the latest
+metrics of each stage (see write_report).
+
+FreshProcessPool runs each of its tasks in a fresh process, for the callers (the pipeline,
+the benchmarks) that measure several stages or configurations side by side.
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Stages being measured (measure() calls can be nested, e.g. in a benchmark).
+_active = []
+
+def count_rows(rows):
+    """Adds rows to the row count of the stages being measured."""
+    for metrics in _active:
+        metrics.rows += int(rows)
+
+def _io_counters():
+    """Returns (bytes_read, bytes_written) of this process so far, or (None, None)."""
+    try:
+        with open("/proc/self/io", encoding="ascii") as fp:
+            fields = dict(line.split(": ") for line in fp.read().splitlines() if ": " in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def _peak_rss_mb(*usages):
+    # ru_maxrss is in KiB on Linux (bytes on macOS).
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(usage.ru_maxrss for usage in usages) * scale / 2**20
+
+class StageMetrics:
+    """Measurements of one run of a stage (see the module docstring)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self._self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._io = _io_counters()
+        self._started = time.perf_counter()
+        self.results = None
+
+    def stop(self):
+        """Takes the final measurements and returns them as a dict."""
+        wall_seconds = time.perf_counter() - self._started
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_seconds = sum(after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+                          for before, after in ((self._self_usage, self_usage),
+                                                (self._children_usage, children_usage)))
+        io = _io_counters()
+        bytes_read, bytes_written = ((after - before if None not in (before, after) else None)
+                                     for before, after in zip(self._io, io))
+        self.results = {
+            "stage": self.name,
+            "started_at": self.started_at,
+            "wall_seconds": wall_seconds,
+            "cpu_seconds": cpu_seconds,
+            "peak_rss_mb": _peak_rss_mb(self_usage, children_usage),
+            "bytes_read": bytes_read,
+            "bytes_written": bytes_written,
+            "rows": self.rows,
+            "rows_per_second": self.rows / wall_seconds if wall_seconds else 0.0,
+        }
+        return self.results
+
+def format_metrics(results):
+    """One-line summary of the metrics returned by StageMetrics.stop."""
+    def mb(value):
+        return "n/a" if value is None else f"{value / 2**20:,.1f} MB"
+    return (f"[{results['stage']}] {results['wall_seconds']:.1f}s wall, {results['cpu_seconds']:.1f}s CPU, "
+            f"peak RSS {results['peak_rss_mb']:,.0f} MB, read {mb(results['bytes_read'])}, "
+            f"wrote {mb(results['bytes_written'])}, {results['rows']:,} rows "
+            f"({results['rows_per_second']:,.0f} rows/sec)")
+
+def write_report(report_path, results):
+    """
+    Saves the metrics of a stage run into the JSON report at report_path, as
+    {"stages": {<stage>: <metrics>}}. Metrics of other stages already in the report are kept,
+    so the stages of a pipeline can share one report.
+    """
+    report = {"stages": {}}
+    if os.path.exists(report_path):
+        with open(report_path, encoding="utf-8") as fp:
+            report = json.load(fp)
+    report.setdefault("stages", {})[results["stage"]] = results
+    directory = os.path.dirname(report_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(report_path + ".tmp", "w", encoding="utf-8") as fp:
+        json.dump(report, fp, indent=2)
+    os.replace(report_path + ".tmp", report_path)
+
+@contextlib.contextmanager
+def measure(name, report_path=None):
+    """
+    Measures the code run inside the with block as one run of stage `name`.
+
+    Parameters:
+        name (str): Stage name, the key of the metrics in the report.
+        report_path (str): Optional JSON report to save the metrics to (see write_report).
+
+    Yields the StageMetrics; its results dict is filled in when the block exits normally.
+    """
+    metrics = StageMetrics(name)
+    _active.append(metrics)
+    try:
+        yield metrics
+    finally:
+        _active.remove(metrics)
+    results = metrics.stop()
+    print(format_metrics(results), file=sys.stderr)
+    if report_path:
+        write_report(report_path, results)
+
+class FreshProcessPool:
+    """
+    A process pool that runs every task in a fresh process, at most max_workers at a time, so
+    the metrics measured in a task (its peak RSS in particular) are its own. It stands in for
+    ProcessPoolExecutor(max_tasks_per_child=1), which needs Python 3.11: each task gets a
+    single-worker ProcessPoolExecutor of its own, shut down as soon as the task is done.
+
+    submit() returns concurrent.futures.Future objects, so wait() and as_completed() work on
+    them as on those of a ProcessPoolExecutor.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._lock = threading.RLock()
+        self._queued = collections.deque()
+        self._executors = set()
+        self._futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs) and returns a Future of its result."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._futures.append(future)
+            self._queued.append((future, fn, args, kwargs))
+            self._start_queued()
+        return future
+
+    def _start_queued(self):
+        with self._lock:
+            while self._queued and len(self._executors) < self.max_workers:
+                future, fn, args, kwargs = self._queued.popleft()
+                future.set_running_or_notify_cancel()
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+                self._executors.add(executor)
+                task = executor.submit(fn, *args, **kwargs)
+                task.add_done_callback(functools.partial(self._task_done, future, executor))
+
+    def _task_done(self, future, executor, task):
+        # Called in the executor's management thread (or in submit if the task already ended).
+        executor.shutdown(wait=False)
+        with self._lock:
+            self._executors.discard(executor)
+            self._start_queued()
+        if task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def shutdown(self, wait=True):
+        """Waits for the submitted tasks to finish (with wait=True)."""
+        if wait:
+            concurrent.futures.wait(list(self._futures))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
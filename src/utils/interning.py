@@ -0,0 +1,471 @@
+"""
+interning.py
+------------
+Compact, array-backed replacements for the Python dicts and sets of UUID strings used by the
+preprocessing stages.
+
+A 36-character UUID string costs well over 100 bytes as a Python str, plus the dict/set slot
+that holds it. Here every UUID is stored as a 16-byte binary key in a sorted NumPy array
+(dtype "S16") and looked up with a vectorized binary search:
+
+    - UuidDictionary: sorted unique UUIDs; the position of a UUID is its compact integer ID.
+    - UuidMapping:    sorted UUID keys with one UUID value each (e.g. MSID -> MBID).
+    - UuidStringTable: sorted UUID keys with one text each (e.g. artist MBID -> name), the texts
+                      packed into one UTF-8 blob with an offsets array.
+    - KeyBitmap:      hashed bitmap of a key set, a cheap membership prefilter (no false
+                      negatives, a few false positives) to run before the exact lookups.
+    - KeyHashIndex:   open-addressing hash table from the keys of an array to their positions,
+                      for constant-time lookups where a binary search per key is too slow.
+
+They can be saved as .npy files and loaded back memory-mapped, so later pipeline stages reuse
+the dictionaries built by earlier ones instead of re-parsing the CSV dumps (see
+src/utils/lookup_store.py for how saved arrays are tied to the files they were built from).
+"""
+
+import os
+
+import numpy as np
+
+KEY_DTYPE = np.dtype("S16")
+
+# Positions of the hex digits (i.e. everything but the dashes) in a canonical UUID string.
+_DASHES = np.array([8, 13, 18, 23])
+_DIGITS = np.array([i for i in range(36) if i not in _DASHES])
+
+_HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+for _i, _c in enumerate(b"0123456789abcdef"):
+    _HEX_VALUES[_c] = _i
+for _i, _c in enumerate(b"ABCDEF"):
+    _HEX_VALUES[_c] = 10 + _i
+_HEX_CHARS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+def _as_ascii(values):
+    """Converts a sequence of strings to a fixed-width "S36" array; non-ASCII entries become empty."""
+    try:
+        return np.asarray(values, dtype="S36")
+    except UnicodeEncodeError:
+        return np.array([v if v.isascii() else "" for v in values], dtype="S36")
+
+def uuid_keys(values):
+    """
+    Converts UUID strings to 16-byte binary keys, vectorized.
+
+    Parameters:
+        values (sequence): UUID strings in canonical 8-4-4-4-12 form.
+
+    Returns:
+        tuple: (keys, valid) where keys is an "S16" array and valid a boolean array flagging
+               the entries that were well-formed UUIDs (invalid entries get an all-zero key).
+    """
+    raw = _as_ascii(values)
+    if raw.dtype.itemsize < 36:
+        raw = raw.astype("S36")
+    chars = raw.view(np.uint8).reshape(-1, 36)
+    nibbles = _HEX_VALUES[chars[:, _DIGITS]]
+    valid = (nibbles != 255).all(axis=1) & (chars[:, _DASHES] == ord("-")).all(axis=1)
+    nibbles[~valid] = 0
+    packed = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+    keys = np.ascontiguousarray(packed).view(KEY_DTYPE).reshape(-1)
+    return keys, valid
+
+def key_uuids(keys):
+    """
+    Converts 16-byte binary keys back to canonical UUID strings, vectorized.
+
+    Returns:
+        list: UUID strings.
+    """
+    keys = np.ascontiguousarray(keys, dtype=KEY_DTYPE)
+    octets = keys.view(np.uint8).reshape(-1, 16)
+    digits = np.stack([octets >> 4, octets & 15], axis=2).reshape(-1, 32)
+    chars = np.full((len(keys), 36), ord("-"), dtype=np.uint8)
+    chars[:, _DIGITS] = _HEX_CHARS[digits]
+    return chars.view("S36").reshape(-1).astype(str).tolist()
+
+def _search(sorted_keys, keys):
+    """
+    Binary-searches keys in sorted_keys.
+
+    Returns:
+        tuple: (positions, found) arrays.
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+    positions = np.searchsorted(sorted_keys, keys)
+    np.minimum(positions, len(sorted_keys) - 1, out=positions)
+    found = sorted_keys[positions] == keys
+    return positions, found
+
+def save_array(path, array):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Write to a temporary name first so a crashed run never leaves a truncated dictionary behind.
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+class UuidDictionary:
+    """
+    Sorted set of unique UUIDs. The position of a UUID in the dictionary is its integer ID.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    @classmethod
+    def from_keys(cls, key_chunks):
+        """Builds a dictionary from one or more arrays of (possibly repeated) binary keys."""
+        keys = np.concatenate(list(key_chunks)) if key_chunks else np.empty(0, dtype=KEY_DTYPE)
+        return cls(np.unique(keys.astype(KEY_DTYPE, copy=False)))
+
+    @classmethod
+    def from_uuids(cls, values):
+        """Builds a dictionary from UUID strings, ignoring malformed ones."""
+        keys, valid = uuid_keys(values)
+        return cls.from_keys([keys[valid]])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, value):
+        keys, valid = uuid_keys([value])
+        return bool(valid[0] and self.contains_keys(keys)[0])
+
+    def contains_keys(self, keys):
+        """Vectorized membership test for binary keys."""
+        return _search(self.keys, keys)[1]
+
+    def encode_keys(self, keys):
+        """Maps binary keys to integer IDs (-1 for keys not in the dictionary)."""
+        positions, found = _search(self.keys, keys)
+        return np.where(found, positions, -1)
+
+    def encode(self, values):
+        """Maps UUID strings to integer IDs (-1 for unknown or malformed UUIDs)."""
+        keys, valid = uuid_keys(values)
+        return np.where(valid, self.encode_keys(keys), -1)
+
+    def decode(self, ids):
+        """Maps integer IDs back to UUID strings."""
+        return key_uuids(self.keys[np.asarray(ids)])
+
+    def save(self, path):
+        save_array(path, self.keys)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        return cls(np.load(path, mmap_mode=mmap_mode))
+
+class UuidMapping:
+    """
+    UUID -> UUID mapping stored as two aligned arrays: sorted binary keys and their values.
+    """
+
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    @classmethod
+    def from_pairs(cls, key_chunks, value_chunks):
+        """
+        Builds a mapping from aligned arrays of binary keys and values. As with a dict built
+        from the same pairs, the last value seen for a repeated key wins.
+        """
+        if not key_chunks:
+            empty = np.empty(0, dtype=KEY_DTYPE)
+            return cls(empty, empty.copy())
+        keys = np.concatenate(list(key_chunks))
+        values = np.concatenate(list(value_chunks))
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        values = values[order]
+        # After a stable sort, the last occurrence of each key is the one before a change.
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        return cls(keys[last], values[last])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """
+        Vectorized lookup of binary keys.
+
+        Returns:
+            tuple: (values, found); values of missing keys are undefined.
+        """
+        positions, found = _search(self.keys, keys)
+        if len(self.values) == 0:
+            return np.zeros(len(keys), dtype=KEY_DTYPE), found
+        return self.values[positions], found
+
+    def get(self, keys, default=None):
+        """
+        Like dict.get, vectorized: returns the mapped values, and default[i] (or an
+        all-zero key when no default is given) where keys[i] is missing.
+        """
+        values, found = self.lookup(keys)
+        fallback = default if default is not None else np.zeros(len(keys), dtype=KEY_DTYPE)
+        return np.where(found, values, fallback), found
+
+    def save(self, prefix):
+        save_array(prefix + ".keys.npy", self.keys)
+        save_array(prefix + ".values.npy", self.values)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        return cls(np.load(prefix + ".keys.npy", mmap_mode=mmap_mode),
+                   np.load(prefix + ".values.npy", mmap_mode=mmap_mode))
+
+class UuidStringTable:
+    """
+    UUID -> text mapping (e.g. artist MBID -> name) in three arrays:
+
+        keys:    sorted 16-byte keys
+        offsets: int64, len(keys) + 1; the text of keys[i] is blob[offsets[i]:offsets[i + 1]]
+        blob:    uint8, the UTF-8 encoded texts, concatenated in key order
+
+    Loaded memory-mapped, opening a table costs nothing whatever its size, and a lookup (a
+    binary search and one slice of the blob) only reads the pages it touches. It answers the
+    dict lookups of the MBID -> name dicts it replaces (get, [], in), plus batch lookups.
+    """
+
+    SUFFIXES = (".keys.npy", ".offsets.npy", ".blob.npy")
+
+    def __init__(self, keys, offsets, blob):
+        self.keys = keys
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_pairs(cls, key_chunks, text_chunks):
+        """
+        Builds a table from aligned chunks of binary keys and texts (sequences of str). As with
+        a dict built from the same pairs, the last text seen for a repeated key wins.
+        """
+        keys = np.concatenate(list(key_chunks)) if key_chunks else np.empty(0, dtype=KEY_DTYPE)
+        texts = [text for chunk in text_chunks for text in chunk]
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        # After a stable sort, the last occurrence of each key is the one before a change.
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        encoded = [texts[i].encode("utf-8") for i in order[last].tolist()]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+        return cls(keys[last], offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _position(self, value):
+        """Position of a UUID string in the table, or None (a scalar binary search, for single lookups)."""
+        if not isinstance(value, str) or len(value) != 36 or value[8] + value[13] + value[18] + value[23] != "----":
+            return None
+        try:
+            key = bytes.fromhex(value.replace("-", ""))
+        except ValueError:
+            return None
+        if len(key) != 16 or not len(self.keys):
+            return None
+        position = min(int(np.searchsorted(self.keys, key)), len(self.keys) - 1)
+        # "S16" items drop their trailing zero bytes.
+        return position if self.keys[position] == key.rstrip(b"\0") else None
+
+    def __contains__(self, value):
+        return self._position(value) is not None
+
+    def __getitem__(self, value):
+        text = self.get(value)
+        if text is None:
+            raise KeyError(value)
+        return text
+
+    def _texts(self, positions):
+        starts = self.offsets[positions].tolist()
+        ends = self.offsets[np.asarray(positions) + 1].tolist()
+        return [self.blob[start:end].tobytes().decode("utf-8") for start, end in zip(starts, ends)]
+
+    def lookup_keys(self, keys, default=None):
+        """Texts of binary keys, as a list (default where a key is missing)."""
+        keys = np.asarray(keys, dtype=KEY_DTYPE)
+        positions, found = _search(self.keys, keys)
+        texts = self._texts(positions[found]) if len(self.keys) else []
+        result = [default] * len(keys)
+        for i, text in zip(np.flatnonzero(found).tolist(), texts):
+            result[i] = text
+        return result
+
+    def get(self, value, default=None):
+        """Text of a UUID string, or default if it is missing or malformed."""
+        position = self._position(value)
+        if position is None:
+            return default
+        return self.blob[self.offsets[position]:self.offsets[position + 1]].tobytes().decode("utf-8")
+
+    def get_many(self, values, default=None):
+        """Texts of many UUID strings, as a list (default for missing or malformed ones)."""
+        keys, valid = uuid_keys(list(values))
+        texts = self.lookup_keys(keys, default)
+        return [text if ok else default for text, ok in zip(texts, valid.tolist())]
+
+    def items(self, chunk_size=100_000):
+        """Yields the (UUID string, text) pairs in key order."""
+        for start in range(0, len(self.keys), chunk_size):
+            positions = np.arange(start, min(start + chunk_size, len(self.keys)))
+            yield from zip(key_uuids(self.keys[positions]), self._texts(positions))
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def save(self, prefix):
+        for suffix, array in zip(self.SUFFIXES, (self.keys, self.offsets, self.blob)):
+            save_array(prefix + suffix, array)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        return cls(*(np.load(prefix + suffix, mmap_mode=mmap_mode) for suffix in cls.SUFFIXES))
+
+def uuid_prefixes(raw):
+    """
+    Parses only the first 16 hex digits of UUID strings, i.e. the first 8 bytes of their keys,
+    vectorized. Cheaper than uuid_keys when only a hash of the key is needed (see KeyBitmap).
+
+    Parameters:
+        raw (numpy.ndarray): Fixed-width bytes array ("S18" or wider) starting with the UUIDs.
+
+    Returns:
+        tuple: (prefixes, valid) where prefixes is a uint64 array comparable with key_prefixes()
+               and valid flags the entries whose 16 digits are all hex.
+    """
+    chars = raw.view(np.uint8).reshape(len(raw), -1)
+    nibbles = _HEX_VALUES[chars[:, _DIGITS[:16]]]
+    valid = (nibbles != 255).all(axis=1)
+    packed = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+    return np.ascontiguousarray(packed).view(np.uint64).reshape(-1), valid
+
+def key_prefixes(keys):
+    """Returns the first 8 bytes of binary keys as uint64 values."""
+    return np.ascontiguousarray(keys, dtype=KEY_DTYPE).view(np.uint64)[::2]
+
+class KeyBitmap:
+    """
+    One-hash bloom filter over binary keys: a bit array indexed by a multiplicative hash of the
+    first 8 bytes of each key. The membership tests never miss a key of the set; with the
+    default 8 bits per key, about 1 in 8 other keys is reported as a (false) candidate.
+    """
+
+    _MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+    def __init__(self, bits, num_bits_log2):
+        self.bits = bits
+        self.num_bits_log2 = num_bits_log2
+
+    @classmethod
+    def from_keys(cls, keys, bits_per_key=8):
+        num_bits_log2 = max(6, int(np.ceil(np.log2(max(len(keys), 1) * bits_per_key))))
+        bitmap = cls(np.zeros(1 << (num_bits_log2 - 3), dtype=np.uint8), num_bits_log2)
+        # Chunked to bound the temporary hash arrays.
+        for start in range(0, len(keys), 1 << 22):
+            slots = bitmap._slots(key_prefixes(keys[start:start + (1 << 22)]))
+            np.bitwise_or.at(bitmap.bits, slots >> 3, (1 << (slots & 7)).astype(np.uint8))
+        return bitmap
+
+    def _slots(self, prefixes):
+        return (prefixes * self._MULTIPLIER) >> np.uint64(64 - self.num_bits_log2)
+
+    def might_contain_prefixes(self, prefixes):
+        """Vectorized prefilter on key prefixes: False means the key is certainly not in the set."""
+        slots = self._slots(prefixes)
+        return (self.bits[slots >> 3] >> (slots & 7).astype(np.uint8)) & 1 == 1
+
+    def might_contain(self, keys):
+        """Vectorized prefilter on binary keys: False means the key is certainly not in the set."""
+        return self.might_contain_prefixes(key_prefixes(keys))
+
+class KeyHashIndex:
+    """
+    Hash table from the binary keys of an array to their positions in it: an int32 slot array
+    (a power of two, at least twice the number of keys) holding key positions, or -1 for an
+    empty slot. A key hashes to a slot by a multiplicative hash of both of its 8-byte halves
+    (keys are not always random in their first bytes), with linear probing on collisions. At this load factor a lookup checks a
+    couple of slots on average, whatever the number of keys.
+
+    The slot array does not depend on the order of lookups, so it is built once and saved next
+    to the keys it indexes.
+    """
+
+    _MULTIPLIER = KeyBitmap._MULTIPLIER
+
+    def __init__(self, keys, slots):
+        self.keys = keys
+        self.slots = slots
+        self.num_slots_log2 = int(len(slots)).bit_length() - 1
+        self._mask = len(slots) - 1
+
+    @classmethod
+    def from_keys(cls, keys):
+        """Builds the index of an array of distinct binary keys (position i for keys[i])."""
+        num_slots_log2 = max(4, int(np.ceil(np.log2(max(len(keys), 1) * 2))))
+        index = cls(keys, np.full(1 << num_slots_log2, -1, dtype=np.int32))
+        # Insert all keys at once, in rounds: each round, every key not yet placed tries the next
+        # slot of its probe sequence, and the first key claiming an empty slot takes it.
+        pending = np.arange(len(keys))
+        home = index._home_slots(keys)
+        probe = 0
+        while len(pending):
+            slots = (home[pending] + probe) & index._mask
+            free = index.slots[slots] == -1
+            claimed, first = np.unique(slots[free], return_index=True)
+            index.slots[claimed] = pending[free][first]
+            placed = np.zeros(len(pending), dtype=bool)
+            placed[np.flatnonzero(free)[first]] = True
+            pending = pending[~placed]
+            probe += 1
+        return index
+
+    def _home_slots(self, keys):
+        halves = np.ascontiguousarray(keys, dtype=KEY_DTYPE).view(np.uint64).reshape(-1, 2)
+        mixed = (halves[:, 0] ^ (halves[:, 1] * self._MULTIPLIER)) * self._MULTIPLIER
+        return (mixed >> np.uint64(64 - self.num_slots_log2)).astype(np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def position(self, key):
+        """Position of one binary key in the indexed array, or -1."""
+        key = np.asarray([key], dtype=KEY_DTYPE)
+        slot = int(self._home_slots(key)[0])
+        key = key[0]
+        while True:
+            position = int(self.slots[slot])
+            if position < 0 or self.keys[position] == key:
+                return position
+            slot = (slot + 1) & self._mask
+
+    def positions(self, keys):
+        """Vectorized lookup: positions of binary keys in the indexed array (-1 for missing keys)."""
+        keys = np.asarray(keys, dtype=KEY_DTYPE)
+        result = np.full(len(keys), -1, dtype=np.int64)
+        pending = np.arange(len(keys))
+        slots = self._home_slots(keys)
+        # Each round checks one slot for every key still searched; a key is done once its slot
+        # holds it (found) or is empty (missing).
+        while len(pending):
+            positions = self.slots[slots]
+            occupied = positions >= 0
+            found = occupied.copy()
+            found[occupied] = self.keys[positions[occupied]] == keys[pending[occupied]]
+            result[pending[found]] = positions[found]
+            searching = occupied & ~found
+            pending = pending[searching]
+            slots = (slots[searching] + 1) & self._mask
+        return result
+
+    def save(self, prefix):
+        save_array(prefix + ".keys.npy", self.keys)
+        save_array(prefix + ".slots.npy", self.slots)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        return cls(np.load(prefix + ".keys.npy", mmap_mode=mmap_mode),
+                   np.load(prefix + ".slots.npy", mmap_mode=mmap_mode))
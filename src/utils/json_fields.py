@@ -0,0 +1,80 @@
+"""
+json_fields.py
+--------------
+Parsers that project a fixed set of top-level fields out of JSON Lines records.
+
+Three engines are available:
+    - "json":   full decode with the standard library json.loads (reference behaviour).
+    - "orjson": full decode with orjson, when it is installed.
+    - "scan":   byte-level scan that cuts each record right before its first nested object
+                and decodes only that flat head (with orjson when available). Records whose
+                requested fields are not all in the head, or whose head does not decode
+                cleanly, fall back to a full decode.
+
+All engines return the same Python values as json.loads for the projected fields, so the
+CSV written from them is identical.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENGINES = ("json", "orjson", "scan")
+
+def _full_decoder():
+    """Returns the fastest available full JSON decoder."""
+    return orjson.loads if orjson is not None else json.loads
+
+def _project(record, fields):
+    if not isinstance(record, dict):
+        return tuple(None for _ in fields)
+    return tuple(record.get(field) for field in fields)
+
+def _make_scanner(fields, decode):
+    def parse(line):
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        nested = line.find(b"{", 1)
+        if nested == -1 or not line.rstrip().endswith(b"}"):
+            # Flat record (nothing to skip) or truncated line (let the decoder report it).
+            return _project(decode(line), fields)
+        # Everything up to the last comma before the first nested object is a flat prefix
+        # of the top-level object; close it and decode only that. If the '{' found was
+        # inside a string, the head is not valid JSON and we fall back below.
+        cut = line.rfind(b",", 0, nested)
+        if cut != -1:
+            try:
+                head = decode(line[:cut] + b"}")
+            except ValueError:
+                head = None
+            if isinstance(head, dict) and all(field in head for field in fields):
+                return tuple(head[field] for field in fields)
+        return _project(decode(line), fields)
+
+    return parse
+
+def make_record_parser(fields, engine="json"):
+    """
+    Builds a function that parses one JSON Lines record and returns the values of the
+    requested top-level fields as a tuple (None for missing fields).
+
+    Parameters:
+        fields (sequence): Names of the top-level fields to project.
+        engine (str): One of "json", "orjson" or "scan" (see module docstring).
+
+    Returns:
+        callable: parse(line) -> tuple. Raises json.JSONDecodeError on invalid records.
+    """
+    fields = tuple(fields)
+    if engine == "json":
+        return lambda line: _project(json.loads(line), fields)
+    if engine == "orjson":
+        if orjson is None:
+            raise ImportError("The 'orjson' engine requires the orjson package")
+        return lambda line: _project(orjson.loads(line), fields)
+    if engine == "scan":
+        return _make_scanner(fields, _full_decoder())
+    raise ValueError(f"Unknown engine '{engine}', expected one of {', '.join(ENGINES)}")
@@ -0,0 +1,194 @@
+"""
+lookup_store.py
+---------------
+Persistent, memory-mapped indexes of the reference dumps (the ListenBrainz MSID mapping and the
+canonical redirect / metadata files), so that the preprocessing stages do not re-parse them on
+every run.
+
+An index is a set of .npy arrays sharing a path prefix, plus a "<prefix>.source.json" manifest
+that records the size and mtime of the file it was built from. The index is reused (opened
+memory-mapped, near-zero resident memory) while the source file still has that size and mtime,
+and rebuilt otherwise. The same manifests guard the dictionaries cached by filter_mapping.py and
+canonicalize.py.
+
+    - MsidMappingIndex: the MSID mapping dump sorted by binary MSID key, so filter_mapping.py
+      can binary-search the MSIDs it needs instead of scanning the whole dump.
+    - The canonical redirect and metadata indexes are UuidMappings (see src/utils/interning.py)
+      built by canonicalize.load_canonical_redirect / load_canonical_metadata.
+
+Build them once with src/preprocessing/build_indexes.py.
+"""
+
+import csv
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from src.utils.config import CSV_CHUNK_ROWS
+from src.utils.file_utils import csv_column, iter_chunks, open_input
+from src.utils.interning import KEY_DTYPE, key_uuids, save_array, uuid_keys
+
+# Bump when the layout of the saved indexes changes, so older indexes get rebuilt.
+INDEX_VERSION = 1
+
+MAPPING_COLUMNS = ["recording_msid", "recording_mbid", "match_type"]
+
+def source_fingerprint(source_path):
+    """Returns the identity of a source file: its absolute path, size and mtime."""
+    stat = os.stat(source_path)
+    return {"path": os.path.abspath(source_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def manifest_path(prefix):
+    return prefix + ".source.json"
+
+def read_manifest(prefix):
+    """Returns the manifest saved with an index, or None if there is none."""
+    try:
+        with open(manifest_path(prefix), encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def is_current(prefix, source_path):
+    """
+    Returns True if the index saved under prefix was built from source_path as it is now
+    (same path, size and mtime).
+    """
+    manifest = read_manifest(prefix)
+    return (manifest is not None and manifest.get("version") == INDEX_VERSION
+            and manifest.get("source") == source_fingerprint(source_path))
+
+def invalidate(prefix):
+    """Removes the manifest of an index, e.g. before rebuilding it."""
+    if os.path.exists(manifest_path(prefix)):
+        os.remove(manifest_path(prefix))
+
+def mark_built(prefix, source_path, **info):
+    """
+    Writes the manifest of an index built from source_path. Call it after the index arrays
+    are saved, so an interrupted build never looks current.
+    """
+    manifest = {"version": INDEX_VERSION, "source": source_fingerprint(source_path), **info}
+    tmp_path = manifest_path(prefix) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_path, manifest_path(prefix))
+
+class MsidMappingIndex:
+    """
+    The MSID mapping dump as aligned arrays sorted by MSID key (rows with the same MSID keep
+    their dump order):
+
+        keys:        16-byte recording_msid keys
+        mbids:       16-byte recording_mbid keys (all-zero where the dump has none)
+        match_types: int16 codes into match_type_names
+        rows:        line number of the row in the dump, to write selections in dump order
+    """
+
+    def __init__(self, keys, mbids, match_types, rows, match_type_names):
+        self.keys = keys
+        self.mbids = mbids
+        self.match_types = match_types
+        self.rows = rows
+        self.match_type_names = list(match_type_names)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, mapping_file):
+        """
+        Reads the mapping dump (CSV, possibly .zst) once. Rows with a malformed MSID are left
+        out, as no listen can match them.
+        """
+        names = {}
+        key_chunks, mbid_chunks, type_chunks, row_chunks = [], [], [], []
+        offset = 0
+        with open_input(mapping_file, errors="replace") as infile:
+            reader = csv.reader(infile)
+            header = next(reader)
+            msid_col, mbid_col, type_col = (header.index(name) for name in MAPPING_COLUMNS)
+            with tqdm(desc=f"Indexing {os.path.basename(mapping_file)}", unit="it") as pbar:
+                for rows in iter_chunks(reader, CSV_CHUNK_ROWS):
+                    keys, valid = uuid_keys(csv_column(rows, msid_col))
+                    mbids = uuid_keys(csv_column(rows, mbid_col))[0]
+                    types = np.array([names.setdefault(value, len(names))
+                                      for value in csv_column(rows, type_col)], dtype=np.int16)
+                    key_chunks.append(keys[valid])
+                    mbid_chunks.append(mbids[valid])
+                    type_chunks.append(types[valid])
+                    row_chunks.append(offset + np.flatnonzero(valid))
+                    offset += len(rows)
+                    pbar.update(len(rows))
+
+        def concat(chunks, dtype):
+            return np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+        keys = concat(key_chunks, KEY_DTYPE)
+        order = np.argsort(keys, kind="stable")
+        return cls(keys[order], concat(mbid_chunks, KEY_DTYPE)[order],
+                   concat(type_chunks, np.int16)[order], concat(row_chunks, np.int64)[order], names)
+
+    def save(self, prefix):
+        save_array(prefix + ".keys.npy", self.keys)
+        save_array(prefix + ".mbids.npy", self.mbids)
+        save_array(prefix + ".match_types.npy", self.match_types)
+        save_array(prefix + ".rows.npy", self.rows)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        manifest = read_manifest(prefix) or {}
+        return cls(np.load(prefix + ".keys.npy", mmap_mode=mmap_mode),
+                   np.load(prefix + ".mbids.npy", mmap_mode=mmap_mode),
+                   np.load(prefix + ".match_types.npy", mmap_mode=mmap_mode),
+                   np.load(prefix + ".rows.npy", mmap_mode=mmap_mode),
+                   manifest.get("match_type_names", []))
+
+    @classmethod
+    def open(cls, prefix, mapping_file):
+        """
+        Opens the index saved under prefix, building (or rebuilding) it first if it is missing
+        or mapping_file changed since it was built.
+
+        Returns:
+            tuple: (index, built) where built tells whether the index was (re)built.
+        """
+        if is_current(prefix, mapping_file):
+            return cls.load(prefix), False
+        invalidate(prefix)
+        index = cls.build(mapping_file)
+        index.save(prefix)
+        mark_built(prefix, mapping_file, match_type_names=index.match_type_names, rows=len(index))
+        return cls.load(prefix), True
+
+    def select(self, msid_keys, match_types):
+        """
+        Finds the rows whose MSID is in msid_keys (a sorted array of unique keys) and whose
+        match_type is one of match_types.
+
+        Returns:
+            numpy.ndarray: positions in the index, in dump order.
+        """
+        msid_keys = np.asarray(msid_keys, dtype=KEY_DTYPE)
+        start = np.searchsorted(self.keys, msid_keys, side="left")
+        counts = np.searchsorted(self.keys, msid_keys, side="right") - start
+        # Expand each [start, start + count) range into positions.
+        total = int(counts.sum())
+        ends = np.cumsum(counts)
+        positions = np.arange(total) + np.repeat(start - (ends - counts), counts)
+        wanted = [code for code, name in enumerate(self.match_type_names) if name in match_types]
+        positions = positions[np.isin(self.match_types[positions], wanted)]
+        return positions[np.argsort(self.rows[positions], kind="stable")]
+
+    def rows_at(self, positions):
+        """Returns the selected rows as [recording_msid, recording_mbid, match_type] text rows."""
+        msids = key_uuids(self.keys[positions])
+        mbid_keys = self.mbids[positions]
+        mbids = key_uuids(mbid_keys)
+        for i in np.flatnonzero(mbid_keys == np.zeros(1, dtype=KEY_DTYPE)):
+            mbids[i] = ""
+        names = self.match_type_names
+        return [[msid, mbid, names[code]] for msid, mbid, code in
+                zip(msids, mbids, self.match_types[positions].tolist())]
@@ -0,0 +1,418 @@
+"""
+matrix_store.py
+---------------
+The user x artist play matrix the CF model is trained on, built from a userid-artist-counts
+table and cached in binary form.
+
+PlayMatrix.build streams the counts table in chunks (of a month-partitioned counts store, only
+the months of a date range, summed). User IDs and artist keys get int32 codes
+as they are first seen (an incremental index over the unique values only), and the codes and
+counts go into preallocated int32 / float32 buffers, 12 bytes per row. The CSR arrays are then
+filled from those buffers in a single pass, without the full-size string columns,
+categoricals and COO copies of the old pandas loader. Rows and columns follow the order of the old pandas
+loader: users sorted as strings, artists sorted by MBID.
+
+A PlayMatrix is saved as .npy files sharing a path prefix (CSR indptr / indices / data, the
+int64 user IDs of the rows and the 16-byte artist keys of the columns), with a manifest tying
+it to the counts table it was built from (see src/utils/lookup_store.py). PlayMatrix.open
+loads the saved arrays while the table is unchanged, so restarting a notebook or a service
+does not parse the counts again.
+
+PlayMatrix.prune drops the long tail the model learns little from (artists heard by a single
+user, users with one artist, ...): min_support_masks applies minimum supports on both sides
+until they are stable, and the matrix of the survivors is re-indexed (see
+src/preprocessing/prune_counts.py for the pipeline stage).
+
+ArtistIndex maps artist MBIDs to matrix columns and back in constant time, for the similar
+artist queries and evaluation loops that look up many artists. Its hash table is built from
+the matrix columns once and saved with them (and with a model, see listenbrainz_model.py).
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from src.utils.columnar import (NULL_KEY, is_partitioned, iter_table, partition_path, pq, select_partitions,
+                                table_format, table_size, time_bound)
+from src.utils.config import CSV_CHUNK_ROWS
+from src.utils.interning import KEY_DTYPE, KeyHashIndex, UuidStringTable, key_uuids, save_array, uuid_keys
+from src.utils.lookup_store import invalidate, is_current, mark_built, read_manifest
+
+COUNT_COLUMNS = ["user_id", "artist_id", "listen_count"]
+
+# Rows read per chunk while building a matrix
+MATRIX_CHUNK_ROWS = 10 * CSV_CHUNK_ROWS
+# Matrix entries scanned at a time per pass of min_support_masks
+PRUNE_BLOCK_ENTRIES = 1 << 22
+
+class _IncrementalIndex:
+    """
+    Assigns int32 codes to values (int64 user IDs or 16-byte keys) in order of first appearance,
+    across chunks. Only the unique values are kept, sorted, for the lookups.
+    """
+
+    def __init__(self, dtype):
+        self.sorted_values = np.empty(0, dtype=dtype)
+        self.sorted_codes = np.empty(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.sorted_values)
+
+    def encode_unique(self, uniques):
+        """Returns the codes of an array of distinct values, assigning codes to the new ones."""
+        positions = np.searchsorted(self.sorted_values, uniques)
+        found = np.zeros(len(uniques), dtype=bool)
+        if len(self.sorted_values):
+            found = self.sorted_values[np.minimum(positions, len(self.sorted_values) - 1)] == uniques
+        codes = np.empty(len(uniques), dtype=np.int32)
+        codes[found] = self.sorted_codes[positions[found]]
+        new = ~found
+        if new.any():
+            codes[new] = np.arange(len(self), len(self) + int(new.sum()), dtype=np.int32)
+            # np.insert needs the new values in sorted order.
+            order = np.argsort(uniques[new], kind="stable")
+            self.sorted_values = np.insert(self.sorted_values, positions[new][order], uniques[new][order])
+            self.sorted_codes = np.insert(self.sorted_codes, positions[new][order], codes[new][order])
+        return codes
+
+    def ranks(self, order):
+        """
+        Returns the new code of every code, for the values sorted in `order` (positions into
+        sorted_values), as an int32 array indexed by code.
+        """
+        ranks = np.empty(len(self), dtype=np.int32)
+        ranks[self.sorted_codes[order]] = np.arange(len(self), dtype=np.int32)
+        return ranks
+
+def _iter_counts(counts_path, chunk_rows, since=None, until=None):
+    """
+    Yields, for each chunk of a counts table, the chunk's distinct user IDs and artist keys
+    with the position of every row's user and artist among them, and the listen counts:
+    (users, user_positions, artists, artist_positions, listen_counts). Rows with a malformed
+    artist_id are left out.
+    """
+    if table_format(counts_path) == "csv" and since is None and until is None:
+        # pandas' C parser is the fastest way to read CSV; only the distinct artist IDs of a
+        # chunk are packed into keys.
+        reader = pd.read_csv(counts_path, usecols=COUNT_COLUMNS, dtype={"user_id": np.int64, "artist_id": str},
+                             na_filter=False, chunksize=chunk_rows, encoding="utf-8")
+        chunks = ((chunk["user_id"].to_numpy(), pd.factorize(chunk["artist_id"]), chunk["listen_count"].to_numpy())
+                  for chunk in reader)
+        chunks = ((user_ids, uuid_keys(np.asarray(artist_ids, dtype=object)), artist_positions, counts)
+                  for user_ids, (artist_positions, artist_ids), counts in chunks)
+    else:
+        chunks = ((chunk["user_id"], np.unique(chunk["artist_id"], return_inverse=True), chunk["listen_count"])
+                  for chunk in iter_table(counts_path, COUNT_COLUMNS, chunk_rows=chunk_rows, since=since, until=until))
+        chunks = ((user_ids, (artists, artists != NULL_KEY), artist_positions.reshape(-1), counts)
+                  for user_ids, (artists, artist_positions), counts in chunks)
+    for user_ids, (artists, valid), artist_positions, counts in chunks:
+        if not valid.all():
+            keep = valid[artist_positions]
+            artist_positions = (np.cumsum(valid) - 1)[artist_positions[keep]]
+            artists, user_ids, counts = artists[valid], user_ids[keep], counts[keep]
+        user_positions, users = pd.factorize(user_ids)
+        yield users, user_positions, artists, artist_positions, counts
+
+def _estimate_rows(counts_path, users, user_positions, counts, since=None, until=None):
+    """Number of rows to preallocate for a counts table, given its first chunk."""
+    if is_partitioned(counts_path):
+        return sum(_estimate_rows(partition_path(counts_path, month), users, user_positions, counts)
+                   for month in select_partitions(counts_path, since, until))
+    fmt = table_format(counts_path)
+    if fmt == "npcols":
+        return len(np.load(os.path.join(counts_path, "user_id.npy"), mmap_mode="r"))
+    if fmt == "parquet":
+        return pq.ParquetFile(counts_path).metadata.num_rows
+    if not len(counts):
+        return 1
+    # CSV: size of the file over the average text length of the first chunk's rows, plus 5%
+    # (the buffers grow if that is too few, e.g. for a compressed file).
+    def digits(values):
+        return np.floor(np.log10(np.maximum(np.abs(values), 1))) + 1
+    row_bytes = 36 + 3 + digits(users)[user_positions].mean() + digits(counts).mean()
+    return int(table_size(counts_path) / row_bytes * 1.05) + 1
+
+def min_support_masks(plays, min_artist_users=1, min_user_artists=1, min_user_plays=0, min_artist_plays=0,
+                      block_entries=PRUNE_BLOCK_ENTRIES):
+    """
+    Users and artists of a play matrix that meet minimum supports: listened to by at least
+    min_artist_users users (and min_artist_plays plays) for an artist, at least min_user_artists
+    artists (and min_user_plays plays) for a user. Dropping one side lowers the support of the
+    other, so the filters are repeated until nothing changes.
+
+    Each pass streams the CSR arrays in blocks of about block_entries entries (so a
+    memory-mapped matrix is never loaded whole) and sums the surviving entries per user and
+    per artist; memory holds the per-user and per-artist sums only.
+
+    Returns:
+        tuple: (keep_users, keep_artists, passes), boolean masks of the rows and columns and
+               the number of passes made.
+    """
+    num_users, num_artists = plays.shape
+    indptr = plays.indptr
+    keep_users = np.ones(num_users, dtype=bool)
+    keep_artists = np.ones(num_artists, dtype=bool)
+    passes = 0
+    while True:
+        passes += 1
+        user_artists = np.zeros(num_users, dtype=np.int64)
+        user_plays = np.zeros(num_users, dtype=np.float64)
+        artist_users = np.zeros(num_artists, dtype=np.int64)
+        artist_plays = np.zeros(num_artists, dtype=np.float64)
+        start = 0
+        while start < num_users:
+            # Rows start:end hold about block_entries entries (at least one row).
+            end = max(int(np.searchsorted(indptr, indptr[start] + block_entries, side="right")) - 1, start + 1)
+            end = min(end, num_users)
+            entries = slice(int(indptr[start]), int(indptr[end]))
+            columns = np.asarray(plays.indices[entries])
+            counts = np.asarray(plays.data[entries])
+            rows = np.repeat(np.arange(start, end), np.diff(indptr[start:end + 1]))
+            alive = keep_users[rows] & keep_artists[columns]
+            rows, columns, counts = rows[alive] - start, columns[alive], counts[alive]
+            user_artists[start:end] = np.bincount(rows, minlength=end - start)
+            user_plays[start:end] = np.bincount(rows, weights=counts, minlength=end - start)
+            artist_users += np.bincount(columns, minlength=num_artists)
+            artist_plays += np.bincount(columns, weights=counts, minlength=num_artists)
+            start = end
+        users = keep_users & (user_artists >= max(min_user_artists, 1)) & (user_plays >= min_user_plays)
+        artists = keep_artists & (artist_users >= max(min_artist_users, 1)) & (artist_plays >= min_artist_plays)
+        if (users == keep_users).all() and (artists == keep_artists).all():
+            return keep_users, keep_artists, passes
+        keep_users, keep_artists = users, artists
+
+class ArtistIndex:
+    """
+    Artist MBID <-> matrix column lookups, over the 16-byte artist keys of the columns:
+
+        row / rows:    MBID(s) -> column, in constant time per MBID (a KeyHashIndex)
+        mbid / mbids:  column(s) -> MBID
+        name / names:  column(s) -> artist name, given an MBID -> name map: the string table
+                       written by artist_mapping.py (see listenbrainz_model.get_artist_map),
+                       looked up by key on demand, or a dict
+    """
+
+    def __init__(self, hash_index, names=None):
+        self.hash_index = hash_index
+        self.names_by_row = names
+        self.name_table = None
+
+    @classmethod
+    def from_keys(cls, keys, artist_map=None):
+        """Builds the index of the columns of a matrix from their artist keys."""
+        return cls(KeyHashIndex.from_keys(keys)).with_names(artist_map)
+
+    @classmethod
+    def from_mbids(cls, mbids, artist_map=None):
+        """
+        Builds the index from the artist MBIDs of the columns (e.g. the artists returned by
+        load_data_matrix). Malformed MBIDs get an all-zero key and are never found.
+        """
+        keys, _ = uuid_keys(list(mbids))
+        return cls.from_keys(keys, artist_map)
+
+    def with_names(self, artist_map):
+        """
+        Attaches the names of an MBID -> name map (UuidStringTable or dict) to the columns;
+        returns the index.
+        """
+        if isinstance(artist_map, UuidStringTable):
+            self.name_table, self.names_by_row = artist_map, None
+        elif artist_map is not None:
+            self.name_table = None
+            self.names_by_row = [artist_map.get(mbid) for mbid in self.mbids(np.arange(len(self)))]
+        return self
+
+    def __len__(self):
+        return len(self.hash_index)
+
+    @property
+    def keys(self):
+        return self.hash_index.keys
+
+    def row(self, mbid):
+        """
+        Column of an artist MBID.
+
+        Raises:
+            ValueError: If the MBID is malformed or not a column of the matrix.
+        """
+        keys, valid = uuid_keys([mbid])
+        row = self.hash_index.position(keys[0]) if valid[0] else -1
+        if row < 0:
+            raise ValueError("Not found")
+        return row
+
+    def rows(self, mbids):
+        """Vectorized row(): columns of many MBIDs, -1 for unknown or malformed ones."""
+        keys, valid = uuid_keys(list(mbids))
+        return np.where(valid, self.hash_index.positions(keys), -1)
+
+    def mbid(self, row):
+        return key_uuids(self.keys[row:row + 1])[0]
+
+    def mbids(self, rows):
+        """MBIDs of many columns, as a list of strings."""
+        return key_uuids(self.keys[np.asarray(rows, dtype=np.int64)])
+
+    def name(self, row, default="unknown"):
+        """Name of the artist of a column, or default if it is unknown (or no names are attached)."""
+        return self.names([row], default)[0]
+
+    def names(self, rows, default="unknown"):
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.name_table is not None:
+            return self.name_table.lookup_keys(self.keys[rows], default)
+        if self.names_by_row is None:
+            return [default] * len(rows)
+        names = [self.names_by_row[row] for row in rows.tolist()]
+        return [default if name is None else name for name in names]
+
+    def save(self, prefix):
+        """Saves the keys and hash table (not the names) under prefix."""
+        self.hash_index.save(prefix)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r", artist_map=None):
+        return cls(KeyHashIndex.load(prefix, mmap_mode)).with_names(artist_map)
+
+class PlayMatrix:
+    """
+    CSR play matrix (float32 listen counts, users x artists) with the IDs of its rows and columns:
+
+        plays:   scipy.sparse.csr_matrix
+        users:   int64 user IDs, one per row
+        artists: 16-byte artist MBID keys, one per column
+    """
+
+    def __init__(self, plays, users, artists, artist_index=None):
+        self.plays = plays
+        self.users = users
+        self.artists = artists
+        self._artist_index = artist_index
+
+    @classmethod
+    def build(cls, counts_path, chunk_rows=MATRIX_CHUNK_ROWS, since=None, until=None):
+        """
+        Builds the matrix from a userid-artist-counts table (.csv, .parquet, .npcols or a .months
+        store), in one streaming pass. Rows with a malformed artist_id are skipped; repeated
+        (user, artist) pairs are summed. Given a date range [since, until), a .months store
+        only contributes the counts of the months it overlaps, so since and until must be month
+        starts (see columnar.iter_table).
+        """
+        user_index = _IncrementalIndex(np.int64)
+        artist_index = _IncrementalIndex(KEY_DTYPE)
+        rows = cols = data = None
+        size = 0
+        for users, user_positions, artists, artist_positions, counts in _iter_counts(counts_path, chunk_rows,
+                                                                                     since, until):
+            if rows is None:
+                capacity = max(_estimate_rows(counts_path, users, user_positions, counts, since, until),
+                               len(counts), 1)
+                rows = np.empty(capacity, dtype=np.int32)
+                cols = np.empty(capacity, dtype=np.int32)
+                data = np.empty(capacity, dtype=np.float32)
+            if size + len(counts) > len(rows):
+                capacity = max(2 * len(rows), size + len(counts))
+                rows, cols, data = (np.resize(buffer, capacity) for buffer in (rows, cols, data))
+            end = size + len(counts)
+            np.take(user_index.encode_unique(users), user_positions, out=rows[size:end])
+            np.take(artist_index.encode_unique(artists), artist_positions, out=cols[size:end])
+            data[size:end] = counts
+            size = end
+        if rows is None:
+            return cls(csr_matrix((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64),
+                       np.empty(0, dtype=KEY_DTYPE))
+        rows, cols, data = rows[:size], cols[:size], data[:size]
+
+        # Recode users in string order and artists in key order (= MBID string order), in place.
+        user_order = np.argsort(user_index.sorted_values.astype(str), kind="stable")
+        np.take(user_index.ranks(user_order), rows, out=rows, mode="clip")
+        np.take(artist_index.ranks(np.arange(len(artist_index))), cols, out=cols, mode="clip")
+        users = user_index.sorted_values[user_order]
+        artists = artist_index.sorted_values
+
+        # scipy fills the CSR arrays from the int32 / float32 buffers in one linear pass (no
+        # copies of the buffers), then sorts each row's columns and sums repeated pairs.
+        plays = csr_matrix((data, (rows, cols)), shape=(len(users), len(artists)), dtype=np.float32)
+        return cls(plays, users, artists)
+
+    def prune(self, min_artist_users=1, min_user_artists=1, min_user_plays=0, min_artist_plays=0):
+        """
+        The matrix restricted to the users and artists meeting the minimum supports (see
+        min_support_masks), re-indexed: the rows and columns of the survivors, in their order.
+
+        Returns:
+            tuple: (matrix, passes) where passes is the number of pruning passes made.
+        """
+        keep_users, keep_artists, passes = min_support_masks(self.plays, min_artist_users, min_user_artists,
+                                                             min_user_plays, min_artist_plays)
+        if keep_users.all() and keep_artists.all():
+            return self, passes
+        plays = self.plays[np.flatnonzero(keep_users)][:, np.flatnonzero(keep_artists)].tocsr()
+        plays.eliminate_zeros()
+        return PlayMatrix(plays.astype(np.float32, copy=False), np.asarray(self.users)[keep_users],
+                          np.asarray(self.artists)[keep_artists]), passes
+
+    def user_ids(self):
+        """The user IDs of the rows, as strings."""
+        return self.users.astype(str).tolist()
+
+    def artist_ids(self):
+        """The artist MBIDs of the columns, as strings."""
+        return key_uuids(self.artists)
+
+    def artist_index(self, artist_map=None):
+        """
+        ArtistIndex of the columns. The hash table is built on the first call and kept (and
+        saved with the matrix), so later calls and loads of a saved matrix reuse it.
+        """
+        if self._artist_index is None:
+            self._artist_index = ArtistIndex.from_keys(self.artists)
+        return self._artist_index.with_names(artist_map)
+
+    def save(self, prefix):
+        save_array(prefix + ".indptr.npy", self.plays.indptr)
+        save_array(prefix + ".indices.npy", self.plays.indices)
+        save_array(prefix + ".data.npy", self.plays.data)
+        save_array(prefix + ".users.npy", self.users)
+        save_array(prefix + ".artists.npy", self.artists)
+        save_array(prefix + ".artist_slots.npy", self.artist_index().hash_index.slots)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode=None):
+        """
+        Loads a saved matrix. With mmap_mode="r" the arrays are memory-mapped (read-only)
+        instead of read into memory.
+        """
+        users = np.load(prefix + ".users.npy", mmap_mode=mmap_mode)
+        artists = np.load(prefix + ".artists.npy", mmap_mode=mmap_mode)
+        plays = csr_matrix((np.load(prefix + ".data.npy", mmap_mode=mmap_mode),
+                            np.load(prefix + ".indices.npy", mmap_mode=mmap_mode),
+                            np.load(prefix + ".indptr.npy", mmap_mode=mmap_mode)),
+                           shape=(len(users), len(artists)), copy=False)
+        artist_index = None
+        if os.path.exists(prefix + ".artist_slots.npy"):
+            artist_index = ArtistIndex(KeyHashIndex(artists, np.load(prefix + ".artist_slots.npy", mmap_mode=mmap_mode)))
+        return cls(plays, users, artists, artist_index)
+
+    @classmethod
+    def open(cls, prefix, counts_path, mmap_mode=None, since=None, until=None):
+        """
+        Loads the matrix saved under prefix, building (or rebuilding) it first if it is missing,
+        counts_path changed since it was built, or it was built for another date range.
+
+        Returns:
+            tuple: (matrix, built) where built tells whether the matrix was (re)built.
+        """
+        date_range = [time_bound(since), time_bound(until)]
+        if is_current(prefix, counts_path) and (read_manifest(prefix).get("date_range") or [None, None]) == date_range:
+            return cls.load(prefix, mmap_mode), False
+        invalidate(prefix)
+        matrix = cls.build(counts_path, since=since, until=until)
+        matrix.save(prefix)
+        mark_built(prefix, counts_path, shape=list(matrix.plays.shape), nnz=int(matrix.plays.nnz),
+                   date_range=date_range)
+        return matrix, True
@@ -0,0 +1,147 @@
+"""
+model_store.py
+--------------
+Saved collaborative filtering models: the ALS factors of a trained model together with the
+IDs of the matrix rows and columns they belong to, in a directory of .npy files that can be
+memory-mapped:
+
+    user_factors.npy          float32, one row per user of the training matrix
+    item_factors.npy          float32, one row per artist
+    users.npy                 int64 user IDs of the rows
+    artists.keys.npy          16-byte artist MBID keys of the columns, and the hash table of
+    artists.slots.npy         their ArtistIndex (see src/utils/matrix_store.py)
+    model.json                format version, model and BM25 parameters, matrix shape, the
+                              counts table trained on, training time, warm-start origin
+
+model.json is written last, so a directory whose model.json is missing or has another format
+version holds no usable model. Loading memory-maps the arrays: it takes milliseconds whatever
+the size of the model, and the pages are shared by every process that loads the same model.
+
+The factors of a saved model can also seed the training of the next one (warm start, see
+SavedModel.warm_start_factors): users and artists already in the saved model start from their
+factors, new ones from small random values, so a retrain after adding a month of counts
+converges in a few iterations instead of a full training.
+"""
+
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from src.utils.interning import save_array
+from src.utils.lookup_store import source_fingerprint
+from src.utils.matrix_store import ArtistIndex
+
+# Bump when the layout of a saved model changes; older models then fail to load.
+MODEL_FORMAT_VERSION = 1
+
+MODEL_FILE = "model.json"
+
+class SavedModel:
+    """
+    Factors and row / column IDs of a trained model, plus its model.json metadata (params).
+
+        user_factors: float32 array, users x factors
+        item_factors: float32 array, artists x factors
+        users:        int64 user IDs of the user_factors rows
+        artist_index: ArtistIndex of the item_factors rows
+    """
+
+    def __init__(self, user_factors, item_factors, users, artist_index, params):
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.users = users
+        self.artist_index = artist_index
+        self.params = params
+
+    @classmethod
+    def from_factors(cls, user_factors, item_factors, users, artist_index, counts_path=None, **params):
+        """
+        Wraps freshly trained factors. params holds the model and BM25 parameters and any other
+        information to save in model.json (e.g. training_seconds).
+        """
+        users = np.asarray(users, dtype=np.int64)
+        if user_factors.shape[0] != len(users) or item_factors.shape[0] != len(artist_index):
+            raise ValueError(f"Factors of shape {user_factors.shape} / {item_factors.shape} do not match "
+                             f"{len(users)} users / {len(artist_index)} artists")
+        params = dict(params, created_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                      shape=[len(users), len(artist_index)], factors=int(item_factors.shape[1]))
+        if counts_path:
+            params["trained_on"] = source_fingerprint(counts_path)
+        return cls(np.ascontiguousarray(user_factors, dtype=np.float32),
+                   np.ascontiguousarray(item_factors, dtype=np.float32), users, artist_index, params)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        # Remove the metadata first, so a model overwritten halfway never looks complete.
+        if os.path.exists(os.path.join(directory, MODEL_FILE)):
+            os.remove(os.path.join(directory, MODEL_FILE))
+        save_array(os.path.join(directory, "user_factors.npy"), self.user_factors)
+        save_array(os.path.join(directory, "item_factors.npy"), self.item_factors)
+        save_array(os.path.join(directory, "users.npy"), self.users)
+        self.artist_index.save(os.path.join(directory, "artists"))
+        tmp_path = os.path.join(directory, MODEL_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(dict(self.params, version=MODEL_FORMAT_VERSION), fp, indent=2)
+        os.replace(tmp_path, os.path.join(directory, MODEL_FILE))
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Loads a saved model, memory-mapped by default (mmap_mode=None reads it into memory).
+
+        Raises:
+            ValueError: If the directory holds no complete model of the current format version.
+        """
+        params = read_model_params(directory)
+        if params is None:
+            raise ValueError(f"No saved model in {directory}")
+        if params.get("version") != MODEL_FORMAT_VERSION:
+            raise ValueError(f"Model in {directory} has format version {params.get('version')}, "
+                             f"expected {MODEL_FORMAT_VERSION}")
+        return cls(np.load(os.path.join(directory, "user_factors.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, "item_factors.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, "users.npy"), mmap_mode=mmap_mode),
+                   ArtistIndex.load(os.path.join(directory, "artists"), mmap_mode), params)
+
+    def warm_start_factors(self, users, artist_keys, seed=None):
+        """
+        Initial factors to train a model on a new matrix with the given user IDs (rows) and
+        artist keys (columns): rows of users and artists in this model are copied from its
+        factors, the others are drawn like implicit's own initialization (uniform in [0, 0.01)).
+
+        Returns:
+            tuple: (user_factors, item_factors, reused) where the factors are new, writable
+                   float32 arrays and reused counts the users and artists copied.
+        """
+        rng = np.random.default_rng(seed)
+        users = np.asarray(users, dtype=np.int64)
+        factors = self.item_factors.shape[1]
+
+        # Users: binary search in the sorted saved IDs; artists: the saved artist hash table.
+        user_rows = np.full(len(users), -1, dtype=np.int64)
+        if len(self.users):
+            order = np.argsort(self.users, kind="stable")
+            sorted_users = self.users[order]
+            positions = np.minimum(np.searchsorted(sorted_users, users), len(order) - 1)
+            matched = sorted_users[positions] == users
+            user_rows[matched] = order[positions[matched]]
+        item_rows = self.artist_index.hash_index.positions(artist_keys)
+
+        result = []
+        for rows, saved in ((user_rows, self.user_factors), (item_rows, self.item_factors)):
+            initial = rng.random((len(rows), factors), dtype=np.float32) * np.float32(0.01)
+            known = rows >= 0
+            initial[known] = saved[rows[known]]
+            result.append(initial)
+        reused = {"users": int((user_rows >= 0).sum()), "artists": int((item_rows >= 0).sum())}
+        return result[0], result[1], reused
+
+def read_model_params(directory):
+    """Returns the model.json metadata of a saved model, or None if there is none."""
+    try:
+        with open(os.path.join(directory, MODEL_FILE), encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,206 @@
+"""
+pipeline.py
+-----------
+A small DAG runner for the preprocessing stages (see src/preprocessing/run_pipeline.py).
+
+A Stage names a function by its import path ("module:function"), the arguments it is called
+with, and the files it reads and writes. The dependency graph follows from the paths: a stage
+depends on every stage that writes one of its inputs.
+
+Caching: each stage gets a key computed from its function, arguments and the fingerprints of
+its inputs (size + mtime, or SHA-256 of the content with content_hash=True). A stage whose key
+matches the previous successful run, and whose outputs are still the files that run wrote, is
+skipped. Since a rerun stage rewrites its outputs, the stages downstream of it see new input
+fingerprints and rerun too.
+
+Stages whose dependencies are done run concurrently, each in a fresh process, so the metrics
+measured for a stage (wall and CPU time, peak RSS, bytes read and written, rows per second; see
+src/utils/instrumentation.py) are its own. The state of the previous runs is kept
+in "<state_dir>/state.json", each stage's output in "<state_dir>/logs/<stage>.log", and the
+timings of the last run in "<state_dir>/report.json".
+"""
+
+import contextlib
+import hashlib
+import importlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from src.utils.file_utils import file_checksum
+from src.utils.instrumentation import FreshProcessPool, measure
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    Parameters:
+        name (str): Unique stage name.
+        target (str): Function to call, as "package.module:function".
+        args (list): Positional arguments (JSON-serializable).
+        inputs (list): Files or directories the stage reads.
+        outputs (list): Files or directories the stage writes.
+        kwargs (dict): Keyword arguments (JSON-serializable), e.g. tuning parameters.
+    """
+
+    def __init__(self, name, target, args, inputs, outputs, kwargs=None):
+        self.name = name
+        self.target = target
+        self.args = list(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.kwargs = dict(kwargs or {})
+
+def path_fingerprint(path, content_hash=False):
+    """
+    Returns a JSON-serializable fingerprint of a file or directory (None if it does not exist):
+    size and mtime, or the SHA-256 of the content with content_hash=True. Directories (e.g.
+    .npcols tables) are fingerprinted file by file.
+    """
+    if os.path.isdir(path):
+        return {name: path_fingerprint(os.path.join(path, name), content_hash) for name in sorted(os.listdir(path))}
+    if not os.path.exists(path):
+        return None
+    if content_hash:
+        return file_checksum(path)
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def stage_key(stage, content_hash=False):
+    """Hash of everything that determines a stage's outputs."""
+    description = {
+        "target": stage.target,
+        "args": stage.args,
+        "kwargs": stage.kwargs,
+        "inputs": {path: path_fingerprint(path, content_hash) for path in stage.inputs},
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _dependencies(stages):
+    """Maps each stage name to the names of the stages writing its inputs."""
+    writers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            if path in writers:
+                raise ValueError(f"{path} is written by both {writers[path]} and {stage.name}")
+            writers[path] = stage.name
+    return {stage.name: sorted({writers[path] for path in stage.inputs if path in writers} - {stage.name})
+            for stage in stages}
+
+def run_stage(name, target, args, kwargs, log_path):
+    """
+    Worker entry point: calls the stage function with its output going to log_path.
+
+    Returns:
+        dict: The metrics of the run (see src/utils/instrumentation.py).
+    """
+    module_name, function_name = target.split(":")
+    function = getattr(importlib.import_module(module_name), function_name)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "w", encoding="utf-8") as log, \
+         contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            with measure(name) as metrics:
+                function(*args, **kwargs)
+        except BaseException:
+            traceback.print_exc()
+            raise
+    return metrics.results
+
+def _load_state(state_dir):
+    path = os.path.join(state_dir, "state.json")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as fp:
+            return json.load(fp)
+    return {}
+
+def _save_json(path, data):
+    with open(path + ".tmp", "w", encoding="utf-8") as fp:
+        json.dump(data, fp, indent=2)
+    os.replace(path + ".tmp", path)
+
+def run_pipeline(stages, state_dir, max_workers=None, content_hash=False, force=()):
+    """
+    Runs the stages in dependency order, skipping those that are up to date.
+
+    Parameters:
+        stages (list): Stage objects.
+        state_dir (str): Directory for the cache state, logs and report.
+        max_workers (int): Maximum number of stages running at once (defaults to the CPU count).
+        content_hash (bool): Fingerprint inputs and outputs by content instead of size + mtime.
+        force (iterable): Names of stages to run even if they are up to date.
+
+    Returns:
+        dict: The run report, per stage: status ("ran", "skipped", "failed" or "not run") and,
+              for the stages that ran, their metrics.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    by_name = {stage.name: stage for stage in stages}
+    dependencies = _dependencies(stages)
+    state = _load_state(state_dir)
+    report = {}
+    done = set()
+    failed = False
+    running = {}
+    running_names = set()
+    started = time.perf_counter()
+
+    def ready():
+        return [name for name in by_name if name not in report and name not in running_names
+                and all(dep in done for dep in dependencies[name])]
+
+    # Every stage runs in a fresh process, so its peak RSS is its own.
+    with FreshProcessPool(max_workers) as pool:
+        while True:
+            # Submit every ready stage; skipping one may make its dependents ready at once.
+            candidates = [] if failed else ready()
+            while candidates:
+                for name in candidates:
+                    stage = by_name[name]
+                    key = stage_key(stage, content_hash)
+                    previous = state.get(name, {})
+                    up_to_date = (name not in force and previous.get("key") == key and all(
+                        previous.get("outputs", {}).get(path) == path_fingerprint(path, content_hash)
+                        for path in stage.outputs))
+                    if up_to_date:
+                        print(f"[{name}] up to date, skipped")
+                        report[name] = {"status": "skipped"}
+                        done.add(name)
+                        continue
+                    print(f"[{name}] running")
+                    log_path = os.path.join(state_dir, "logs", f"{name}.log")
+                    future = pool.submit(run_stage, name, stage.target, stage.args, stage.kwargs, log_path)
+                    running[future] = (name, key, log_path)
+                    running_names.add(name)
+                candidates = ready()
+            if not running:
+                # Either everything is done, or the remaining stages wait on a failed one.
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, key, log_path = running.pop(future)
+                running_names.discard(name)
+                try:
+                    metrics = future.result()
+                except Exception:  # the traceback is in the stage log
+                    failed = True
+                    report[name] = {"status": "failed", "log": log_path}
+                    print(f"[{name}] FAILED, see {log_path}")
+                    state.pop(name, None)
+                    continue
+                stage = by_name[name]
+                state[name] = {"key": key, "outputs": {path: path_fingerprint(path, content_hash)
+                                                       for path in stage.outputs}}
+                _save_json(os.path.join(state_dir, "state.json"), state)
+                report[name] = dict(status="ran", log=log_path, **metrics)
+                done.add(name)
+                print(f"[{name}] done in {metrics['wall_seconds']:.1f}s "
+                      f"(cpu {metrics['cpu_seconds']:.1f}s, peak RSS {metrics['peak_rss_mb']:.0f} MB)")
+
+    for name in by_name:
+        report.setdefault(name, {"status": "not run"})
+    summary = {"wall_seconds": time.perf_counter() - started, "stages": report}
+    _save_json(os.path.join(state_dir, "report.json"), summary)
+    return summary
@@ -0,0 +1,212 @@
+"""
+similarity.py
+-------------
+Similar-artist queries over the item factors of a saved model (see src/utils/model_store.py),
+for serving many queries instead of one model.similar_items call at a time.
+
+The similarity of two artists is the cosine of their factors, as in implicit's similar_items.
+top_k_similar computes the K most similar artists of every artist in blocks of rows: each
+block is one matrix product of L2-normalized factors followed by a partial sort of a few
+candidates per row, so the whole catalog is scored at close to BLAS speed in bounded memory.
+The result is a SimilarityTable, two n x K arrays (int32 artist rows and float32 scores),
+saved in the model directory and memory-mapped back, so a lookup is a row slice.
+
+SimilarityService answers queries by MBID from the table and falls back to computing one row
+(kept in an LRU cache) for queries asking for more than K neighbours.
+"""
+
+import functools
+import os
+
+import numpy as np
+
+from src.utils.interning import save_array
+from src.utils.lookup_store import invalidate, is_current, mark_built
+from src.utils.model_store import MODEL_FILE
+
+# Neighbours kept per artist in a precomputed table
+DEFAULT_TOP_K = 50
+# Upper bound on the scores computed at once (block rows x artists), i.e. 64 MB of float32
+SCORE_BLOCK_ELEMENTS = 1 << 24
+# Ad-hoc queries kept by a SimilarityService
+DEFAULT_CACHE_SIZE = 4096
+
+def normalized_factors(item_factors):
+    """
+    Item factors scaled to unit L2 norm, as float32. Zero vectors stay zero (implicit divides
+    their scores by 1e-10 instead; either way they are similar to nothing).
+    """
+    factors = np.asarray(item_factors, dtype=np.float32)
+    norms = np.linalg.norm(factors, axis=1)
+    norms[norms == 0] = 1e-10
+    return factors / norms[:, None]
+
+def top_k_rows(scores, k, groups=8):
+    """
+    Column indices and values of the k largest scores of each row, in decreasing order.
+
+    A full argpartition of every row costs more than the matrix product that computed it.
+    Instead, the columns of a row are split into `groups` strided slices and reduced to their
+    element-wise maximum (one vectorized pass); the k largest scores lie in the k columns of
+    that maximum with the largest values, so only groups * k candidates per row are
+    partitioned.
+    """
+    num_rows, num_columns = scores.shape
+    k = min(k, num_columns)
+    width = -(-num_columns // groups)
+    if k * groups < num_columns:
+        if width * groups != num_columns:
+            padding = np.full((num_rows, width * groups - num_columns), -np.inf, dtype=scores.dtype)
+            scores = np.concatenate([scores, padding], axis=1)
+        maxima = scores.reshape(num_rows, groups, width).max(axis=1)
+        top_columns = np.argpartition(maxima, -k, axis=1)[:, -k:]
+        candidates = (top_columns[:, None, :] + width * np.arange(groups)[None, :, None]).reshape(num_rows, -1)
+    else:
+        candidates = np.broadcast_to(np.arange(num_columns), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    if k < candidates.shape[1]:
+        top = np.argpartition(candidate_scores, -k, axis=1)[:, -k:]
+        candidates = np.take_along_axis(candidates, top, axis=1)
+        candidate_scores = np.take_along_axis(candidate_scores, top, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+def top_k_similar(normalized, k=DEFAULT_TOP_K, rows=None, block_elements=SCORE_BLOCK_ELEMENTS):
+    """
+    The k most similar artists of each of `rows` (default: all artists), the artist itself
+    included, as with similar_items.
+
+    Parameters:
+        normalized (numpy.ndarray): Unit-norm item factors (see normalized_factors).
+        k (int): Neighbours per artist.
+        rows (array-like): Rows of the query artists.
+        block_elements (int): Bound on the size of the score block computed at once.
+
+    Returns:
+        tuple: (neighbours, scores), int32 and float32 arrays of shape (len(rows), k).
+    """
+    rows = np.arange(len(normalized)) if rows is None else np.asarray(rows, dtype=np.int64)
+    k = min(k, len(normalized))
+    neighbours = np.empty((len(rows), k), dtype=np.int32)
+    scores = np.empty((len(rows), k), dtype=np.float32)
+    block_rows = max(1, block_elements // max(len(normalized), 1))
+    for start in range(0, len(rows), block_rows):
+        block = rows[start:start + block_rows]
+        block_scores = normalized[block] @ normalized.T
+        neighbours[start:start + len(block)], scores[start:start + len(block)] = top_k_rows(block_scores, k)
+    return neighbours, scores
+
+class SimilarityTable:
+    """
+    Precomputed neighbours of every artist: row i of neighbours / scores holds the K most
+    similar artists of artist i (matrix column order) and their cosine similarities.
+    """
+
+    def __init__(self, neighbours, scores):
+        self.neighbours = neighbours
+        self.scores = scores
+
+    @property
+    def k(self):
+        return self.neighbours.shape[1]
+
+    def __len__(self):
+        return len(self.neighbours)
+
+    @classmethod
+    def build(cls, item_factors, k=DEFAULT_TOP_K):
+        return cls(*top_k_similar(normalized_factors(item_factors), k))
+
+    def save(self, prefix):
+        save_array(prefix + ".neighbours.npy", self.neighbours)
+        save_array(prefix + ".scores.npy", self.scores)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        return cls(np.load(prefix + ".neighbours.npy", mmap_mode=mmap_mode),
+                   np.load(prefix + ".scores.npy", mmap_mode=mmap_mode))
+
+    @classmethod
+    def open(cls, model_dir, item_factors, k=DEFAULT_TOP_K):
+        """
+        Loads the table saved in a model directory, building it first if it is missing, has
+        fewer than k neighbours per artist or was built for an earlier model saved there.
+
+        Returns:
+            tuple: (table, built) where built tells whether the table was (re)built.
+        """
+        prefix = os.path.join(model_dir, "similar_items")
+        model_file = os.path.join(model_dir, MODEL_FILE)
+        if is_current(prefix, model_file):
+            table = cls.load(prefix)
+            if table.k >= min(k, len(item_factors)):
+                return table, False
+        invalidate(prefix)
+        table = cls.build(item_factors, k)
+        table.save(prefix)
+        mark_built(prefix, model_file, k=table.k)
+        return table, True
+
+class SimilarityService:
+    """
+    Similar-artist lookups by MBID over a SavedModel: from its SimilarityTable when the table
+    has enough neighbours per artist, otherwise computed for the one artist and cached (LRU).
+    Given an ANN index (see src/utils/ann.py), the computed queries search it, with the
+    ann_query parameters (e.g. {"nprobe": 16}), instead of scanning every artist.
+    """
+
+    def __init__(self, saved_model, table=None, cache_size=DEFAULT_CACHE_SIZE, ann=None, ann_query=None):
+        self.artist_index = saved_model.artist_index
+        self.table = table
+        self.ann = ann
+        self.ann_query = ann_query or {}
+        self._normalized = None
+        self._item_factors = saved_model.item_factors
+        self._similar_row = functools.lru_cache(maxsize=cache_size)(self._compute_row)
+
+    @classmethod
+    def open(cls, model_dir, saved_model, k=DEFAULT_TOP_K, cache_size=DEFAULT_CACHE_SIZE):
+        """Service over a saved model, with the table saved in its directory (built if needed)."""
+        table, _ = SimilarityTable.open(model_dir, saved_model.item_factors, k)
+        return cls(saved_model, table, cache_size)
+
+    @property
+    def normalized(self):
+        if self._normalized is None:
+            self._normalized = normalized_factors(self._item_factors)
+        return self._normalized
+
+    def _compute_row(self, row, n):
+        if self.ann is not None:
+            return self.ann.query(self._item_factors[row], n, **self.ann_query)
+        neighbours, scores = top_k_similar(self.normalized, n, rows=[row])
+        return neighbours[0], scores[0]
+
+    def similar_rows(self, row, n=20):
+        """(neighbour rows, scores) of the n artists most similar to the artist in row."""
+        if self.table is not None and n <= self.table.k:
+            return self.table.neighbours[row, :n], self.table.scores[row, :n]
+        return self._similar_row(int(row), n)
+
+    def similar_rows_batch(self, rows, n=20):
+        """Vectorized similar_rows: (neighbours, scores) arrays of shape (len(rows), n)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.table is not None and n <= self.table.k:
+            return self.table.neighbours[rows, :n], self.table.scores[rows, :n]
+        if self.ann is not None:
+            return self.ann.query_batch(self._item_factors[rows], n, **self.ann_query)
+        return top_k_similar(self.normalized, n, rows=rows)
+
+    def similar_artists(self, mbid, n=20, default_name="unknown"):
+        """
+        The n artists most similar to an artist MBID, as (MBID, name, score) tuples.
+
+        Raises:
+            ValueError: If the MBID is not an artist of the model.
+        """
+        neighbours, scores = self.similar_rows(self.artist_index.row(mbid), n)
+        return list(zip(self.artist_index.mbids(neighbours), self.artist_index.names(neighbours, default_name),
+                        np.asarray(scores).tolist()))
+
+    def cache_info(self):
+        return self._similar_row.cache_info()